@@ -1,22 +1,17 @@
+import collections
 import logging
 import os
+import sys
 from typing import Annotated, Optional
 
-import pathlib as plb
 import tempfile
-import dicom2nifti
-import nibabel as nib
-import pydicom
-import shutil
 from tqdm import tqdm
 
+import qt
 import vtk
-import numpy as np
 import surfa as sf
 import tensorflow as tf
 import voxelmorph as vxm
-import neurite as ne
-import nibabel as nib
 import SimpleITK as sitk
 import sitkUtils
 
@@ -32,6 +27,15 @@ from slicer.parameterNodeWrapper import (
 
 from slicer import vtkMRMLScalarVolumeNode
 
+# SynthMorph package bundled with the module.
+sys.path.append(os.path.join(os.path.dirname(__file__), "mri_synthmorph"))
+
+import batch_processing
+import dicom_index
+import preprocess
+import space_register
+from suvr_calculate import compute_subject_suvr, save_suvr_results, suvr_mapping
+
 
 #
 # SynCT
@@ -262,6 +266,123 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.ui.cancelButton5.connect("clicked(bool)", self.onCancel5)
         self.ui.applyButton5.connect("clicked(bool)", self.onApplyClicked5)
 
+        # 批量任务在后台运行，由定时器轮询进度
+        self.batch = None
+        self.batchTimer = qt.QTimer()
+        self.batchTimer.setInterval(200)
+        self.batchTimer.connect("timeout()", self.onBatchTimeout)
+
+    def cleanup(self) -> None:
+        """Called when the application closes and the module widget is destroyed."""
+        self.cancelBatch()
+        self.batchTimer.stop()
+
+    # 批量任务
+    def isBatchRunning(self):
+        """同一时间只运行一个批量任务"""
+        if self.batch is not None:
+            slicer.util.errorDisplay("A batch is already running!")
+            return True
+        return False
+
+    def startBatch(self, batch, updateProgress, message, onFinished=None, status=None, failures=None):
+        """开始轮询批量任务
+
+        batch 为 batch_processing.BatchExecutor 或 CliBatch。每次定时器触发时收集已完成的
+        被试并更新进度条，全部完成后调用 onFinished(results, errors)。
+        status 若指定，运行期间以其返回的 (value, message) 代替完成的被试数显示进度。
+        failures 若指定，完成时以其返回的 failures(results, errors) = (failed, total) 代替
+        失败的任务数显示，用于一个任务处理多个被试、并在结果中返回各自失败的情况。
+        """
+        self.batch = batch
+        self.batchProgress = updateProgress
+        self.batchMessage = message
+        self.batchFinished = onFinished
+        self.batchStatus = status
+        self.batchFailures = failures
+        self.onBatchTimeout()
+        if self.batch is not None:
+            self.batchTimer.start()
+
+    def seriesCriteria(self, n):
+        """批量DICOM对话框中的序列筛选条件，0表示不限制"""
+        criteria = {}
+        description = getattr(self.ui, f"lineEdit_{n}_5").text.strip()
+        if description:
+            criteria['description'] = description
+        min_slices = getattr(self.ui, f"spinBox_{n}_6").value
+        if min_slices:
+            criteria['min_slices'] = min_slices
+        max_thickness = getattr(self.ui, f"doubleSpinBox_{n}_7").value
+        if max_thickness:
+            criteria['max_thickness'] = max_thickness
+        return criteria
+
+    def indexDicom(self, base_dir, updateProgress, onIndexed):
+        """在后台线程更新DICOM索引，只读取新增或修改文件的头信息
+
+        进度由batchTimer轮询显示，界面保持响应。索引完成后在主线程调用onIndexed(index)，
+        返回后关闭索引。取消或失败时不调用。
+        """
+        progress = {}
+
+        def callback(done, total):
+            progress.update(done=done, total=total)
+
+        def update():
+            # SQLite连接只能在创建它的线程中使用，后台线程单独打开索引
+            with dicom_index.DicomIndex(self.logic.dicom_index_path) as index:
+                return index.update(base_dir, callback=callback)
+
+        def status():
+            if not progress:
+                return 0, "Indexing DICOM..."
+            done, total = progress['done'], progress['total']
+            return int(100 * done / total), f"Indexing DICOM {done}/{total}..."
+
+        def onFinished(results, errors):
+            if executor.cancelled:
+                return
+            if errors:
+                raise next(iter(errors.values()))
+            with dicom_index.DicomIndex(self.logic.dicom_index_path) as index:
+                onIndexed(index)
+
+        executor = batch_processing.BatchExecutor(1, processes=False)
+        executor.submit(base_dir, update)
+        self.startBatch(executor, updateProgress, "DICOM indexed", onFinished, status=status)
+
+    def onBatchTimeout(self):
+        done, total = self.batch.poll()
+        if not self.batch.finished:
+            if self.batchStatus is not None:
+                self.batchProgress(*self.batchStatus())
+            else:
+                self.batchProgress(int(100 * done / total), f"Processing {done}/{total}...")
+            return
+
+        self.batchTimer.stop()
+        batch, self.batch = self.batch, None
+
+        message = "Cancelled!" if batch.cancelled else self.batchMessage
+        failed = len(batch.errors)
+        if self.batchFailures is not None:
+            failed, total = self.batchFailures(batch.results, batch.errors)
+        if failed:
+            message += f" ({failed}/{total} failed)"
+        self.batchProgress(100, message)
+
+        if self.batchFinished is not None:
+            try:
+                self.batchFinished(batch.results, batch.errors)
+            except Exception as e:
+                slicer.util.errorDisplay(f"Error during processing: {str(e)}")
+
+    def cancelBatch(self):
+        """取消尚未开始的被试，正在处理的被试完成后停止"""
+        if self.batch is not None:
+            self.batch.cancel()
+
     # 批量CT dicom2nifit
     def onDialogShow8(self):
         # 显示对话框
@@ -295,6 +416,7 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def onCancel8(self):
         """取消按钮点击事件"""
+        self.cancelBatch()
         self.ui.dialog8.close()
 
     def onApplyClicked8(self):
@@ -313,58 +435,38 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         if not os.path.isdir(base_dir):
             slicer.util.errorDisplay(f"Base directory does not exist: {base_dir}")
             return
+
+        if self.isBatchRunning():
+            return
         
         # 开始处理        
         try:
             # 获取所有子文件夹名
-            subdirs = [d for d in os.listdir(base_dir) 
-                    if os.path.isdir(os.path.join(base_dir, d))]
-            subdirs.sort()
+            subdirs = batch_processing.list_subjects(base_dir)
             
             if not subdirs:
                 slicer.util.errorDisplay("no subdirs", windowTitle="Error dir path")
                 return
             
             # 初始化
+            self.ui.progressBar8.setMaximum(100)
             self.ui.progressBar8.setValue(0)
             self.ui.progressBar8.setFormat("Prepare CT dicom2nifit...")
             
-            
-            # 遍历每个子文件夹
-            for i, subdir in enumerate(subdirs):
-                self.updateProgress8(10 + i*80, f"Processing {i}/{len(subdirs)} {subdir}...")
-                subdir_path = os.path.join(base_dir, subdir)
-                print(f"Processing subdir: {subdir_path}")
-                
-                # 查找指定文件夹
-                fold_path = os.path.join(subdir_path, fold_name)
-                output_file_path = os.path.join(output_path, subdir)
-                
-                # 确保输出目录存在
-                os.makedirs(output_file_path, exist_ok=True)
-
-                if os.path.isdir(fold_path):
-                    self.ui.progressBar8.setMaximum(10 + len(subdirs)*80)  # 分配权重
-
-                    with tempfile.TemporaryDirectory() as tmp_dir:
-                        tmp_path = plb.Path(tmp_dir)
-                        
-                        print("开始DICOM到NIfTI转换...")
-                        
-                        # 将DICOM目录转换为NIfTI
-                        dicom2nifti.convert_directory(fold_path, str(tmp_path), compression=False, reorient=True)
-                        
-                        nii = next(tmp_path.glob('*nii'))
-                        
-                        # 修正：使用os.path.join来拼接路径
-                        output_file = os.path.join(output_file_path, f'{output_file_name}.nii')
-                        shutil.copy(nii, output_file)
-                        ct_path = output_file
-                        
-                        print(f"转换成功: {ct_path}")
-                    
-                    
-            self.updateProgress8(10 + len(subdirs)*80, "Complete CT dicom2nifit!")  
+            # 从索引中查找含CT序列的被试，每个被试作为一个任务，分发到进程池
+            criteria = self.seriesCriteria(8)
+            def onIndexed(index):
+                executor = batch_processing.BatchExecutor(self.logic.batch_workers)
+                for subdir in subdirs:
+                    fold_path = os.path.join(base_dir, subdir, fold_name)
+                    if index.series(fold_path, modality='CT', **criteria):
+                        output_file = os.path.join(output_path, subdir, f'{output_file_name}.nii')
+                        executor.submit(subdir, preprocess.dicom_to_nifti_ct, fold_path, output_file, index.path,
+                                        **criteria)
+
+                self.startBatch(executor, self.updateProgress8, "Complete CT dicom2nifit!")
+
+            self.indexDicom(base_dir, self.updateProgress8, onIndexed)
             
         except Exception as e:
             slicer.util.errorDisplay(f"Error during processing: {str(e)}")
@@ -373,7 +475,6 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """更新进度辅助函数"""
         self.ui.progressBar8.setValue(value)
         self.ui.progressBar8.setFormat(message)
-        slicer.app.processEvents()
 
     # 批量PET dicom2nifit
     def onDialogShow9(self):
@@ -408,6 +509,7 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def onCancel9(self):
         """取消按钮点击事件"""
+        self.cancelBatch()
         self.ui.dialog9.close()
 
     def onApplyClicked9(self):
@@ -426,63 +528,40 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         if not os.path.isdir(base_dir):
             slicer.util.errorDisplay(f"Base directory does not exist: {base_dir}")
             return
+
+        if self.isBatchRunning():
+            return
         
         # 开始处理        
         try:
             # 获取所有子文件夹名
-            subdirs = [d for d in os.listdir(base_dir) 
-                    if os.path.isdir(os.path.join(base_dir, d))]
-            subdirs.sort()
+            subdirs = batch_processing.list_subjects(base_dir)
             
             if not subdirs:
                 slicer.util.errorDisplay("no subdirs", windowTitle="Error dir path")
                 return
             
             # 初始化
+            self.ui.progressBar9.setMaximum(100)
             self.ui.progressBar9.setValue(0)
             self.ui.progressBar9.setFormat("Prepare PET dicom2nifit...")
             
-            
-            # 遍历每个子文件夹
-            for i, subdir in enumerate(subdirs):
-                self.updateProgress9(10 + i*80, f"Processing {i}/{len(subdirs)} {subdir}...")
-                subdir_path = os.path.join(base_dir, subdir)
-                print(f"Processing subdir: {subdir_path}")
-                
-                # 查找指定文件夹
-                fold_path = os.path.join(subdir_path, fold_name)
-                output_file_path = os.path.join(output_path, subdir)
-                
-                # 确保输出目录存在
-                os.makedirs(output_file_path, exist_ok=True)
-
-                if os.path.isdir(fold_path):
-                    self.ui.progressBar9.setMaximum(10 + len(subdirs)*80)  # 分配权重
+            # 从索引中查找含PET序列的被试，每个被试作为一个任务，分发到进程池
+            criteria = self.seriesCriteria(9)
+            # SUV系数写入scl_slope，或写出float32数据
+            suv_mode = 'float32' if self.ui.suvModeComboBox_9.currentText == 'float32' else 'slope'
+            def onIndexed(index):
+                executor = batch_processing.BatchExecutor(self.logic.batch_workers)
+                for subdir in subdirs:
+                    fold_path = os.path.join(base_dir, subdir, fold_name)
+                    if index.series(fold_path, modality='PT', **criteria):
+                        output_file = os.path.join(output_path, subdir, f'{output_file_name}.nii')
+                        executor.submit(subdir, preprocess.dicom_to_nifti_pet, fold_path, output_file, index.path,
+                                        suv_mode=suv_mode, **criteria)
 
-                    fold_path_obj = plb.Path(fold_path)
+                self.startBatch(executor, self.updateProgress9, "Complete PET dicom2nifit!")
 
-                    first_pt_dcm = next(fold_path_obj.glob('*'))
-                    suv_corr_factor = self.logic.calculate_suv_factor(first_pt_dcm)
-                    
-                    # 使用临时目录进行转换
-                    with tempfile.TemporaryDirectory() as tmp_dir:
-                        tmp_path = plb.Path(tmp_dir)
-                        
-                        print("开始DICOM到NIfTI转换...")
-                        
-                        # 将DICOM目录转换为NIfTI
-                        dicom2nifti.convert_directory(fold_path, str(tmp_path), compression=False, reorient=True)
-                        
-                        nii = next(tmp_path.glob('*nii'))
-                        suv_pet_nii = self.logic.convert_pet(nib.load(nii), suv_factor=suv_corr_factor)
-                        output_file = os.path.join(output_file_path, f'{output_file_name}.nii')
-                        nib.save(suv_pet_nii, output_file)
-                        pet_path = output_file
-                        
-                        print(f"转换成功: {pet_path}")
-                    
-                    
-            self.updateProgress9(10 + len(subdirs)*80, "Complete PET dicom2nifit!")  
+            self.indexDicom(base_dir, self.updateProgress9, onIndexed)
             
         except Exception as e:
             slicer.util.errorDisplay(f"Error during processing: {str(e)}")
@@ -491,7 +570,6 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """更新进度辅助函数"""
         self.ui.progressBar9.setValue(value)
         self.ui.progressBar9.setFormat(message)
-        slicer.app.processEvents()
 
 
     # 批量头骨剥离
@@ -527,6 +605,7 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def onCancel6(self):
         """取消按钮点击事件"""
+        self.cancelBatch()
         self.ui.dialog6.close()
 
     def onApplyClicked6(self):
@@ -545,105 +624,49 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         if not os.path.isdir(base_dir):
             slicer.util.errorDisplay(f"Base directory does not exist: {base_dir}")
             return
+
+        if self.isBatchRunning():
+            return
         
         # 开始处理        
         try:
             # 获取所有子文件夹名
-            subdirs = [d for d in os.listdir(base_dir) 
-                    if os.path.isdir(os.path.join(base_dir, d))]
-            subdirs.sort()
+            subdirs = batch_processing.list_subjects(base_dir)
             
             if not subdirs:
                 slicer.util.errorDisplay("no subdirs", windowTitle="Error dir path")
                 return
             
             # 初始化
+            self.ui.progressBar6.setMaximum(100)
             self.ui.progressBar6.setValue(0)
             self.ui.progressBar6.setFormat("Prepare skull strip...")
             
-            
-            # 遍历每个子文件夹
-            for i, subdir in enumerate(subdirs):
-                self.updateProgress6(10 + i*80, f"Processing {i}/{len(subdirs)} {subdir}...")
+            backend = self.ui.skullStripBackendComboBox_batch.currentText
+            if backend == "SynthStrip":
+                # SynthStrip 不需要场景，每个工作进程只加载一次模型；模型较大，进程数与CLI相同
+                batch = batch_processing.BatchExecutor(self.logic.cli_workers)
+                threads = max(1, (os.cpu_count() or 1) // self.logic.cli_workers)
+            else:
+                # SwissSkullStripper 需要场景节点，在主线程启动，多个CLI进程同时运行
+                batch = CliBatch(self.logic.cli_workers)
+
+            for subdir in subdirs:
                 subdir_path = os.path.join(base_dir, subdir)
-                print(f"Processing subdir: {subdir_path}")
                 
                 # 查找指定文件
                 file_path = os.path.join(subdir_path, filename)
                 output_file_path = os.path.join(subdir_path, output_name)
                 output_mask_file_path = os.path.join(subdir_path, output_label_name)
-                if os.path.isfile(file_path):
-                    self.ui.progressBar6.setMaximum(10 + len(subdirs)*80)  # 分配权重
-
-                    self.image_skull = slicer.util.loadVolume(file_path)
-
-                    # 创建临时节点用于处理
-                    temp_stripped_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", "temp_stripped")
-                    temp_mask_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", "temp_mask")
-                    
-                    try:
-                        # 运行 SwissSkullStripper
-                        parameters = {
-                            "patientVolume": self.image_skull.GetID(),
-                            "patientOutputVolume": temp_stripped_node.GetID(),
-                            "patientMaskLabel": temp_mask_node.GetID(),
-                        }
-                        print("正在运行头骨剥离...")
-                        cli_node = slicer.cli.run(slicer.modules.swissskullstripper, None, parameters, wait_for_completion=True)
-
-                        # 检查是否成功完成
-                        if cli_node.GetStatus() != cli_node.Completed:
-                            raise RuntimeError(f"头骨剥离失败，状态: {cli_node.GetStatusString()}")
-                        
-                        print("头骨剥离完成，正在保存结果...")
-                        
-                        # 保存结果到指定路径
-                        print(f"保存头骨剥离结果到: {output_file_path}")
-                        slicer.util.saveNode(temp_stripped_node, output_file_path)
-                        
-                        print(f"保存掩码结果到: {output_mask_file_path}")
-                        slicer.util.saveNode(temp_mask_node, output_mask_file_path)
-                        
-                        print("头骨剥离完成!")
-                        
-                    except Exception as e:
-                        raise RuntimeError(f"头骨剥离过程失败: {str(e)}")
-                    
-                    finally:
-                        # 清理临时节点
-                        slicer.mrmlScene.RemoveNode(temp_stripped_node)
-                        slicer.mrmlScene.RemoveNode(temp_mask_node)
-                        
-                        # 可选：也移除输入节点以保持场景清洁
-                        if hasattr(self, 'image_skull') and self.image_skull:
-                            slicer.mrmlScene.RemoveNode(self.image_skull)
-
-                    # # 构建 mri_synthstrip 命令
-                    # mri_synthstrip_script = os.path.join(os.path.dirname(__file__), "./tools/mri_synthstrip.py")
-
-                    # if not os.path.exists(mri_synthstrip_script):
-                    #     raise FileNotFoundError(f"mri_synthstrip.py not found at: {mri_synthstrip_script}")
-                    
-                    # # 设置命令参数
-                    # import subprocess
-                    # cmd = [
-                    #     "python", mri_synthstrip_script,
-                    #     "-i", file_path,
-                    #     "-o", output_file_path,
-                    #     "-m", output_mask_file_path,
-                    #     "--model", "E:\\synthstrip.1.pt"
-                    # ]
-
-                    # print(f"Running command: {' '.join(cmd)}")
-                    # result = subprocess.run(cmd, capture_output=True, text=True, cwd=os.path.dirname(__file__))
-
-                    # if result.returncode != 0:
-                    #     raise RuntimeError(f"mri_synthstrip failed: {result.stderr}")
-                    
-                    # print(f"mri_synthstrip output: {result.stdout}")
-                    
+                if not os.path.isfile(file_path):
+                    continue
+                if backend == "SynthStrip":
+                    batch.submit(subdir, batch_processing.synthstrip, file_path,
+                                 output=output_file_path, mask=output_mask_file_path, threads=threads)
+                else:
+                    batch.submit(subdir, self.logic.startSkullStrip, file_path, output_file_path, output_mask_file_path)
 
-            self.updateProgress6(10 + len(subdirs)*80, "Complete skull strip!")  
+            self.startBatch(batch, self.updateProgress6, "Complete skull strip!")
             
         except Exception as e:
             slicer.util.errorDisplay(f"Error during processing: {str(e)}")
@@ -652,7 +675,6 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """更新进度辅助函数"""
         self.ui.progressBar6.setValue(value)
         self.ui.progressBar6.setFormat(message)
-        slicer.app.processEvents()
 
 
 
@@ -688,6 +710,7 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def onCancel6_pet(self):
         """取消按钮点击事件"""
+        self.cancelBatch()
         self.ui.dialog6_pet.close()
 
     def onApplyClicked6_pet(self):
@@ -706,28 +729,28 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         if not os.path.isdir(base_dir):
             slicer.util.errorDisplay(f"Base directory does not exist: {base_dir}")
             return
+
+        if self.isBatchRunning():
+            return
         
         # 开始处理        
         try:
             # 获取所有子文件夹名
-            subdirs = [d for d in os.listdir(base_dir) 
-                    if os.path.isdir(os.path.join(base_dir, d))]
-            subdirs.sort()
+            subdirs = batch_processing.list_subjects(base_dir)
             
             if not subdirs:
                 slicer.util.errorDisplay("no subdirs", windowTitle="Error dir path")
                 return
             
             # 初始化
+            self.ui.progressBar6_pet.setMaximum(100)
             self.ui.progressBar6_pet.setValue(0)
             self.ui.progressBar6_pet.setFormat("Prepare skull strip...")
-   
             
-            # 遍历每个子文件夹
-            for i, subdir in enumerate(subdirs):
-                self.updateProgress6_pet(int((i / len(subdirs)) * 90), f"Processing {i}/{len(subdirs)} {subdir}...")
+            # 每个子文件夹作为一个任务，分发到进程池
+            executor = batch_processing.BatchExecutor(self.logic.batch_workers)
+            for subdir in subdirs:
                 subdir_path = os.path.join(base_dir, subdir)
-                print(f"Processing subdir: {subdir_path}")
                 
                 # 查找指定文件
                 file_path = os.path.join(subdir_path, filename)
@@ -743,37 +766,9 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                     print(f"Mask file not found: {mask_path}")
                     continue
 
-                # 使用nibabel加载图像和掩码
-                try:
-                    # 加载图像
-                    img = nib.load(file_path)
-                    img_data = img.get_fdata()
-                    
-                    # 加载掩码
-                    mask = nib.load(mask_path)
-                    mask_data = mask.get_fdata()
-                    
-                    # 确保图像和掩码尺寸一致
-                    if img_data.shape != mask_data.shape:
-                        print(f"Image and mask shape mismatch in {subdir}: {img_data.shape} vs {mask_data.shape}")
-                        continue
-                    
-                    # 应用掩码进行颅骨剥离（假设掩码是二值的，1为保留区域，0为背景）
-                    skull_stripped_data = img_data * mask_data
-                    
-                    # 创建新的NIfTI图像
-                    skull_stripped_img = nib.Nifti1Image(skull_stripped_data, img.affine, img.header)
-                    
-                    # 保存结果
-                    nib.save(skull_stripped_img, output_image_path)
-                    print(f"Skull-stripped image saved to: {output_image_path}")
-                    
-                except Exception as e:
-                    print(f"Error processing {subdir}: {str(e)}")
-                    continue
-                
+                executor.submit(subdir, preprocess.apply_mask, file_path, mask_path, output_image_path)
 
-            self.updateProgress6_pet(100, "Complete skull strip!")  
+            self.startBatch(executor, self.updateProgress6_pet, "Complete skull strip!")
             
         except Exception as e:
             slicer.util.errorDisplay(f"Error during processing: {str(e)}")
@@ -782,7 +777,6 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """更新进度辅助函数"""
         self.ui.progressBar6_pet.setValue(value)
         self.ui.progressBar6_pet.setFormat(message)
-        slicer.app.processEvents()
 
     # 批量CTClip
     def onDialogShow7(self):
@@ -817,6 +811,7 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def onCancel7(self):
         """取消按钮点击事件"""
+        self.cancelBatch()
         self.ui.dialog7.close()
 
     def onApplyClicked7(self):
@@ -850,43 +845,38 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         except ValueError:
             slicer.util.errorDisplay(f"Invalid maximum value: {maximum_str}")
             return
+
+        if self.isBatchRunning():
+            return
         
         # 开始处理        
         try:
             # 获取所有子文件夹名
-            subdirs = [d for d in os.listdir(base_dir) 
-                    if os.path.isdir(os.path.join(base_dir, d))]
-            subdirs.sort()
+            subdirs = batch_processing.list_subjects(base_dir)
             
             if not subdirs:
                 slicer.util.errorDisplay("no subdirs", windowTitle="Error dir path")
                 return
             
             # 初始化
+            self.ui.progressBar7.setMaximum(100)
             self.ui.progressBar7.setValue(0)
             self.ui.progressBar7.setFormat("Prepare CT Clip...")
             
-            
-            # 遍历每个子文件夹
-            for i, subdir in enumerate(subdirs):
-                self.updateProgress7(10 + i*80, f"Processing {i}/{len(subdirs)} {subdir}...")
+            # 每个子文件夹作为一个任务，分发到进程池
+            executor = batch_processing.BatchExecutor(self.logic.batch_workers)
+            for subdir in subdirs:
                 subdir_path = os.path.join(base_dir, subdir)
-                print(f"Processing subdir: {subdir_path}")
                 
                 # 查找指定文件
                 file_path = os.path.join(subdir_path, filename)
                 output_file_path = os.path.join(subdir_path, output_name)
 
                 if os.path.isfile(file_path):
-                    self.ui.progressBar7.setMaximum(10 + len(subdirs)*80)  # 分配权重
-
-                    data, affine, header = self.logic.load_nifti(file_path)
-                    normalized_data = self.logic.threshold_and_normalize(data, minimum, maximum, normalize)
+                    executor.submit(subdir, preprocess.ct_clip, file_path, output_file_path, minimum, maximum, normalize,
+                                    self.logic.ct_clip_dtype)
 
-                    self.logic.save_nifti(normalized_data, affine, header, output_file_path)
-                    print(f"CTClip image saved to: {output_file_path}")
-                    
-            self.updateProgress7(10 + len(subdirs)*80, "Complete CT Clip!")  
+            self.startBatch(executor, self.updateProgress7, "Complete CT Clip!")
             
         except Exception as e:
             slicer.util.errorDisplay(f"Error during processing: {str(e)}")
@@ -895,7 +885,6 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """更新进度辅助函数"""
         self.ui.progressBar7.setValue(value)
         self.ui.progressBar7.setFormat(message)
-        slicer.app.processEvents()
 
 
 
@@ -932,6 +921,7 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def onCancel1(self):
         """取消按钮点击事件"""
+        self.cancelBatch()
         self.ui.dialog1.close()
 
     def onApplyClicked1(self):
@@ -963,97 +953,53 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         if not os.path.isfile(fixed_image_path):
             slicer.util.errorDisplay(f"Fixed image file does not exist: {fixed_image_path}")
             return
+
+        if self.isBatchRunning():
+            return
         
         # 开始处理        
         try:
             # 获取所有子文件夹名
-            subdirs = [d for d in os.listdir(base_dir) 
-                    if os.path.isdir(os.path.join(base_dir, d))]
-            subdirs.sort()
+            subdirs = batch_processing.list_subjects(base_dir)
             
             if not subdirs:
                 slicer.util.errorDisplay("no subdirs", windowTitle="Error dir path")
                 return
             
             # 初始化
+            self.ui.progressBar1.setMaximum(100)
             self.ui.progressBar1.setValue(0)
             self.ui.progressBar1.setFormat("Prepare register...")
             
-            self.updateProgress1(10, "Load fixed image...")
-            fixed_volume  = slicer.util.loadVolume(fixed_image_path)
+            # 固定图像只加载一次，所有被试共用
+            self.updateProgress1(0, "Load fixed image...")
+            fixed_volume = slicer.util.loadVolume(fixed_image_path)
             
-            # 遍历每个子文件夹
-            for i, subdir in enumerate(subdirs):
-                self.updateProgress1(10 + i*80, f"Processing {i}/{len(subdirs)} {subdir}...")
+            # BRAINSFit 需要场景节点，在主线程启动，多个CLI进程同时运行
+            cli_batch = CliBatch(self.logic.cli_workers)
+            for subdir in subdirs:
                 subdir_path = os.path.join(base_dir, subdir)
-                print(f"Processing subdir: {subdir_path}")
                 
                 # 查找指定文件
                 file_path = os.path.join(subdir_path, filename)
                 if os.path.isfile(file_path):
-                    moving_volume  = slicer.util.loadVolume(file_path)
-                    self.ui.progressBar1.setMaximum(10 + len(subdirs)*80)  # 分配权重
-
-                    # Create output volume node
-                    self.rigidRegisteredVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", output_name)
-                    self.rigidRegisteredFieldVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTransformNode", output_field_name)
-
-                    # 创建配准参数
-                    parameters = {
-                        "fixedVolume": fixed_volume.GetID(),
-                        "movingVolume": moving_volume.GetID(),
-                        "outputVolume": self.rigidRegisteredVolumeNode.GetID(),
-                        "outputTransform": self.rigidRegisteredFieldVolumeNode.GetID(),  # 添加形变场输出参数
-                        "useRigid": True,
-                        "useAffine": False,
-                        "samplingPercentage": 0.02,
-                        "initializeTransformMode": "useGeometryAlign",
-                        "interpolationMode": interpolation_mode,
-                    }
-
-                    # 执行刚性配准 (使用BRAINSFit模块)
-                    registration = slicer.cli.runSync(
-                        slicer.modules.brainsfit,
-                        None,  # 无自定义节点
-                        parameters
-                    )
-
-                    if not registration.GetStatusString() == "Completed":
-                        raise RuntimeError(f"Error rigid register: {registration.GetStatusString()}")
-                    
-                    # 保存节点到文件
                     output_path = os.path.join(subdir_path, f"{output_name}.nii.gz")
                     output_field_path = os.path.join(subdir_path, f"{output_field_name}.h5")
+                    cli_batch.submit(subdir, self.logic.startRigidRegistration, fixed_volume, file_path,
+                                     output_path, output_field_path, interpolation_mode)
 
-                    try:
-                        slicer.util.saveNode(self.rigidRegisteredVolumeNode, output_path)
-                        slicer.util.saveNode(self.rigidRegisteredFieldVolumeNode, output_field_path)
-                        print(f"rigid registation result is saved to: {output_path}")
-                        print(f"rigid field registation result is saved to: {output_field_path}")
-                    except Exception as e:
-                        print(f"Error save: {str(e)}")
-                        slicer.util.errorDisplay(f"Error save: {str(e)}")
-                    
-
-                    # 清理临时节点
-                    slicer.mrmlScene.RemoveNode(moving_volume)
-                    slicer.mrmlScene.RemoveNode(self.rigidRegisteredVolumeNode)
-                    slicer.mrmlScene.RemoveNode(self.rigidRegisteredFieldVolumeNode)
-
-            self.updateProgress1(10 + len(subdirs)*80, "Complete registration!")  
+            self.startBatch(cli_batch, self.updateProgress1, "Complete registration!",
+                            onFinished=lambda results, errors: slicer.mrmlScene.RemoveNode(fixed_volume))
             
         except Exception as e:
             slicer.util.errorDisplay(f"Error during processing: {str(e)}")
-
-        finally:
-                if 'fixed_volume' in locals() and fixed_volume:
-                    slicer.mrmlScene.RemoveNode(fixed_volume)
+            if 'fixed_volume' in locals() and fixed_volume:
+                slicer.mrmlScene.RemoveNode(fixed_volume)
   
     def updateProgress1(self, value, message):
         """更新进度辅助函数"""
         self.ui.progressBar1.setValue(value)
         self.ui.progressBar1.setFormat(message)
-        slicer.app.processEvents()
 
 
 
@@ -1089,6 +1035,7 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def onCancel1_pet(self):
         """取消按钮点击事件"""
+        self.cancelBatch()
         self.ui.dialog1_pet.close()
 
     def onApplyClicked1_pet(self):
@@ -1112,67 +1059,37 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         if not os.path.isdir(base_dir):
             slicer.util.errorDisplay(f"Base directory does not exist: {base_dir}")
             return
-        
+
+        if self.isBatchRunning():
+            return
         
         # 开始处理        
         try:
             # 获取所有子文件夹名
-            subdirs = [d for d in os.listdir(base_dir) 
-                    if os.path.isdir(os.path.join(base_dir, d))]
-            subdirs.sort()
+            subdirs = batch_processing.list_subjects(base_dir)
             
             if not subdirs:
                 slicer.util.errorDisplay("no subdirs", windowTitle="Error dir path")
                 return
             
             # 初始化
-            self.ui.progressBar1.setValue(0)
-            self.ui.progressBar1.setFormat("Prepare register...")
+            self.ui.progressBar1_pet.setMaximum(100)
+            self.ui.progressBar1_pet.setValue(0)
+            self.ui.progressBar1_pet.setFormat("Prepare register...")
             
-            # 遍历每个子文件夹
-            for i, subdir in enumerate(subdirs):
-                self.updateProgress1(10 + i*90, f"Processing {i}/{len(subdirs)} {subdir}...")
+            # BRAINSResample 需要场景节点，在主线程启动，多个CLI进程同时运行
+            cli_batch = CliBatch(self.logic.cli_workers)
+            for subdir in subdirs:
                 subdir_path = os.path.join(base_dir, subdir)
-                print(f"Processing subdir: {subdir_path}")
                 
                 # 查找指定文件
                 file_path = os.path.join(subdir_path, filename)
                 field_path = os.path.join(subdir_path, field_name)
                 if os.path.isfile(file_path):
-                    moving_volume  = slicer.util.loadVolume(file_path)
-                    field = slicer.util.loadTransform(field_path)
-                    self.ui.progressBar1.setMaximum(10 + len(subdirs)*90)  # 分配权重
-
-                    parameters = {
-                        "inputVolume": moving_volume.GetID(),
-                        "referenceVolume": moving_volume.GetID(),  # 可以用自己，或另一张图作为参考空间
-                        "outputVolume": slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", output_name).GetID(),
-                        "warpTransform": field.GetID()
-                    }
-
-                    cliNode = slicer.cli.runSync(slicer.modules.brainsresample, None, parameters)
-                    outputNode = slicer.mrmlScene.GetNodeByID(parameters["outputVolume"])
-
-
-                    if cliNode.GetStatusString() == "Completed":
-                        print("Rigid registration applied successfully.")
-                        # 保存节点到文件
-                        output_path = os.path.join(subdir_path, f"{output_name}.nii.gz")
-                        try:
-                            slicer.util.saveNode(outputNode, output_path)
-                            print(f"rigid registation result is saved to: {output_path}")
-                        except Exception as e:
-                            print(f"Error save: {str(e)}")
-                            slicer.util.errorDisplay(f"Error save: {str(e)}")
-                    else:
-                        slicer.util.errorDisplay("Failed to apply transform. Check the log for details.")
-
-                    # 清理临时节点
-                    slicer.mrmlScene.RemoveNode(moving_volume)
-                    slicer.mrmlScene.RemoveNode(field)
-                    slicer.mrmlScene.RemoveNode(outputNode)
-
-            self.updateProgress1(10 + len(subdirs)*90, "Complete registration!")  
+                    output_path = os.path.join(subdir_path, f"{output_name}.nii.gz")
+                    cli_batch.submit(subdir, self.logic.startRigidRegistration_field, file_path, field_path, output_path)
+
+            self.startBatch(cli_batch, self.updateProgress1_pet, "Complete registration!")
             
         except Exception as e:
             slicer.util.errorDisplay(f"Error during processing: {str(e)}")
@@ -1181,7 +1098,6 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """更新进度辅助函数"""
         self.ui.progressBar1_pet.setValue(value)
         self.ui.progressBar1_pet.setFormat(message)
-        slicer.app.processEvents()
 
 
     # 批量空间配准
@@ -1217,6 +1133,7 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def onCancel2(self):
         """取消按钮点击事件"""
+        self.cancelBatch()
         self.ui.dialog2.close()
 
     def onApplyClicked2(self):
@@ -1256,87 +1173,47 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         except:
             slicer.util.errorDisplay("Please input the form of resolution or dimension, such as: 128,128,128")
             return
+
+        if self.isBatchRunning():
+            return
         
         out_dir = '.\\temp_data'
-        # Threading.
-        tf.config.threading.set_inter_op_parallelism_threads(12)
-        tf.config.threading.set_intra_op_parallelism_threads(12)
         
         # 开始处理
         try:
             # 获取所有子文件夹名
-            subdirs = [d for d in os.listdir(base_dir) 
-                    if os.path.isdir(os.path.join(base_dir, d))]
-            subdirs.sort()
+            subdirs = batch_processing.list_subjects(base_dir)
             
             if not subdirs:
                 slicer.util.errorDisplay("no subdirs", windowTitle="Error dir path")
                 return
             
             # 初始化
+            self.ui.progressBar2.setMaximum(100)
             self.ui.progressBar2.setValue(0)
             self.ui.progressBar2.setFormat("Prepare register...")
             
-            self.updateProgress(10, "Load fixed image...")
+            self.updateProgress(0, "Load fixed image...")
             fix = sf.load_volume(fixed_image_path)
+
+            # 固定图像只需变换到网络空间一次
+            os.makedirs(out_dir, exist_ok=True)
+            inp_2 = os.path.join(out_dir, 'fixed.nii')
+            space_register.resample(fix, dimensions, resolutions, interpolationComboBox_mode=interpolation_mode).save(inp_2)
             
-            # 遍历每个子文件夹
-            for i, subdir in enumerate(subdirs):
-                self.updateProgress(10 + i*80, f"Processing {i}/{len(subdirs)} {subdir}...")
+            # 每个子文件夹作为一个任务，分发到进程池
+            executor = batch_processing.BatchExecutor(self.logic.batch_workers)
+            for subdir in subdirs:
                 subdir_path = os.path.join(base_dir, subdir)
-                print(f"Processing subdir: {subdir_path}")
                 
                 # 查找指定文件
                 file_path = os.path.join(subdir_path, filename)
                 if os.path.isfile(file_path):
-                    # Input data.
-                    mov = sf.load_volume(file_path)
-                    self.ui.progressBar2.setMaximum(10 + len(subdirs)*80)  # 分配权重
-                    
-                    if not len(mov.shape) == len(fix.shape) == 3:
-                        sf.system.fatal('input images are not single-frame volumes')
-
-                    center = fix
-                    net_to_mov, mov_to_net = self.logic.network_space(im=mov, shape=dimensions, voxsize=resolutions, center=center)
-                    net_to_fix, fix_to_net = self.logic.network_space(fix, shape=dimensions, voxsize=resolutions)
-
-                    mov_to_ras = mov.geom.vox2world.matrix
-                    fix_to_ras = fix.geom.vox2world.matrix
-
-                    inputs = (
-                            self.logic.transform(mov, net_to_mov, shape=dimensions, normalize=False, batch=True, interpolationComboBox_mode=interpolation_mode),
-                            self.transform(fix, net_to_fix, shape=dimensions, normalize=False, batch=True, interpolationComboBox_mode=interpolation_mode),
-                        )
-
-                    os.makedirs(out_dir, exist_ok=True)
-
-                    inp_1 = os.path.join(out_dir, f'{output_name}.nii')
-                    inp_2 = os.path.join(out_dir, 'fixed.nii')
-                    geom_1 = sf.ImageGeometry(dimensions, vox2world=mov_to_ras @ net_to_mov)
-                    geom_2 = sf.ImageGeometry(dimensions, vox2world=fix_to_ras @ net_to_fix)
-                    sf.Volume(inputs[0][0], geom_1).save(inp_1)
-                    sf.Volume(inputs[1][0], geom_2).save(inp_2)
-
-                    # Load the saved volume into 3D Slicer
-                    loadedVolumeNode = slicer.util.loadVolume(inp_1)
-                    
-                    # Optionally set the name of the loaded volume
-                    loadedVolumeNode.SetName(output_name)
-
-                    # 保存节点到文件
                     output_path = os.path.join(subdir_path, f"{output_name}.nii.gz")
-                    try:
-                        slicer.util.saveNode(loadedVolumeNode, output_path)
-                        print(f"space registation result is saved to: {output_path}")
-                    except Exception as e:
-                        print(f"Error save: {str(e)}")
-                        slicer.util.errorDisplay(f"Error save: {str(e)}")
-                    
-
-                    # 清理临时节点
-                    slicer.mrmlScene.RemoveNode(loadedVolumeNode)
+                    executor.submit(subdir, space_register.resample_file, file_path, fixed_image_path,
+                                    dimensions, resolutions, output_path, interpolation_mode)
 
-            self.updateProgress(10 + len(subdirs)*80, "Complete registration!")  
+            self.startBatch(executor, self.updateProgress, "Complete registration!")
             
         except Exception as e:
             slicer.util.errorDisplay(f"Error during processing: {str(e)}")
@@ -1345,7 +1222,6 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """更新进度辅助函数"""
         self.ui.progressBar2.setValue(value)
         self.ui.progressBar2.setFormat(message)
-        slicer.app.processEvents()
 
 
     # 批量synthmorph配准
@@ -1381,6 +1257,7 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def onCancel3(self):
         """取消按钮点击事件"""
+        self.cancelBatch()
         self.ui.dialog3.close()
 
     def onApplyClicked3(self):
@@ -1404,57 +1281,65 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         if not os.path.isfile(fixed_image_path):
             slicer.util.errorDisplay(f"Fixed image file does not exist: {fixed_image_path}")
             return
-        
-        import subprocess
 
+        if self.isBatchRunning():
+            return
+        
         # 开始处理        
         try:
             # 获取所有子文件夹名
-            subdirs = [d for d in os.listdir(base_dir) 
-                    if os.path.isdir(os.path.join(base_dir, d))]
-            subdirs.sort()
+            subdirs = batch_processing.list_subjects(base_dir)
             
             if not subdirs:
                 slicer.util.errorDisplay("no subdirs", windowTitle="Error dir path")
                 return
             
             # 初始化
+            self.ui.progressBar3.setMaximum(100)
             self.ui.progressBar3.setValue(0)
             self.ui.progressBar3.setFormat("Prepare register...")
+
+            # 模型只加载一次
+            engine = self.logic.getRegistrationEngine()
             
-            # 遍历每个子文件夹
-            for i, subdir in enumerate(subdirs):
-                self.updateProgress3(10 + i*80, f"Processing {i}/{len(subdirs)} {subdir}...")
+            # 查找每个子文件夹的待配准图像
+            jobs = []
+            for subdir in subdirs:
                 subdir_path = os.path.join(base_dir, subdir)
-                print(f"Processing subdir: {subdir_path}")
                 
                 # 查找指定文件
                 file_path = os.path.join(subdir_path, filename)
                 if os.path.isfile(file_path):
-                    self.ui.progressBar3.setMaximum(10 + len(subdirs)*80)  # 分配权重
-
                     output_path = os.path.join(subdir_path, f"{output_name}.nii.gz")
                     output_field_path = os.path.join(subdir_path, f"{output_field_name}.nii.gz")
-
-                    cmd = [
-                        r".\bin\PythonSlicer.exe",  # 确保使用 Slicer 的 Python
-                        r".\slicer.org\Extensions-33241\PETCTREGISTER\PETCTREGISTER\mri_synthmorph\mri_synthmorph.py", 
-                        "register",
-                        file_path,
-                        fixed_image_path,
-                        "-m", "joint",
-                        "-o", output_path,
-                        "-t", output_field_path
-                    ]
-
-                    try:
-                        result = subprocess.run(cmd, check=True, capture_output=True, text=True, encoding='latin-1')
-                        print(result.stdout)
-                    except subprocess.CalledProcessError as e:
-                        print("Command failed with error:")
-                        print(e.stderr)
-
-            self.updateProgress3(10 + len(subdirs)*80, "Complete registration!")  
+                    jobs.append((subdir, (file_path, fixed_image_path, dict(out_moving=output_path, trans=output_field_path))))
+
+            # 网络只有一份，在后台线程中按批次推理，每批一个任务
+            batch_size = self.logic.registration_batch_size
+            executor = batch_processing.BatchExecutor(1, processes=False)
+            for start in range(0, len(jobs), batch_size):
+                chunk = jobs[start:start + batch_size]
+                executor.submit(
+                    tuple(subdir for subdir, _ in chunk),
+                    batch_processing.synthmorph_register,
+                    engine,
+                    [job for _, job in chunk],
+                    batch_size=batch_size,
+                    mem_limit=self.logic.registration_mem_limit,
+                )
+
+            def onFinished(results, errors):
+                for failed in results.values():
+                    for moving, e in failed.items():
+                        print(f"Registration failed for {moving}: {str(e)}")
+
+            def failures(results, errors):
+                # 每个任务是一批被试，整批出错时全部计为失败
+                failed = sum(len(subjects) for subjects in errors) + sum(len(f) for f in results.values())
+                return failed, len(jobs)
+
+            self.startBatch(executor, self.updateProgress3, "Complete registration!", onFinished=onFinished,
+                            failures=failures)
             
         except Exception as e:
             slicer.util.errorDisplay(f"Error during processing: {str(e)}")
@@ -1463,7 +1348,6 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """更新进度辅助函数"""
         self.ui.progressBar3.setValue(value)
         self.ui.progressBar3.setFormat(message)
-        slicer.app.processEvents()
 
 
 
@@ -1499,6 +1383,7 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def onCancel3_pet(self):
         """取消按钮点击事件"""
+        self.cancelBatch()
         self.ui.dialog3_pet.close()
 
     def onApplyClicked3_pet(self):
@@ -1518,57 +1403,38 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         if not os.path.isdir(base_dir):
             slicer.util.errorDisplay(f"Base directory does not exist: {base_dir}")
             return
-        
-        import subprocess
+
+        if self.isBatchRunning():
+            return
 
         # 开始处理        
         try:
             # 获取所有子文件夹名
-            subdirs = [d for d in os.listdir(base_dir) 
-                    if os.path.isdir(os.path.join(base_dir, d))]
-            subdirs.sort()
+            subdirs = batch_processing.list_subjects(base_dir)
             
             if not subdirs:
                 slicer.util.errorDisplay("no subdirs", windowTitle="Error dir path")
                 return
             
             # 初始化
+            self.ui.progressBar3_pet.setMaximum(100)
             self.ui.progressBar3_pet.setValue(0)
             self.ui.progressBar3_pet.setFormat("Prepare register...")
             
-            # 遍历每个子文件夹
-            for i, subdir in enumerate(subdirs):
-                self.updateProgress3_pet(10 + i*80, f"Processing {i}/{len(subdirs)} {subdir}...")
+            # 每个子文件夹作为一个任务，分发到进程池
+            executor = batch_processing.BatchExecutor(self.logic.batch_workers)
+            for subdir in subdirs:
                 subdir_path = os.path.join(base_dir, subdir)
-                print(f"Processing subdir: {subdir_path}")
                 
                 # 查找指定文件
                 file_path = os.path.join(subdir_path, filename)
                 if os.path.isfile(file_path):
-                    self.ui.progressBar3_pet.setMaximum(10 + len(subdirs)*80)  # 分配权重
-
                     output_path = os.path.join(subdir_path, f"{output_name}.nii.gz")
                     field_path = os.path.join(subdir_path, f"{field_name}.nii.gz")
-                    filename_path = os.path.join(subdir_path, filename)
-
-                    cmd = [
-                        r".\bin\PythonSlicer.exe",  # 确保使用 Slicer 的 Python
-                        r".\slicer.org\Extensions-33241\PETCTREGISTER\PETCTREGISTER\mri_synthmorph\mri_synthmorph.py", 
-                        "apply",
-                        field_path,
-                        filename_path,
-                        output_path,
-                        "-m", interpolation_mode
-                    ]
-
-                    try:
-                        result = subprocess.run(cmd, check=True, capture_output=True, text=True, encoding='latin-1')
-                        print(result.stdout)
-                    except subprocess.CalledProcessError as e:
-                        print("Command failed with error:")
-                        print(e.stderr)
-
-            self.updateProgress3_pet(10 + len(subdirs)*80, "Complete registration!")  
+                    executor.submit(subdir, batch_processing.synthmorph_apply, field_path, file_path, output_path,
+                                    method=interpolation_mode)
+
+            self.startBatch(executor, self.updateProgress3_pet, "Complete registration!")
             
         except Exception as e:
             slicer.util.errorDisplay(f"Error during processing: {str(e)}")
@@ -1577,7 +1443,6 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """更新进度辅助函数"""
         self.ui.progressBar3_pet.setValue(value)
         self.ui.progressBar3_pet.setFormat(message)
-        slicer.app.processEvents()
 
 
     # 批量Dice计算
@@ -1613,6 +1478,7 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def onCancel4(self):
         """取消按钮点击事件"""
+        self.cancelBatch()
         self.ui.dialog4.close()
 
     def onApplyClicked4(self):
@@ -1640,88 +1506,56 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         except:
             slicer.util.errorDisplay("Please input the form of label map, such as: 128,128,128")
             return
+
+        if self.isBatchRunning():
+            return
         
         import dice_calculate as dc
-        import pandas as pd
-        from openpyxl import Workbook
-
-        # 准备结果数据结构
-        results = {
-            'Folder': [],
-            'Label_Maps': [],
-            'Dice_Mean': [],
-            'Dice_Std': []
-        }
         
         # 开始处理        
         try:
             # 获取所有子文件夹名
-            subdirs = [d for d in os.listdir(base_dir) 
-                    if os.path.isdir(os.path.join(base_dir, d))]
-            subdirs.sort()
+            subdirs = batch_processing.list_subjects(base_dir)
             
             if not subdirs:
                 slicer.util.errorDisplay("no subdirs", windowTitle="Error dir path")
                 return
             
             # 初始化
+            self.ui.progressBar4.setMaximum(100)
             self.ui.progressBar4.setValue(0)
             self.ui.progressBar4.setFormat("Prepare register...")
             
-            # 遍历每个子文件夹
-            for i, subdir in enumerate(subdirs):
-                self.updateProgress4(10 + i*80, f"Processing {i}/{len(subdirs)} {subdir}...")
+            # 每个子文件夹作为一个任务，分发到进程池
+            executor = batch_processing.BatchExecutor(self.logic.batch_workers)
+            for subdir in subdirs:
                 subdir_path = os.path.join(base_dir, subdir)
-                print(f"Processing subdir: {subdir_path}")
                 
                 # 查找指定文件
                 label1_path = os.path.join(subdir_path, label1_name)
                 label2_path = os.path.join(subdir_path, label2_name)
                 if os.path.isfile(label1_path) and os.path.isfile(label2_path):
-                    self.ui.progressBar4.setMaximum(10 + len(subdirs)*80)  # 分配权重
-
-
-                    dice_result = dc.dice_compute(label1_path, label2_path, labels=label_maps)
-                    print('Dice: %.4f +/- %.4f' % (dice_result[0], dice_result[1]))
-
-                    results['Folder'].append(subdir)
-                    results['Label_Maps'].append(str(label_maps))
-                    results['Dice_Mean'].append(float(dice_result[0]))
-                    results['Dice_Std'].append(float(dice_result[1]))
-
-            # 保存结果到Excel文件
-            df = pd.DataFrame(results)
-
-            # 使用openpyxl引擎以支持格式设置
-            with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-                df.to_excel(writer, index=False, sheet_name='Dice_Results')
-                
-                # 获取工作簿和工作表对象进行格式设置
-                workbook = writer.book
-                worksheet = writer.sheets['Dice_Results']
-                
-                # 设置列宽
-                worksheet.column_dimensions['A'].width = 20
-                worksheet.column_dimensions['B'].width = 20
-                worksheet.column_dimensions['C'].width = 15
-                worksheet.column_dimensions['D'].width = 12
-                worksheet.column_dimensions['E'].width = 12
-                
+                    executor.submit(subdir, dc.dice_compute, label1_path, label2_path, labels=label_maps)
 
-            print(f"结果已保存到: {output_path}")
-            self.updateProgress4(100, "Dice计算完成!")
-            slicer.util.infoDisplay(f"Dice计算结果已保存到:\n{output_path}")
+            def onFinished(dice_results, errors):
+                self.saveDiceResults(subdirs, dice_results, label_maps, output_path)
 
-            self.updateProgress4(10 + len(subdirs)*80, "Complete registration!")  
+            self.startBatch(executor, self.updateProgress4, "Dice计算完成!", onFinished=onFinished)
             
         except Exception as e:
             slicer.util.errorDisplay(f"Error during processing: {str(e)}")
 
+    def saveDiceResults(self, subdirs, dice_results, label_maps, output_path):
+        """按子文件夹顺序将Dice结果保存到Excel文件"""
+        import dice_calculate as dc
+
+        dc.save_dice_results(subdirs, dice_results, label_maps, output_path)
+        slicer.util.infoDisplay(f"Dice计算结果已保存到:\n{output_path}")
+
     def updateProgress4(self, value, message):
         """更新进度辅助函数"""
         self.ui.progressBar4.setValue(value)
         self.ui.progressBar4.setFormat(message)
-        slicer.app.processEvents()
 
     # 批量SUVR mapping
     def onDialogShow10_pet(self):
@@ -1756,6 +1590,7 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def onCancel10_pet(self):
         """取消按钮点击事件"""
+        self.cancelBatch()
         self.ui.dialog10_pet.close()
 
     def onApplyClicked10_pet(self):
@@ -1774,32 +1609,32 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         if not os.path.isdir(base_dir):
             slicer.util.errorDisplay(f"Base directory does not exist: {base_dir}")
             return
+
+        if self.isBatchRunning():
+            return
         
         # 开始处理        
         try:
             # 获取所有子文件夹名
-            subdirs = [d for d in os.listdir(base_dir) 
-                    if os.path.isdir(os.path.join(base_dir, d))]
-            subdirs.sort()
+            subdirs = batch_processing.list_subjects(base_dir)
             
             if not subdirs:
                 slicer.util.errorDisplay("no subdirs", windowTitle="Error dir path")
                 return
             
             # 初始化
-            self.ui.progressBar6_pet.setValue(0)
-            self.ui.progressBar6_pet.setFormat("Prepare skull strip...")
-   
+            self.ui.progressBar10_pet.setMaximum(100)
+            self.ui.progressBar10_pet.setValue(0)
+            self.ui.progressBar10_pet.setFormat("Prepare SUVr mapping...")
             
-            # 遍历每个子文件夹
-            for i, subdir in enumerate(subdirs):
-                self.updateProgress10_pet(int((i / len(subdirs)) * 90), f"Processing {i}/{len(subdirs)} {subdir}...")
+            # 每个子文件夹作为一个任务，分发到进程池
+            executor = batch_processing.BatchExecutor(self.logic.batch_workers)
+            for subdir in subdirs:
                 subdir_path = os.path.join(base_dir, subdir)
-                print(f"Processing subdir: {subdir_path}")
                 
                 # 查找指定文件
                 file_path = os.path.join(subdir_path, filename)
-                mask_path = os.path.join(subdir_path, mask_name)
+                mask_path = os.path.join(subdir_path, mask_name)  # 0为背景，1为小脑灰质
                 output_image_path = os.path.join(subdir_path, output_image_name)
 
                 # 检查文件是否存在
@@ -1811,37 +1646,9 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                     print(f"Mask file not found: {mask_path}")
                     continue
 
-                # 初始化归一化器
-                normalizer = PETNormalizerWithRegistration()
-                
-                # 加载图像（请替换为实际路径）
-                pet_path = file_path
-                ref_mask_path = mask_path  # 0为背景，1为小脑灰质
-                
-                if not normalizer.load_images(pet_path, ref_mask_path):
-                    return
-                
-                # 检查图像兼容性
-                if not normalizer.check_image_compatibility():
-                    print("图像不兼容，进行配准...")
-                    # 进行配准（使用您提供的MATLAB代码方法）
-                    if not normalizer.register_mask_to_pet():
-                        print("配准失败，使用原始mask")
-                else:
-                    print("图像兼容，跳过配准步骤")
-                
-                # 计算SUVR
-                try:
-                    suvr_img, suvr_data = normalizer.calculate_suvr(use_registered_mask=True)
-                    
-                    # 保存结果
-                    normalizer.save_suvr_image(suvr_img, output_image_path)
-                    
-                except Exception as e:
-                    print(f"SUVR计算错误: {e}")
-                
+                executor.submit(subdir, suvr_mapping, file_path, mask_path, output_image_path)
 
-            self.updateProgress10_pet(100, "Complete skull strip!")  
+            self.startBatch(executor, self.updateProgress10_pet, "Complete SUVr mapping!")
             
         except Exception as e:
             slicer.util.errorDisplay(f"Error during processing: {str(e)}")
@@ -1850,7 +1657,6 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """更新进度辅助函数"""
         self.ui.progressBar10_pet.setValue(value)
         self.ui.progressBar10_pet.setFormat(message)
-        slicer.app.processEvents()
 
 
     # 批量Suvr计算
@@ -1886,6 +1692,7 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def onCancel5(self):
         """取消按钮点击事件"""
+        self.cancelBatch()
         self.ui.dialog5.close()
 
     def onApplyClicked5(self):
@@ -1912,40 +1719,31 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         except:
             slicer.util.errorDisplay("Please input the form of label map, such as: 128,128,128")
             return
-        
-        import pandas as pd
 
-        # 准备结果数据结构
-        results = {
-            'Folder': [],
-        }
+        if not os.path.isfile(label_path):
+            slicer.util.errorDisplay(f"Label file not found: {label_path}")
+            return
 
-        # 为每个标签添加列
-        for label in label_maps:
-            results[f'Label_{label}'] = []
+        if self.isBatchRunning():
+            return
         
         # 开始处理        
         try:
             # 获取所有子文件夹名
-            subdirs = [d for d in os.listdir(base_dir) 
-                    if os.path.isdir(os.path.join(base_dir, d))]
-            subdirs.sort()
+            subdirs = batch_processing.list_subjects(base_dir)
             
             if not subdirs:
                 slicer.util.errorDisplay("no subdirs", windowTitle="Error dir path")
                 return
             
             # 初始化进度条
-            total_steps = len(subdirs)
-            self.ui.progressBar5.setValue(0)
             self.ui.progressBar5.setMaximum(100)
+            self.ui.progressBar5.setValue(0)
+            self.ui.progressBar5.setFormat("Prepare SUVr computation...")
             
-            # 遍历每个子文件夹
-            for i, subdir in enumerate(subdirs):
-                # 计算进度百分比
-                progress_value = int((i + 1) / total_steps * 100)
-                self.updateProgress5(progress_value, f"Processing {i+1}/{total_steps}: {subdir}")
-                
+            # 每个子文件夹作为一个任务，分发到进程池
+            executor = batch_processing.BatchExecutor(self.logic.batch_workers)
+            for subdir in subdirs:
                 subdir_path = os.path.join(base_dir, subdir)
                 
                 # 查找指定文件
@@ -1954,88 +1752,28 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                 if not os.path.isfile(pet_path):
                     print(f"PET file not found: {pet_path}")
                     continue
-                if not os.path.isfile(label_path):
-                    print(f"Label file not found: {label_path}")
-                    continue
 
-                # 创建临时文件保存配准结果
-                with tempfile.NamedTemporaryFile(suffix='.nii', delete=False) as temp_file:
-                    temp_path = temp_file.name
-                
-                try:
-                    # 配准标签图像到PET图像空间
-                    registered_data, affine = register_and_save(
-                        original_img_path=label_path,
-                        refer_img_path=pet_path,
-                        output_path=temp_path,
-                        method='vectorized',
-                        interpolation_order=0,
-                        dtype=np.float32
-                    )
-                    
-                    # 计算SUVR
-                    suvr_result = suvr_compute(temp_path, pet_path, label_maps)
-                    
-                    # 添加结果
-                    results['Folder'].append(subdir)
-                    
-                    # 添加每个标签的值
-                    for label in label_maps:
-                        # 使用正确的键名，与suvr_compute返回的键一致
-                        label_key = f'Label{label}'
-                        if label_key in suvr_result:
-                            results[f'Label_{label}'].append(suvr_result[label_key])
-                        else:
-                            results[f'Label_{label}'].append(None)  # 或者0，根据需求
-                    
-                except Exception as e:
-                    print(f"Error processing {subdir}: {e}")
-                    # 添加空值以保持数据对齐
-                    results['Folder'].append(subdir)
-                    for label in label_maps:
-                        results[f'Label_{label}'].append(None)
-                finally:
-                    # 清理临时文件
-                    if os.path.exists(temp_path):
-                        os.remove(temp_path)
-
-            # 保存结果到Excel文件
-            df = pd.DataFrame(results)
-            
-            # 确保输出目录存在
-            output_dir = os.path.dirname(output_path)
-            if output_dir and not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-
-            # 使用openpyxl引擎以支持格式设置
-            with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-                df.to_excel(writer, index=False, sheet_name='SUVr_Results')
-                
-                # 获取工作簿和工作表对象进行格式设置
-                workbook = writer.book
-                worksheet = writer.sheets['SUVr_Results']
-                
-                # 设置列宽
-                worksheet.column_dimensions['A'].width = 20  # Folder列
-                
-                # 设置标签列的宽度
-                for col_idx, col_name in enumerate(df.columns[1:], 2):  # 从第2列开始
-                    col_letter = chr(64 + col_idx)  # A=65, B=66, etc.
-                    worksheet.column_dimensions[col_letter].width = 12
+                executor.submit(subdir, compute_subject_suvr, pet_path, label_path, label_maps)
 
-            self.updateProgress5(100, "SUVr computation complete!")
-            slicer.util.infoDisplay(f"SUVr calculation result is saved to:\n{output_path}")
+            def onFinished(suvr_results, errors):
+                self.saveSuvrResults(subdirs, suvr_results, errors, label_maps, output_path)
+
+            self.startBatch(executor, self.updateProgress5, "SUVr computation complete!", onFinished=onFinished)
             
         except Exception as e:
             slicer.util.errorDisplay(f"Error during processing: {str(e)}")
             import traceback
             traceback.print_exc()
 
+    def saveSuvrResults(self, subdirs, suvr_results, errors, label_maps, output_path):
+        """按子文件夹顺序将SUVr结果保存到Excel文件，失败的被试保留空值"""
+        save_suvr_results(subdirs, suvr_results, errors, label_maps, output_path)
+        slicer.util.infoDisplay(f"SUVr calculation result is saved to:\n{output_path}")
+
     def updateProgress5(self, value, message):
         """更新进度辅助函数"""
         self.ui.progressBar5.setValue(value)
         self.ui.progressBar5.setFormat(message)
-        slicer.app.processEvents()
 
 
 
@@ -2108,8 +1846,10 @@ class SynCTWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             slicer.util.errorDisplay("Please provide a name for the output volume.")
             return
 
+        backend = self.ui.skullStripBackendComboBox.currentText
+
         with slicer.util.tryWithErrorDisplay("RigidRegistration failed.", waitCursor=True):
-            self.logic.runSkullStrip(output_name, output_label_name)
+            self.logic.runSkullStrip(output_name, output_label_name, backend)
 
     def onSkullStrip_mask(self):
         if not self.logic.image_skull_pet and not self.logic.image_skull_mask:
@@ -2340,6 +2080,37 @@ class SynCTLogic(ScriptedLoadableModuleLogic):
         self.filepath5_2_mapping = None
         self.filepath_skull = None
 
+        # 批量处理的进程数；CLI模块本身是多线程的，同时运行的数量更少
+        self.batch_workers = batch_processing.default_workers()
+        self.cli_workers = max(1, self.batch_workers // 4)
+
+        # DICOM头信息索引，None为默认位置
+        self.dicom_index_path = None
+        # PET的SUV系数写入scl_slope（'slope'），或写出float32数据（'float32'）
+        self.suv_mode = 'slope'
+        # CT加窗输出类型：float32，或量化的uint8、uint16
+        self.ct_clip_dtype = 'float32'
+
+        self.registration_engine = None
+        self.strip_engine = None
+        # Subjects per SynthMorph forward pass, bounded by the memory budget in bytes
+        self.registration_batch_size = 4
+        self.registration_mem_limit = 16 * 1024 ** 3
+        # Compile SynthMorph inference with XLA, once per image shape
+        self.registration_xla = False
+        # SynthMorph inference precision: float32, bfloat16, or int8
+        self.registration_precision = 'float32'
+
+    def getRegistrationEngine(self):
+        """Return the SynthMorph deformable registration engine, building it on first use."""
+        if self.registration_engine is None:
+            from synthmorph.engine import RegistrationEngine
+            # 扩展只附带形变权重，joint 配准还需要 FreeSurfer 的仿射权重
+            cache_dir = os.path.join(os.path.dirname(__file__), "tmp_data", "synthmorph_cache")
+            self.registration_engine = RegistrationEngine(model="deform", cache_dir=cache_dir, xla=self.registration_xla,
+                                                          precision=self.registration_precision)
+        return self.registration_engine
+
     def loadImage(self, filepath_skull: str) -> None:
         """Load the image from the specified file path."""
         self.filepath_skull = filepath_skull
@@ -2545,10 +2316,21 @@ class SynCTLogic(ScriptedLoadableModuleLogic):
         node.SetName(new_name)
         return True
 
-    def runSkullStrip(self, output_name: str, output_label_name) -> None:
+    def getStripEngine(self):
+        """Return the SynthStrip engine, loading the model on first use."""
+        if self.strip_engine is None:
+            from synthstrip_engine import StripEngine
+            self.strip_engine = StripEngine()
+        return self.strip_engine
+
+    def runSkullStrip(self, output_name: str, output_label_name, backend: str = "SwissSkullStripper") -> None:
         if not self.image_skull:
             raise ValueError("Image is not loaded.")
 
+        if backend == "SynthStrip":
+            self.runSynthStrip(output_name, output_label_name)
+            return
+
         # Create output volume node
         self.rigidRegisteredVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", output_name)
         self.labelVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", output_label_name)
@@ -2564,8 +2346,29 @@ class SynCTLogic(ScriptedLoadableModuleLogic):
         # 查看结果
         slicer.util.setSliceViewerLayers(background=self.rigidRegisteredVolumeNode)
 
+    def runSynthStrip(self, output_name: str, output_label_name: str) -> None:
+        """使用进程内的SynthStrip模型进行颅骨剥离，模型只加载一次"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_path = os.path.join(temp_dir, "output.nii.gz")
+            mask_path = os.path.join(temp_dir, "mask.nii.gz")
+
+            # 优先使用原始文件，否则保存当前节点
+            input_path = self.filepath_skull
+            if not input_path or not os.path.isfile(input_path):
+                input_path = os.path.join(temp_dir, "input.nii.gz")
+                slicer.util.saveNode(self.image_skull, input_path)
+
+            self.getStripEngine().run(input_path, out=output_path, mask=mask_path)
+
+            # 加载结果
+            self.rigidRegisteredVolumeNode = slicer.util.loadVolume(output_path, properties={'name': output_name})
+            self.labelVolumeNode = slicer.util.loadVolume(mask_path, properties={'name': output_label_name, 'labelmap': True})
+
+        # 查看结果
+        slicer.util.setSliceViewerLayers(background=self.rigidRegisteredVolumeNode)
+
 
-    def runDicom2Nifit_CT(self, ct_dicom_dir: str, output_path: str, output_name: str) -> None:
+    def runDicom2Nifit_CT(self, ct_dicom_dir: str, output_path: str, output_name: str, **criteria) -> None:
         """
         将CT的DICOM文件转换为NIfTI格式
         
@@ -2573,51 +2376,21 @@ class SynCTLogic(ScriptedLoadableModuleLogic):
             ct_dicom_dir: 输入DICOM文件目录路径
             output_path: 输出目录路径
             output_name: 输出NIfTI文件名（不包含扩展名）
+            criteria: 序列筛选条件，见dicom_index.matches；只转换选中的序列
         """
         try:
-            # 将字符串路径转换为Path对象
-            nii_out_path = plb.Path(output_path)
-            
             print(f'ct_dicom_dir: {ct_dicom_dir}')
             print(f'output_path: {output_path}')
             
-            # 确保输出目录存在
-            nii_out_path.mkdir(parents=True, exist_ok=True)
-            
-            # 使用临时目录进行转换
-            with tempfile.TemporaryDirectory() as tmp_dir:
-                tmp_path = plb.Path(tmp_dir)
-                
-                print("开始DICOM到NIfTI转换...")
-                
-                # 将DICOM目录转换为NIfTI
-                dicom2nifti.convert_directory(ct_dicom_dir, str(tmp_path), compression=False, reorient=True)
-                
-                # 查找生成的NIfTI文件
-                nii_files = list(tmp_path.glob('*.nii'))
-                if not nii_files:
-                    # 也检查.nii.gz文件
-                    nii_files = list(tmp_path.glob('*.nii.gz'))
-                
-                if not nii_files:
-                    # 列出临时目录中的所有文件用于调试
-                    all_files = list(tmp_path.glob('*'))
-                    print(f"临时目录中的文件: {[f.name for f in all_files]}")
-                    raise FileNotFoundError("未找到转换后的NIfTI文件")
-                
-                # 获取第一个NIfTI文件
-                nii_file = nii_files[0]
-                # print(f"找到转换文件: {nii_file.name}")
-                
-                # 构建输出文件路径
-                output_file = nii_out_path / f'{output_name}.nii'
-                
-                # 复制文件到目标位置
-                shutil.copy(nii_file, output_file)
+            print("开始DICOM到NIfTI转换...")
 
-                self.displayVolumeInSlicer(str(output_file), output_name)
-                
-                print(f"转换成功: {output_file}")
+            # 只转换选中的序列，直接写入输出文件
+            output_file = os.path.join(output_path, f'{output_name}.nii')
+            preprocess.dicom_to_nifti_ct(ct_dicom_dir, output_file, self.dicom_index_path, **criteria)
+
+            self.displayVolumeInSlicer(output_file, output_name)
+            
+            print(f"转换成功: {output_file}")
                 
         except Exception as e:
             print(f"转换失败: {str(e)}")
@@ -2661,59 +2434,29 @@ class SynCTLogic(ScriptedLoadableModuleLogic):
             print(error_msg)
 
     def conv_time(self, time_str):
-        return (float(time_str[:2]) * 3600 + float(time_str[2:4]) * 60 + float(time_str[4:13]))
+        return preprocess.conv_time(time_str)
 
     def calculate_suv_factor(self, dcm_path):
-        ds = pydicom.read_file(str(dcm_path))
-        total_dose = ds.RadiopharmaceuticalInformationSequence[0].RadionuclideTotalDose
-        start_time = ds.RadiopharmaceuticalInformationSequence[0].RadiopharmaceuticalStartTime
-        half_life = ds.RadiopharmaceuticalInformationSequence[0].RadionuclideHalfLife
-        acq_time = ds.AcquisitionTime
-        weight = ds.PatientWeight
-        time_diff = self.conv_time(acq_time) - self.conv_time(start_time)
-        act_dose = total_dose * 0.5 ** (time_diff / half_life)
-        suv_factor = 1000 * (weight) / act_dose
-        return suv_factor
+        return preprocess.calculate_suv_factor(dcm_path)
     
-    def convert_pet(self, pet, suv_factor):
-        affine = pet.affine
-        pet_data = pet.get_fdata()
-        pet_suv_data = (pet_data * suv_factor).astype(np.float32)
-        pet_suv = nib.Nifti1Image(pet_suv_data, affine)
-        return pet_suv
+    def convert_pet(self, pet, suv_factor, mode='float32'):
+        return preprocess.convert_pet(pet, suv_factor, mode)
     
-    def runDicom2Nifit_PET(self, pet_dicom_dir: str, output_path: str, output_name: str) -> None:
+    def runDicom2Nifit_PET(self, pet_dicom_dir: str, output_path: str, output_name: str, **criteria) -> None:
         try:
-            # 将字符串路径转换为Path对象
-            pet_dicom_dir = plb.Path(pet_dicom_dir)
-            nii_out_path = plb.Path(output_path)
-            
-            print(f'ct_dicom_dir: {pet_dicom_dir}')
+            print(f'pet_dicom_dir: {pet_dicom_dir}')
             print(f'output_path: {output_path}')
             
-            # 确保输出目录存在
-            nii_out_path.mkdir(parents=True, exist_ok=True)
+            print("开始DICOM到NIfTI转换...")
 
-            first_pt_dcm = next(pet_dicom_dir.glob('*'))
-            suv_corr_factor = self.calculate_suv_factor(first_pt_dcm)
-            
-            # 使用临时目录进行转换
-            with tempfile.TemporaryDirectory() as tmp_dir:
-                tmp_path = plb.Path(tmp_dir)
-                
-                print("开始DICOM到NIfTI转换...")
-                
-                # 将DICOM目录转换为NIfTI
-                dicom2nifti.convert_directory(pet_dicom_dir, str(tmp_path), compression=False, reorient=True)
-                
-                nii = next(tmp_path.glob('*nii'))
-                suv_pet_nii = self.convert_pet(nib.load(nii), suv_factor=suv_corr_factor)
-                nib.save(suv_pet_nii, nii_out_path / f'{output_name}.nii')
-                pet_path = nii_out_path / f'{output_name}.nii'
+            # 只转换选中的PET序列，SUV系数来自索引中的序列头信息
+            pet_path = os.path.join(output_path, f'{output_name}.nii')
+            preprocess.dicom_to_nifti_pet(pet_dicom_dir, pet_path, self.dicom_index_path, suv_mode=self.suv_mode,
+                                          **criteria)
                 
-                print(f"转换成功: {pet_path}")
+            print(f"转换成功: {pet_path}")
 
-                self.displayVolumeInSlicer(pet_path, output_name)
+            self.displayVolumeInSlicer(pet_path, output_name)
                 
         except Exception as e:
             print(f"转换失败: {str(e)}")
@@ -2787,8 +2530,7 @@ class SynCTLogic(ScriptedLoadableModuleLogic):
     #         raise
     #     finally:
     #         # 清理临时文件
-    #         import shutil
-    #         try:
+    #             #         try:
     #             shutil.rmtree(temp_dir)
     #         except:
     #             pass
@@ -2834,41 +2576,20 @@ class SynCTLogic(ScriptedLoadableModuleLogic):
 
     # 加载NIfTI文件
     def load_nifti(self, file_path):
-        nifti_img = nib.load(file_path)
-        data = nifti_img.get_fdata()
-        affine = nifti_img.affine
-        header = nifti_img.header
-        return data, affine, header
-
+        return preprocess.load_nifti(file_path)
 
     # 设置阈值并进行Min-Max归一化
     def threshold_and_normalize(self, data, min_val: float, max_val: float, normalize: str):
-        # 设置阈值
-        data = np.clip(data, min_val, max_val)
-
-        if normalize == 'True':
-            # Min-Max归一化
-            data_min = np.min(data)
-            data_max = np.max(data)
-            if data_max - data_min == 0:
-                raise ValueError("The data has no variation; min and max values are equal.")
-            normalized_data = (data - data_min) / (data_max - data_min)
-        else:
-            normalized_data = data
-        return normalized_data
+        return preprocess.threshold_and_normalize(data, min_val, max_val, normalize)
     
     # 保存NIfTI文件
     def save_nifti(self, data, affine, header, output_file):
-        nifti_img = nib.Nifti1Image(data, affine, header=header)
-        nib.save(nifti_img, output_file)
+        preprocess.save_nifti(data, affine, header, output_file)
 
     def runCTclip(self, minimum: float, maximum: float, output_name: str, normalize: str) -> None:
         # Create output volume node
         # print(f'filepath_ct: {self.filepath_ct}, minimum: {minimum}, maximum: {maximum}, output_name: {output_name}')
 
-        data, affine, header = self.load_nifti(self.filepath_ct)
-        normalized_data = self.threshold_and_normalize(data, minimum, maximum, normalize)
-
         output_dir = os.path.join(
             os.path.dirname(__file__),  # 当前脚本目录
             "tmp_data"
@@ -2876,7 +2597,8 @@ class SynCTLogic(ScriptedLoadableModuleLogic):
         os.makedirs(output_dir, exist_ok=True)  # 确保目录存在
         output_file_path = os.path.join(output_dir, "{output_filename}.nii.gz".format(output_filename=output_name))
 
-        self.save_nifti(normalized_data, affine, header, output_file_path)
+        # 整数CT查表加窗，不转换为float64
+        preprocess.ct_clip(self.filepath_ct, output_file_path, minimum, maximum, normalize, self.ct_clip_dtype)
         print(f"CTClip image saved to: {output_file_path}")
 
         self.ctclipVolumeNode = slicer.util.loadVolume(output_file_path, properties={'name': output_name})
@@ -2936,6 +2658,119 @@ class SynCTLogic(ScriptedLoadableModuleLogic):
         else:
             slicer.util.errorDisplay("Failed to apply transform. Check the log for details.")
 
+    # 批量处理：在场景中启动一个被试的CLI模块，不等待完成。
+    # 返回CLI节点和完成后调用的函数，该函数保存结果并清理节点。
+    def startSkullStrip(self, file_path, output_file_path, output_mask_file_path):
+        image = slicer.util.loadVolume(file_path)
+
+        # 创建临时节点用于处理
+        temp_stripped_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", "temp_stripped")
+        temp_mask_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", "temp_mask")
+        nodes = [image, temp_stripped_node, temp_mask_node]
+
+        parameters = {
+            "patientVolume": image.GetID(),
+            "patientOutputVolume": temp_stripped_node.GetID(),
+            "patientMaskLabel": temp_mask_node.GetID(),
+        }
+        cli_node = self.startCli(slicer.modules.swissskullstripper, parameters, nodes)
+
+        def finish():
+            try:
+                # 检查是否成功完成
+                if cli_node.GetStatusString() != "Completed":
+                    raise RuntimeError(f"头骨剥离失败，状态: {cli_node.GetStatusString()}")
+
+                slicer.util.saveNode(temp_stripped_node, output_file_path)
+                slicer.util.saveNode(temp_mask_node, output_mask_file_path)
+                print(f"保存头骨剥离结果到: {output_file_path}")
+                return output_file_path
+            finally:
+                self.removeNodes(nodes + [cli_node])
+
+        return cli_node, finish
+
+    def startRigidRegistration(self, fixed_volume, file_path, output_path, output_field_path, interpolation_mode):
+        moving_volume = slicer.util.loadVolume(file_path)
+        output_name = os.path.basename(output_path).split('.')[0]
+        output_field_name = os.path.basename(output_field_path).split('.')[0]
+
+        # Create output volume node
+        output_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", output_name)
+        output_field_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTransformNode", output_field_name)
+        nodes = [moving_volume, output_node, output_field_node]
+
+        # 创建配准参数
+        parameters = {
+            "fixedVolume": fixed_volume.GetID(),
+            "movingVolume": moving_volume.GetID(),
+            "outputVolume": output_node.GetID(),
+            "outputTransform": output_field_node.GetID(),  # 添加形变场输出参数
+            "useRigid": True,
+            "useAffine": False,
+            "samplingPercentage": 0.02,
+            "initializeTransformMode": "useGeometryAlign",
+            "interpolationMode": interpolation_mode,
+        }
+        cli_node = self.startCli(slicer.modules.brainsfit, parameters, nodes)
+
+        def finish():
+            try:
+                if cli_node.GetStatusString() != "Completed":
+                    raise RuntimeError(f"Error rigid register: {cli_node.GetStatusString()}")
+
+                slicer.util.saveNode(output_node, output_path)
+                slicer.util.saveNode(output_field_node, output_field_path)
+                print(f"rigid registation result is saved to: {output_path}")
+                print(f"rigid field registation result is saved to: {output_field_path}")
+                return output_path
+            finally:
+                self.removeNodes(nodes + [cli_node])
+
+        return cli_node, finish
+
+    def startRigidRegistration_field(self, file_path, field_path, output_path):
+        moving_volume = slicer.util.loadVolume(file_path)
+        field = slicer.util.loadTransform(field_path)
+        output_name = os.path.basename(output_path).split('.')[0]
+        output_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", output_name)
+        nodes = [moving_volume, field, output_node]
+
+        parameters = {
+            "inputVolume": moving_volume.GetID(),
+            "referenceVolume": moving_volume.GetID(),  # 可以用自己，或另一张图作为参考空间
+            "outputVolume": output_node.GetID(),
+            "warpTransform": field.GetID()
+        }
+        cli_node = self.startCli(slicer.modules.brainsresample, parameters, nodes)
+
+        def finish():
+            try:
+                if cli_node.GetStatusString() != "Completed":
+                    raise RuntimeError(f"Failed to apply transform: {cli_node.GetStatusString()}")
+
+                slicer.util.saveNode(output_node, output_path)
+                print(f"rigid registation result is saved to: {output_path}")
+                return output_path
+            finally:
+                self.removeNodes(nodes + [cli_node])
+
+        return cli_node, finish
+
+    def startCli(self, module, parameters, nodes):
+        """异步启动CLI模块，启动失败时清理已创建的节点"""
+        try:
+            return slicer.cli.run(module, None, parameters, wait_for_completion=False)
+        except Exception:
+            self.removeNodes(nodes)
+            raise
+
+    @staticmethod
+    def removeNodes(nodes):
+        for node in nodes:
+            if node is not None:
+                slicer.mrmlScene.RemoveNode(node)
+
     def runSpaceRegistration(self, in_shape, resolution, output_name, interpolationComboBox_mode) -> None:
         if not self.image2_1 or not self.image2_2:
             raise ValueError("Fixed or moving image is not loaded.")
@@ -2997,8 +2832,6 @@ class SynCTLogic(ScriptedLoadableModuleLogic):
     def runSynRegistration(self, output_filename: str, output_field_name: str) -> None:
         if not self.image3_1 or not self.image3_2:
             raise ValueError("Fixed or moving image is not loaded.")
-        
-        import subprocess
 
         output_dir = os.path.join(
             os.path.dirname(__file__),  # 当前脚本目录
@@ -3008,25 +2841,10 @@ class SynCTLogic(ScriptedLoadableModuleLogic):
         output_path = os.path.join(output_dir, "{output_filename}.nii.gz".format(output_filename=output_filename))
         output_field_path = os.path.join(output_dir, "{output_field_name}.nii.gz".format(output_field_name=output_field_name))
 
-        cmd = [
-            r".\bin\PythonSlicer.exe",  # 确保使用 Slicer 的 Python
-            r".\slicer.org\Extensions-33241\PETCTREGISTER\PETCTREGISTER\mri_synthmorph\mri_synthmorph.py", 
-            "register",
-            self.filepath3_1,
-            self.filepath3_2,
-            "-m", "joint",
-            "-o", output_path,
-            "-t", output_field_path
-        ]
-
-        try:
-            result = subprocess.run(cmd, check=True, capture_output=True, text=True, encoding='latin-1')
-            print(result.stdout)
-            print(f'output_image_path: {output_path}')
-            print(f'output_field_path: {output_field_path}')
-        except subprocess.CalledProcessError as e:
-            print("Command failed with error:")
-            print(e.stderr)
+        engine = self.getRegistrationEngine()
+        engine.register(self.filepath3_1, self.filepath3_2, out_moving=output_path, trans=output_field_path)
+        print(f'output_image_path: {output_path}')
+        print(f'output_field_path: {output_field_path}')
 
 
     def runSynRegistration_field(self, yield_path: str, output_filename: str, interpolation_mode: str) -> None:
@@ -3097,699 +2915,92 @@ class SynCTLogic(ScriptedLoadableModuleLogic):
         if not self.image5_1 or not self.image5_2:
             raise ValueError("pet or label image is not loaded.")
 
-        # 创建临时文件保存配准结果
-        with tempfile.NamedTemporaryFile(suffix='.nii', delete=False) as temp_file:
-            temp_path = temp_file.name
-        
-        try:
-            # 配准标签图像到PET图像空间
-            registered_data, affine = register_and_save(
-                original_img_path=self.filepath5_2,
-                refer_img_path=self.filepath5_1,
-                output_path=temp_path,
-                method='vectorized',
-                interpolation_order=0,
-                dtype=np.float32
-            )
-            
-            # 计算SUVR
-            suvr_result = suvr_compute(temp_path, self.filepath5_1, labels)
-            print("计算的SUVR结果为：", suvr_result)
-        finally:
-            # 清理临时文件
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+        suvr_result = compute_subject_suvr(self.filepath5_1, self.filepath5_2, labels)
+        print("计算的SUVR结果为：", suvr_result)
 
     def runSuvrMapping(self, output_path):
         if not self.image5_1_mapping or not self.image5_2_mapping:
             raise ValueError("pet or label image is not loaded.")
 
-        # 初始化归一化器
-        normalizer = PETNormalizerWithRegistration()
-        
-        # 加载图像（请替换为实际路径）
-        pet_path = self.filepath5_1_mapping
-        ref_mask_path = self.filepath5_2_mapping  # 0为背景，1为小脑灰质
-        
-        if not normalizer.load_images(pet_path, ref_mask_path):
-            return
-        
-        # 检查图像兼容性
-        if not normalizer.check_image_compatibility():
-            print("图像不兼容，进行配准...")
-            # 进行配准（使用您提供的MATLAB代码方法）
-            if not normalizer.register_mask_to_pet():
-                print("配准失败，使用原始mask")
-        else:
-            print("图像兼容，跳过配准步骤")
-        
-        # 计算SUVR
+        # 参考脑区mask：0为背景，1为小脑灰质
         try:
-            suvr_img, suvr_data = normalizer.calculate_suvr(use_registered_mask=True)
-            
-            # 保存结果
-            normalizer.save_suvr_image(suvr_img, output_path)
-            
+            suvr_mapping(self.filepath5_1_mapping, self.filepath5_2_mapping, output_path)
         except Exception as e:
             print(f"SUVR计算错误: {e}")
 
     # space_register
     def network_space(self, im, shape, voxsize, center=None):
-        """Construct transform from network space to the voxel space of an image.
-
-        Constructs a coordinate transform from the space the network will operate
-        in to the zero-based image index space. The network space has isotropic
-        1-mm voxels, left-inferior-anterior (LIA) orientation, and no shear. It is
-        centered on the field of view, or that of a reference image. This space is
-        an indexed voxel space, not world space.
-
-        Parameters
-        ----------
-        im : surfa.Volume
-            Input image to construct the transform for.
-        shape : (3,) array-like
-            Spatial shape of the network space.
-        center : surfa.Volume, optional
-            Center the network space on the center of a reference image.
-
-        Returns
-        -------
-        out : tuple of (3, 4) NumPy arrays
-            Transform from network to input-image space and its inverse, thinking
-            coordinates.
-
-        """
-        old = im.geom
-        new = sf.ImageGeometry(
-            shape=shape,
-            voxsize=voxsize,
-            rotation='LIA',
-            center=old.center if center is None else center.geom.center,
-            shear=None,
-        )
-
-        net_to_vox = old.world2vox @ new.vox2world
-        vox_to_net = new.world2vox @ old.vox2world
-        return net_to_vox.matrix, vox_to_net.matrix
-
-    def is_affine_shape(self, shape):
-        """
-        Determine whether the given shape (single-batch) represents an N-dimensional affine matrix of
-        shape (M, N + 1), with `N in (2, 3)` and `M in (N, N + 1)`.
-
-        Parameters:
-            shape: Tuple or list of integers excluding the batch dimension.
-        """
-        if len(shape) == 2 and shape[-1] != 1:
-            self.validate_affine_shape(shape)
-            return True
-        return False
-
-
-    def validate_affine_shape(self, shape):
-        """
-        Validate whether the input shape represents a valid affine matrix of shape (..., M, N + 1),
-        where N is the number of dimensions, and M is N or N + 1. Throws an error if the shape is
-        invalid.
-
-        Parameters:
-            shape: Tuple or list of integers.
-        """
-        ndim = shape[-1] - 1
-        rows = shape[-2]
-        if ndim not in (2, 3):
-            raise ValueError(f'Affine matrix must be 2D or 3D, got {ndim}D')
-        if rows not in (ndim, ndim + 1):
-            raise ValueError(f'{ndim}D affine matrix must have {ndim} or {ndim + 1} rows, got {rows}.')
-
-    def affine_to_dense_shift(self, matrix, shape, shift_center=True, warp_right=None):
-        """
-        Convert N-dimensional (ND) matrix transforms to dense displacement fields.
-
-        Algorithm:
-            1. Build and (optionally) shift grid to center of image.
-            2. Apply matrices to each index coordinate.
-            3. Subtract grid.
-
-        Parameters:
-            matrix: Affine matrix of shape (..., M, N + 1), where M is N or N + 1. Can have any batch
-                dimensions.
-            shape: ND shape of the output space.
-            shift_center: Shift grid to image center.
-            warp_right: Right-compose the matrix transform with a displacement field of shape
-                (..., *shape, N), with batch dimensions broadcastable to those of `matrix`.
-
-        Returns:
-            Dense shift (warp) of shape (..., *shape, N).
-
-        Notes:
-            There used to be an argument for choosing between matrix ('ij') and Cartesian ('xy')
-            indexing. Due to inconsistencies in how some functions and layers handled xy-indexing, we
-            removed it in favor of default ij-indexing to minimize the potential for confusion.
-
-        """
-        if isinstance(shape, (tf.compat.v1.Dimension, tf.TensorShape)):
-            shape = shape.as_list()
-
-        if not tf.is_tensor(matrix) or not matrix.dtype.is_floating:
-            matrix = tf.cast(matrix, tf.float32)
-
-        # check input shapes
-        ndims = len(shape)
-        if matrix.shape[-1] != (ndims + 1):
-            matdim = matrix.shape[-1] - 1
-            raise ValueError(f'Affine ({matdim}D) does not match target shape ({ndims}D).')
-        self.validate_affine_shape(matrix.shape)
-
-        # coordinate grid
-        mesh = (tf.range(s, dtype=matrix.dtype) for s in shape)
-        if shift_center:
-            mesh = (m - 0.5 * (s - 1) for m, s in zip(mesh, shape))
-        mesh = [tf.reshape(m, shape=(-1,)) for m in tf.meshgrid(*mesh, indexing='ij')]
-        mesh = tf.stack(mesh)  # N x nb_voxels
-        out = mesh
-
-        # optionally right-compose with warp field
-        if warp_right is not None:
-            if not tf.is_tensor(warp_right) or warp_right.dtype != matrix.dtype:
-                warp_right = tf.cast(warp_right, matrix.dtype)
-            flat_shape = tf.concat((tf.shape(warp_right)[:-1 - ndims], (-1, ndims)), axis=0)
-            warp_right = tf.reshape(warp_right, flat_shape)  # ... x nb_voxels x N
-            out += tf.linalg.matrix_transpose(warp_right)  # ... x N x nb_voxels
-
-        # compute locations, subtract grid to obtain shift
-        out = matrix[..., :ndims, :-1] @ out + matrix[..., :ndims, -1:]  # ... x N x nb_voxels
-        out = tf.linalg.matrix_transpose(out - mesh)  # ... x nb_voxels x N
-
-        # restore shape
-        shape = tf.concat((tf.shape(matrix)[:-2], (*shape, ndims)), axis=0)
-        return tf.reshape(out, shape)  # ... x in_shape x N
-
-
-    def transformS(self, vol, loc_shift, interp_method='nearest', fill_value=None,
-                shift_center=True, shape=None):
-        """Apply affine or dense transforms to images in N dimensions.
-
-        Essentially interpolates the input ND tensor at locations determined by
-        loc_shift. The latter can be an affine transform or dense field of location
-        shifts in the sense that at location x we now have the data from x + dx, so
-        we moved the data.
-
-        Parameters:
-            vol: tensor or array-like structure  of size vol_shape or
-                (*vol_shape, C), where C is the number of channels.
-            loc_shift: Affine transformation matrix of shape (N, N+1) or a shift
-                volume of shape (*new_vol_shape, D) or (*new_vol_shape, C, D),
-                where C is the number of channels, and D is the dimensionality
-                D = len(vol_shape). If the shape is (*new_vol_shape, D), the same
-                transform applies to all channels of the input tensor.
-            interp_method: 'linear' or 'nearest'.
-            fill_value: Value to use for points sampled outside the domain. If
-                None, the nearest neighbors will be used.
-            shift_center: Shift grid to image center when converting affine
-                transforms to dense transforms. Assumes the input and output spaces are identical.
-            shape: ND output shape used when converting affine transforms to dense
-                transforms. Includes only the N spatial dimensions. If None, the
-                shape of the input image will be used. Incompatible with `shift_center=True`.
-
-        Returns:
-            Tensor whose voxel values are the values of the input tensor
-            interpolated at the locations defined by the transform.
-
-        Notes:
-            There used to be an argument for choosing between matrix ('ij') and Cartesian ('xy')
-            indexing. Due to inconsistencies in how some functions and layers handled xy-indexing, we
-            removed it in favor of default ij-indexing to minimize the potential for confusion.
-
-        Keywords:
-            interpolation, sampler, resampler, linear, bilinear
-        """
-        if shape is not None and shift_center:
-            raise ValueError('`shape` option incompatible with `shift_center=True`')
-
-        # convert data type if needed
-        ftype = tf.float32
-        if not tf.is_tensor(vol) or not vol.dtype.is_floating:
-            vol = tf.cast(vol, ftype)
-        if not tf.is_tensor(loc_shift) or not loc_shift.dtype.is_floating:
-            loc_shift = tf.cast(loc_shift, ftype)
-
-        # convert affine to location shift (will validate affine shape)
-        if self.is_affine_shape(loc_shift.shape):
-            loc_shift = self.affine_to_dense_shift(loc_shift,
-                                            shape=vol.shape[:-1] if shape is None else shape,
-                                            shift_center=shift_center)
-
-        # parse spatial location shape, including channels if available
-        loc_volshape = loc_shift.shape[:-1]
-        if isinstance(loc_volshape, (tf.compat.v1.Dimension, tf.TensorShape)):
-            loc_volshape = loc_volshape.as_list()
-
-        # volume dimensions
-        nb_dims = len(vol.shape) - 1
-        is_channelwise = len(loc_volshape) == (nb_dims + 1)
-        assert loc_shift.shape[-1] == nb_dims, \
-            'Dimension check failed for ne.utils.transform(): {}D volume (shape {}) called ' \
-            'with {}D transform'.format(nb_dims, vol.shape[:-1], loc_shift.shape[-1])
-
-        # location should be mesh and delta
-        mesh = ne.utils.volshape_to_meshgrid(loc_volshape, indexing='ij')  # volume mesh
-        for d, m in enumerate(mesh):
-            if m.dtype != loc_shift.dtype:
-                mesh[d] = tf.cast(m, loc_shift.dtype)
-        loc = [mesh[d] + loc_shift[..., d] for d in range(nb_dims)]
-
-        # if channelwise location, then append the channel as part of the location lookup
-        if is_channelwise:
-            loc.append(mesh[-1])
-
-        # test single
-        return ne.utils.interpn(vol, loc, interp_method=interp_method, fill_value=fill_value)
-
+        """Construct transform from network space to the voxel space of an image. See `space_register.network_space`."""
+        return space_register.network_space(im, shape, voxsize, center=center)
 
     def transform(self, im, trans, shape=None, normalize=False, batch=False, interpolationComboBox_mode='nearest'):
-        """Apply a spatial transform to 3D image voxel data in dimensions.
-
-        Applies a transformation matrix operating in zero-based index space or a
-        displacement field to an image buffer.
-
-        Parameters
-        ----------
-        im : surfa.Volume or NumPy array or TensorFlow tensor
-            Input image to transform, without batch dimension.
-        trans : array-like
-            Transform to apply to the image. A matrix of shape (3, 4), a matrix
-            of shape (4, 4), or a displacement field of shape (*space, 3),
-            without batch dimension.
-        shape : (3,) array-like, optional
-            Output shape used for converting matrices to dense transforms. None
-            means the shape of the input image will be used.
-        normalize : bool, optional
-            Min-max normalize the image intensities into the interval [0, 1].
-        batch : bool, optional
-            Prepend a singleton batch dimension to the output tensor.
-
-        Returns
-        -------
-        out : float TensorFlow tensor
-            Transformed image with a trailing feature dimension.
-
-        """
-        # Add singleton feature dimension if needed.
-        if tf.rank(im) == 3:
-            im = im[..., tf.newaxis]
-
-        out = self.transformS(
-            im, trans, fill_value=0, shift_center=False, shape=shape, interp_method=interpolationComboBox_mode
+        """Apply a spatial transform to 3D image voxel data. See `space_register.transform`."""
+        return space_register.transform(
+            im, trans, shape=shape, normalize=normalize, batch=batch, interpolationComboBox_mode=interpolationComboBox_mode
         )
 
-        if normalize:
-            out -= tf.reduce_min(out)
-            out /= tf.reduce_max(out)
-
-        if batch:
-            out = out[tf.newaxis, ...]
-
-        return out
-    
-
-# suvr mapping
-import numpy as np
-import nibabel as nib
-from scipy.ndimage import map_coordinates
-import matplotlib.pyplot as plt
-import os
-
-def deform_img_based_on_other_img(original_img_path, refer_img_path):
-    """
-    基于参考图像对原始图像进行空间变换
-    
-    参数:
-        original_img_path: 原始图像路径
-        refer_img_path: 参考图像路径
-    
-    返回:
-        new_img_data: 变换后的图像数据
-        refer_affine: 参考图像的仿射矩阵
-    """
-    # 加载图像
-    refer_img = nib.load(refer_img_path)
-    original_img = nib.load(original_img_path)
-    
-    # 获取图像数据
-    refer_data = refer_img.get_fdata()
-    original_data = original_img.get_fdata()
-    
-    # 获取仿射矩阵
-    refer_affine = refer_img.affine
-    original_affine = original_img.affine
-    
-    # 获取图像尺寸
-    refer_x, refer_y, refer_z = refer_data.shape
-    origin_x, origin_y, origin_z = original_data.shape
-    
-    # 初始化新图像
-    new_img = np.zeros((refer_x, refer_y, refer_z))
-    
-    # 计算从参考图像空间到原始图像空间的变换矩阵
-    transform_matrix = np.linalg.inv(original_affine) @ refer_affine
-    
-    # 创建坐标网格（更高效的方法）
-    i, j, k = np.meshgrid(
-        np.arange(refer_x), 
-        np.arange(refer_y), 
-        np.arange(refer_z),
-        indexing='ij'
-    )
-    
-    # 将坐标展平以便批量处理
-    coords = np.stack([i.flatten(), j.flatten(), k.flatten(), np.ones(i.size)]).T
-    
-    # 应用变换矩阵
-    physical_coords = coords @ refer_affine.T
-    origin_coords = physical_coords @ np.linalg.inv(original_affine).T
-    
-    # 提取坐标并重塑
-    origin_i = origin_coords[:, 0].reshape(refer_x, refer_y, refer_z)
-    origin_j = origin_coords[:, 1].reshape(refer_x, refer_y, refer_z)
-    origin_k = origin_coords[:, 2].reshape(refer_x, refer_y, refer_z)
-    
-    # 使用插值获取原始图像值（最近邻插值，与MATLAB代码一致）
-    new_img = map_coordinates(
-        original_data, 
-        [origin_i, origin_j, origin_k], 
-        order=0,  # 0=最近邻插值
-        mode='constant', 
-        cval=0.0
-    )
-    
-    return new_img, refer_affine
-
-class PETNormalizerWithRegistration:
-    def __init__(self):
-        self.pet_img = None
-        self.ref_mask_img = None
-        self.pet_data = None
-        self.ref_mask_data = None
-        self.registered_mask = None
-        
-    def load_images(self, pet_path, ref_mask_path):
-        """加载PET图像和参考脑区mask"""
-        try:
-            # 加载PET图像
-            self.pet_img = nib.load(pet_path)
-            self.pet_data = self.pet_img.get_fdata()
-            
-            # 加载参考脑区mask
-            self.ref_mask_img = nib.load(ref_mask_path)
-            self.ref_mask_data = self.ref_mask_img.get_fdata()
-            
-            print(f"PET图像尺寸: {self.pet_data.shape}")
-            print(f"PET图像分辨率: {self.pet_img.header.get_zooms()}")
-            print(f"参考脑区尺寸: {self.ref_mask_data.shape}")
-            print(f"参考脑区分辨率: {self.ref_mask_img.header.get_zooms()}")
-            
-            return True
-            
-        except Exception as e:
-            print(f"图像加载错误: {e}")
-            return False
-    
-    def check_image_compatibility(self):
-        """检查图像兼容性"""
-        pet_shape = self.pet_data.shape
-        ref_shape = self.ref_mask_data.shape
-        pet_affine = self.pet_img.affine
-        ref_affine = self.ref_mask_img.affine
-        
-        # 检查尺寸是否一致
-        shape_match = (pet_shape == ref_shape)
-        
-        # 检查仿射矩阵是否一致（允许小的数值差异）
-        affine_match = np.allclose(pet_affine, ref_affine, atol=1e-3)
-        
-        # 检查分辨率
-        pet_zooms = self.pet_img.header.get_zooms()
-        ref_zooms = self.ref_mask_img.header.get_zooms()
-        resolution_match = np.allclose(pet_zooms, ref_zooms, atol=0.1)
-        
-        print(f"图像尺寸匹配: {shape_match}")
-        print(f"仿射矩阵匹配: {affine_match}")
-        print(f"分辨率匹配: {resolution_match}")
-        
-        return shape_match and affine_match and resolution_match
-    
-    def register_mask_to_pet(self):
-        """
-        使用您提供的MATLAB代码方法将参考脑区mask配准到PET图像空间
-        """
-        print("开始图像配准...")
-        
-        # 保存临时文件用于配准
-        temp_pet_path = "temp_pet.nii"
-        temp_mask_path = "temp_mask.nii"
-        
-        try:
-            # 保存临时文件
-            nib.save(self.pet_img, temp_pet_path)
-            nib.save(self.ref_mask_img, temp_mask_path)
-            
-            # 使用配准函数
-            registered_mask_data, pet_affine = deform_img_based_on_other_img(
-                temp_mask_path, temp_pet_path
-            )
-            
-            # 创建新的mask图像
-            self.registered_mask = nib.Nifti1Image(
-                registered_mask_data.astype(np.uint8), 
-                pet_affine, 
-                self.pet_img.header
-            )
-            
-            print("配准完成")
-            return True
-            
-        except Exception as e:
-            print(f"配准错误: {e}")
-            return False
-        
-        finally:
-            # 清理临时文件
-            if os.path.exists(temp_pet_path):
-                os.remove(temp_pet_path)
-            if os.path.exists(temp_mask_path):
-                os.remove(temp_mask_path)
-    
-    def calculate_suvr(self, use_registered_mask=True):
-        """计算SUVR归一化图像"""
-        print("计算SUVR...")
-        
-        # 选择使用的mask
-        if use_registered_mask and self.registered_mask is not None:
-            mask_data = self.registered_mask.get_fdata()
-        else:
-            mask_data = self.ref_mask_data
-        
-        # 确保mask与PET图像尺寸一致
-        if mask_data.shape != self.pet_data.shape:
-            print("警告: mask与PET图像尺寸不一致，使用配准后的mask")
-            if self.registered_mask is not None:
-                mask_data = self.registered_mask.get_fdata()
-            else:
-                raise ValueError("mask与PET图像尺寸不一致且无配准后的mask")
-        
-        # 提取参考脑区（mask值为1的区域）
-        reference_region = self.pet_data[mask_data == 1]
-        
-        if len(reference_region) == 0:
-            raise ValueError("参考脑区中没有有效的体素，请检查mask文件")
-        
-        # 计算参考脑区的平均强度
-        reference_mean = np.mean(reference_region)
-        print(f"参考脑区平均强度: {reference_mean:.4f}")
-        print(f"参考脑区体素数量: {len(reference_region)}")
-        
-        # 计算SUVR
-        suvr_data = self.pet_data / reference_mean
-        
-        # 创建新的NIfTI图像
-        suvr_img = nib.Nifti1Image(suvr_data, self.pet_img.affine, self.pet_img.header)
-        
-        print(f"SUVR计算完成，范围: [{suvr_data.min():.4f}, {suvr_data.max():.4f}]")
-        
-        return suvr_img, suvr_data
-    
-    def save_suvr_image(self, suvr_img, output_path):
-        """保存SUVR图像"""
-        nib.save(suvr_img, output_path)
-        print(f"SUVR图像已保存至: {output_path}")
 
+#
+# CliBatch
+#
 
-# SUVR Calculate
-def deform_img_based_on_other_img(original_img_path, refer_img_path, interpolation_order=0):
-    """
-    基于参考图像对原始图像进行空间变换
-    """
-    # 加载图像
-    refer_img = nib.load(refer_img_path)
-    original_img = nib.load(original_img_path)
-    
-    # 获取图像数据
-    refer_data = refer_img.get_fdata()
-    original_data = original_img.get_fdata()
-    
-    # 获取仿射矩阵
-    refer_affine = refer_img.affine
-    original_affine = original_img.affine
-    
-    # 获取图像尺寸
-    refer_x, refer_y, refer_z = refer_data.shape
-    origin_x, origin_y, origin_z = original_data.shape
-    
-    # 初始化新图像
-    new_img = np.zeros((refer_x, refer_y, refer_z))
-    
-    # 计算从参考图像空间到原始图像空间的变换矩阵
-    transform_matrix = np.linalg.inv(original_affine) @ refer_affine
-    
-    # 创建坐标网格
-    i, j, k = np.meshgrid(
-        np.arange(refer_x), 
-        np.arange(refer_y), 
-        np.arange(refer_z),
-        indexing='ij'
-    )
-    
-    # 将坐标展平以便批量处理
-    coords = np.stack([i.flatten(), j.flatten(), k.flatten(), np.ones(i.size)]).T
-    
-    # 应用变换矩阵
-    physical_coords = coords @ refer_affine.T
-    origin_coords = physical_coords @ np.linalg.inv(original_affine).T
-    
-    # 提取坐标并重塑
-    origin_i = origin_coords[:, 0].reshape(refer_x, refer_y, refer_z)
-    origin_j = origin_coords[:, 1].reshape(refer_x, refer_y, refer_z)
-    origin_k = origin_coords[:, 2].reshape(refer_x, refer_y, refer_z)
-    
-    # 使用插值获取原始图像值
-    new_img = map_coordinates(
-        original_data, 
-        [origin_i, origin_j, origin_k], 
-        order=interpolation_order,
-        mode='constant', 
-        cval=0.0
-    )
-    
-    return new_img, refer_affine
 
-def deform_img_based_on_other_img_exact(original_img_path, refer_img_path):
-    """
-    基于参考图像对原始图像进行空间变换
-    """
-    # 加载图像
-    refer_img = nib.load(refer_img_path)
-    original_img = nib.load(original_img_path)
-    
-    # 获取图像数据
-    refer_data = refer_img.get_fdata()
-    original_data = original_img.get_fdata()
-    
-    # 获取仿射矩阵
-    refer_affine = refer_img.affine
-    original_affine = original_img.affine
-    
-    # 获取图像尺寸
-    refer_x, refer_y, refer_z = refer_data.shape
-    origin_x, origin_y, origin_z = original_data.shape
-    
-    # 初始化新图像
-    new_img = np.zeros((refer_x, refer_y, refer_z))
-    
-    # 逐个体素计算
-    for i in range(refer_x):
-        for j in range(refer_y):
-            for k in range(refer_z):
-                # 物理坐标转换
-                physical_coor = np.array([i, j, k, 1]) @ refer_affine.T
-                
-                # 转换到原始图像坐标空间
-                origin_coor = physical_coor @ np.linalg.inv(original_affine).T
-                origin_coor = np.round(origin_coor[:3]).astype(int)
-                
-                # 边界检查
-                origin_x_coord = max(min(origin_coor[0], origin_x - 1), 0)
-                origin_y_coord = max(min(origin_coor[1], origin_y - 1), 0)
-                origin_z_coord = max(min(origin_coor[2], origin_z - 1), 0)
-                
-                # 赋值
-                new_img[i, j, k] = original_data[origin_x_coord, origin_y_coord, origin_z_coord]
-    
-    return new_img, refer_affine
+class CliBatch:
+    """Run Slicer CLI modules for many subjects, several at a time.
 
-def save_registered_image(registered_data, affine_matrix, output_path, dtype=None):
-    """
-    保存配准后的图像
-    """
-    if dtype is not None:
-        registered_data = registered_data.astype(dtype)
-    
-    registered_img = nib.Nifti1Image(registered_data, affine_matrix)
-    nib.save(registered_img, output_path)
+    CLI modules such as SwissSkullStripper and BRAINSFit read and write scene
+    nodes, so they are started from the main thread. Each one runs in a
+    process of its own, so several subjects still proceed in parallel. Has the
+    same interface as `batch_processing.BatchExecutor`.
 
-def register_and_save(original_img_path, refer_img_path, output_path, 
-                      method='vectorized', interpolation_order=0, dtype=None):
+    Tasks are functions returning a started CLI node and a function to call
+    once the node is no longer busy, which saves the outputs and removes the
+    nodes of the subject.
     """
-    配准并保存图像的完整函数
-    """
-    # 选择配准方法
-    if method == 'exact':
-        registered_data, affine = deform_img_based_on_other_img_exact(
-            original_img_path, refer_img_path
-        )
-    else:
-        registered_data, affine = deform_img_based_on_other_img(
-            original_img_path, refer_img_path, interpolation_order
-        )
-    
-    # 保存配准后的图像
-    save_registered_image(registered_data, affine, output_path, dtype)
-    
-    return registered_data, affine
-
-def calculate_label_suvr(label_path, suv_path, labels):
-    # 读取label文件
-    label_img = nib.load(label_path)
-    label_data = label_img.get_fdata()
-
-    # 读取SUV文件
-    suv_img = nib.load(suv_path)
-    suv_data = suv_img.get_fdata()
-
-    # 初始化一个字典来存储每个label的SUVR
-    label_suvr = {}
-
-    # 遍历每个label
-    for label in labels:
-        # 获取当前label的区域
-        region_mask = label_data == label
-        region_suv = suv_data[region_mask]
-
-        # 计算当前label的SUV均值
-        region_mean = np.nanmean(region_suv)
-
-        # 计算SUVR
-        suvr_value = region_mean
-        label_suvr[f'Label{label}'] = suvr_value
-
-    return label_suvr
-
-def suvr_compute(label_path, pet_path, labels):
-    label_path = os.path.join(label_path)
-    pet_path = os.path.join(pet_path)
-
-    # 计算每个label的SUVR
-    label_suvr = calculate_label_suvr(label_path, pet_path, labels)
-
-    return label_suvr
 
+    def __init__(self, workers=None):
+        self.workers = workers or batch_processing.default_workers()
+        self.pending = collections.deque()
+        self.running = {}
+        self.total = 0
+        self.results = {}
+        self.errors = {}
+        self.cancelled = False
+
+    def submit(self, key, start, *args, **kwargs):
+        """Queue `start(*args, **kwargs)` for the subject `key`."""
+        self.pending.append((key, start, args, kwargs))
+        self.total += 1
+
+    def poll(self):
+        """Collect finished subjects and start pending ones. Returns `(done, total)`."""
+        for key, (cli_node, finish) in list(self.running.items()):
+            if cli_node.IsBusy():
+                continue
+            del self.running[key]
+            try:
+                self.results[key] = finish()
+            except Exception as e:
+                print(f"Error processing {key}: {str(e)}")
+                self.errors[key] = e
+
+        while self.pending and len(self.running) < self.workers:
+            key, start, args, kwargs = self.pending.popleft()
+            try:
+                self.running[key] = start(*args, **kwargs)
+            except Exception as e:
+                print(f"Error processing {key}: {str(e)}")
+                self.errors[key] = e
+
+        return self.total - len(self.pending) - len(self.running), self.total
+
+    @property
+    def finished(self):
+        return not self.pending and not self.running
+
+    def cancel(self):
+        """Drop pending subjects and cancel running CLI modules."""
+        self.cancelled = True
+        self.pending.clear()
+        for cli_node, finish in self.running.values():
+            cli_node.Cancel()
@@ -0,0 +1,134 @@
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+import dicom2nifti
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import dicom_convert
+
+
+def write_series(directory, data, orientation=(1, 0, 0, 0, 1, 0), spacing=(0.8, 0.9), gaps=None,
+                 slope=1, intercept=-1024):
+    """Write a volume indexed by (slice, row, column) as single-frame CT slices.
+
+    Slices are stacked along the normal of `orientation`, at the distances in
+    `gaps` or 2.5 mm apart.
+
+    """
+    orientation = np.asarray(orientation, dtype=np.float64)
+    normal = np.cross(orientation[:3], orientation[3:])
+    if gaps is None:
+        gaps = [2.5] * (len(data) - 1)
+    offsets = np.concatenate([[0], np.cumsum(gaps)])
+
+    series = generate_uid()
+    files = []
+    for i, pixels in enumerate(data):
+        ds = Dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+        ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        ds.SOPClassUID = ds.file_meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+        ds.PatientID = 'P1'
+        ds.StudyInstanceUID = '1.2.3'
+        ds.SeriesInstanceUID = series
+        ds.Modality = 'CT'
+        ds.ImageType = ['ORIGINAL', 'PRIMARY', 'AXIAL']
+        ds.InstanceNumber = i + 1
+        ds.ImagePositionPatient = list(np.array([-10., -20., 30.]) + offsets[i] * normal)
+        ds.ImageOrientationPatient = list(orientation)
+        ds.PixelSpacing = list(spacing)
+        ds.SliceThickness = 2.5
+        ds.Rows, ds.Columns = pixels.shape
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.RescaleSlope = slope
+        ds.RescaleIntercept = intercept
+        ds.PixelData = pixels.astype(np.int16).tobytes()
+
+        path = os.path.join(directory, f'{i:03d}.dcm')
+        ds.save_as(path, enforce_file_format=True)
+        files.append(path)
+
+    return files
+
+
+class DicomConvertTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.rng = np.random.default_rng(0)
+        self.data = self.rng.integers(0, 2000, size=(12, 20, 24))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def reference(self, files):
+        dicoms = [pydicom.dcmread(f) for f in files]
+        output = os.path.join(self.tmp.name, 'reference.nii')
+        return dicom2nifti.convert_dicom.dicom_array_to_nifti(dicoms, output, reorient_nifti=True)['NII']
+
+    def assertSameImage(self, image, reference):
+        self.assertEqual(image.shape, reference.shape)
+        np.testing.assert_allclose(image.affine, reference.affine, atol=1e-4)
+        np.testing.assert_allclose(image.get_fdata(), reference.get_fdata(), atol=1e-4)
+
+    def test_matches_dicom2nifti(self):
+        oblique = np.array([np.cos(0.3), np.sin(0.3), 0, -np.sin(0.3) * np.cos(0.2),
+                            np.cos(0.3) * np.cos(0.2), np.sin(0.2)])
+        for orientation in ((1, 0, 0, 0, 1, 0), oblique):
+            for slope in (1, 0.5):
+                with self.subTest(orientation=orientation, slope=slope):
+                    directory = tempfile.mkdtemp(dir=self.tmp.name)
+                    files = write_series(directory, self.data, orientation=orientation, slope=slope)
+                    image = dicom_convert.load_series(files)
+                    self.assertSameImage(image, self.reference(files))
+
+    def test_file_order(self):
+        files = write_series(self.tmp.name, self.data)
+        expected = dicom_convert.load_series(files)
+
+        shuffled = list(files)
+        random.Random(0).shuffle(shuffled)
+        image = dicom_convert.load_series(shuffled)
+        np.testing.assert_array_equal(image.affine, expected.affine)
+        np.testing.assert_array_equal(image.get_fdata(), expected.get_fdata())
+
+    def test_overlapping_slices(self):
+        gaps = [2.5] * 11
+        gaps[5] = 0
+        files = write_series(self.tmp.name, self.data, gaps=gaps)
+        with self.assertRaisesRegex(ValueError, 'overlap'):
+            dicom_convert.load_series(files)
+
+    def test_uneven_spacing(self):
+        gaps = [2.5] * 11
+        gaps[5] = 5
+        files = write_series(self.tmp.name, self.data, gaps=gaps)
+        with self.assertRaisesRegex(ValueError, 'evenly spaced'):
+            dicom_convert.load_series(files)
+
+    def test_missing_orientation(self):
+        files = write_series(self.tmp.name, self.data)
+        headers = [dicom_convert.read_geometry(f) for f in files]
+        del headers[0].ImageOrientationPatient
+        with self.assertRaisesRegex(ValueError, 'position or orientation'):
+            dicom_convert.slice_order(headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
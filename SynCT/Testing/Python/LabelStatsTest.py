@@ -0,0 +1,98 @@
+import os
+import sys
+import unittest
+import warnings
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import label_stats
+
+
+def vxm_dice(array1, array2, labels):
+    """Per-label loop of vxm.py.utils.dice, for explicit labels."""
+    dicem = np.zeros(len(labels))
+    for idx, label in enumerate(labels):
+        top = 2 * np.sum(np.logical_and(array1 == label, array2 == label))
+        bottom = np.sum(array1 == label) + np.sum(array2 == label)
+        bottom = np.maximum(bottom, np.finfo(float).eps)
+        dicem[idx] = top / bottom
+    return dicem
+
+
+def extreme(function):
+    """NaN-ignoring minimum or maximum, NaN without valid values."""
+    return lambda v: function(v) if np.isfinite(v).any() else np.nan
+
+
+def masked(function, values, label_data, labels):
+    """Statistic of the values under each label, computed with a full mask per label."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.array([function(values[label_data == label]) for label in labels])
+
+
+class LabelStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+
+    def label_maps(self):
+        """Label images as stored and as read by get_fdata, with and without non-integer labels."""
+        labels = self.rng.integers(0, 40, size=(30, 28, 20))
+        yield 'int16', labels.astype(np.int16)
+        yield 'float64', labels.astype(np.float64)
+        yield 'negative', labels.astype(np.float64) - 20
+        fractional = labels.astype(np.float64)
+        fractional[self.rng.random(labels.shape) < 0.1] += 0.5
+        yield 'fractional', fractional
+
+    def test_regional_stats(self):
+        values = self.rng.normal(1, 0.3, size=(30, 28, 20))
+        values[self.rng.random(values.shape) < 0.02] = np.nan
+
+        for name, label_data in self.label_maps():
+            # Absent, fractional, duplicate, and fully NaN labels
+            labels = list(np.unique(label_data)[::3]) + [1000, 2.5, label_data.flat[0]]
+            values_nan = values.copy()
+            values_nan[label_data == labels[1]] = np.nan
+            with self.subTest(labels=name):
+                stats = label_stats.regional_stats(label_data, values_nan, labels)
+                np.testing.assert_allclose(stats['mean'], masked(np.nanmean, values_nan, label_data, labels),
+                                           rtol=1e-12, equal_nan=True)
+                np.testing.assert_allclose(stats['std'], masked(np.nanstd, values_nan, label_data, labels),
+                                           rtol=1e-6, atol=1e-12, equal_nan=True)
+                np.testing.assert_array_equal(
+                    stats['min'], masked(extreme(np.nanmin), values_nan, label_data, labels))
+                np.testing.assert_array_equal(
+                    stats['max'], masked(extreme(np.nanmax), values_nan, label_data, labels))
+                np.testing.assert_array_equal(
+                    stats['count'], masked(lambda v: np.count_nonzero(~np.isnan(v)), values_nan, label_data, labels))
+                np.testing.assert_array_equal(
+                    stats['nan_count'], masked(lambda v: np.count_nonzero(np.isnan(v)), values_nan, label_data, labels))
+
+    def test_dice(self):
+        for name, label_data in self.label_maps():
+            moved = np.where(self.rng.random(label_data.shape) < 0.8, label_data,
+                             label_data.flat[self.rng.integers(0, label_data.size, label_data.shape)])
+            labels = list(np.unique(label_data)[1::2]) + [1000, 2.5, label_data.flat[0]]
+            with self.subTest(labels=name):
+                np.testing.assert_array_equal(label_stats.dice(label_data, moved, labels),
+                                              vxm_dice(label_data, moved, labels))
+
+    def test_empty(self):
+        label_data = self.rng.integers(0, 5, size=(4, 5, 6))
+        self.assertEqual(len(label_stats.dice(label_data, label_data, [])), 0)
+        self.assertEqual(len(label_stats.regional_stats(label_data, label_data, [])['mean']), 0)
+
+    def test_shape_mismatch(self):
+        label_data = self.rng.integers(0, 5, size=(4, 5, 6))
+        with self.assertRaises(ValueError):
+            label_stats.regional_stats(label_data, label_data[:3], [1, 2])
+        with self.assertRaises(ValueError):
+            label_stats.dice(label_data, label_data[:3], [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+import nibabel as nib
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import pipeline
+
+
+def clip_stages(max_first=200, max_second=100):
+    """Two chained ct-clip stages, the second reading the output of the first."""
+    return {
+        'first': dict(run='ct-clip', input='ct.nii', min=-100, max=max_first, output='first.nii.gz'),
+        'second': dict(run='ct-clip', input='first.nii.gz', min=-50, max=max_second, output='second.nii.gz'),
+    }
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.base_dir = self.tmp.name
+        rng = np.random.default_rng(0)
+        for subject in ('sub1', 'sub2'):
+            os.mkdir(os.path.join(self.base_dir, subject))
+            data = rng.integers(-1024, 2000, size=(8, 9, 10)).astype(np.int16)
+            nib.save(nib.Nifti1Image(data, np.eye(4)), os.path.join(self.base_dir, subject, 'ct.nii'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_pipeline(self, stages, **kwargs):
+        """Run a pipeline, returning its errors and summary line."""
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            errors = pipeline.Pipeline(dict(stages=stages), base_dir=self.base_dir, jobs=2, **kwargs).run()
+        summary = [line for line in out.getvalue().splitlines() if line.startswith('Pipeline complete')]
+        return errors, summary[-1]
+
+    def output(self, subject, name):
+        return nib.load(os.path.join(self.base_dir, subject, name)).get_fdata()
+
+    def test_up_to_date(self):
+        errors, summary = self.run_pipeline(clip_stages())
+        self.assertEqual(errors, {})
+        self.assertEqual(summary, 'Pipeline complete: 4 done')
+        self.assertLessEqual(self.output('sub1', 'second.nii.gz').max(), 100)
+
+        errors, summary = self.run_pipeline(clip_stages())
+        self.assertEqual(errors, {})
+        self.assertEqual(summary, 'Pipeline complete: 4 up to date')
+
+        # Forced stages rerun without their dependents.
+        errors, summary = self.run_pipeline(clip_stages(), force=['second'])
+        self.assertEqual(summary, 'Pipeline complete: 2 up to date, 2 done')
+
+    def test_option_change(self):
+        self.run_pipeline(clip_stages())
+
+        # Only the changed stage reruns.
+        errors, summary = self.run_pipeline(clip_stages(max_second=20))
+        self.assertEqual(errors, {})
+        self.assertEqual(summary, 'Pipeline complete: 2 up to date, 2 done')
+        self.assertLessEqual(self.output('sub1', 'second.nii.gz').max(), 20)
+
+        # Changing the first stage changes the input of the second.
+        errors, summary = self.run_pipeline(clip_stages(max_first=10, max_second=20))
+        self.assertEqual(errors, {})
+        self.assertEqual(summary, 'Pipeline complete: 4 done')
+        self.assertLessEqual(self.output('sub1', 'second.nii.gz').max(), 10)
+
+    def test_failure_blocks_dependents(self):
+        with open(os.path.join(self.base_dir, 'sub2', 'ct.nii'), 'wb') as f:
+            f.write(b'not an image')
+
+        errors, summary = self.run_pipeline(clip_stages())
+        self.assertEqual(set(errors), {('sub2', 'first')})
+        self.assertEqual(summary, 'Pipeline complete: 1 blocked, 2 done, 1 failed')
+        self.assertTrue(os.path.exists(os.path.join(self.base_dir, 'sub1', 'second.nii.gz')))
+        self.assertFalse(os.path.exists(os.path.join(self.base_dir, 'sub2', 'second.nii.gz')))
+
+        # Failed stages are not recorded, and rerun with their dependents.
+        nib.save(nib.Nifti1Image(np.zeros((8, 9, 10), np.int16), np.eye(4)),
+                 os.path.join(self.base_dir, 'sub2', 'ct.nii'))
+        errors, summary = self.run_pipeline(clip_stages())
+        self.assertEqual(errors, {})
+        self.assertEqual(summary, 'Pipeline complete: 2 up to date, 2 done')
+
+    def test_cycle(self):
+        stages = clip_stages()
+        stages['first']['input'] = 'second.nii.gz'
+        with self.assertRaisesRegex(ValueError, 'cycle'):
+            pipeline.Pipeline(dict(stages=stages), base_dir=self.base_dir, jobs=1)
+
+        stages = clip_stages()
+        stages['first']['after'] = ['second']
+        with self.assertRaisesRegex(ValueError, 'cycle'):
+            pipeline.Pipeline(dict(stages=stages), base_dir=self.base_dir, jobs=1)
+
+    def test_unknown_stage(self):
+        stages = clip_stages()
+        stages['second']['after'] = ['third']
+        with self.assertRaisesRegex(ValueError, 'unknown stage'):
+            pipeline.Pipeline(dict(stages=stages), base_dir=self.base_dir, jobs=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
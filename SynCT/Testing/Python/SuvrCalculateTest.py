@@ -0,0 +1,157 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import nibabel as nib
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import suvr_calculate
+
+
+def exact_loop(original_data, original_affine, refer_shape, refer_affine):
+    """Voxel-by-voxel resampling of the original deform_img_based_on_other_img_exact."""
+    new_img = np.zeros(refer_shape)
+    origin_x, origin_y, origin_z = original_data.shape
+    for i in range(refer_shape[0]):
+        for j in range(refer_shape[1]):
+            for k in range(refer_shape[2]):
+                physical_coor = np.array([i, j, k, 1]) @ refer_affine.T
+                origin_coor = physical_coor @ np.linalg.inv(original_affine).T
+                origin_coor = np.round(origin_coor[:3]).astype(int)
+                x = max(min(origin_coor[0], origin_x - 1), 0)
+                y = max(min(origin_coor[1], origin_y - 1), 0)
+                z = max(min(origin_coor[2], origin_z - 1), 0)
+                new_img[i, j, k] = original_data[x, y, z]
+    return new_img
+
+
+def full_grid(original_data, original_affine, refer_shape, refer_affine, order):
+    """Resampling over the whole grid at once, as the original deform_img_based_on_other_img."""
+    i, j, k = np.meshgrid(*map(np.arange, refer_shape), indexing='ij')
+    coords = np.stack([i.flatten(), j.flatten(), k.flatten(), np.ones(i.size)]).T
+    origin_coords = (coords @ refer_affine.T) @ np.linalg.inv(original_affine).T
+    return map_coordinates(original_data, [origin_coords[:, a].reshape(refer_shape) for a in range(3)],
+                           order=order, mode='constant', cval=0.0)
+
+
+def random_affine(rng, scale=(0.7, 2.5), shift=10):
+    """Affine with random rotation, scaling, shear, and translation."""
+    q, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+    affine = np.eye(4)
+    affine[:3, :3] = q @ np.diag(rng.uniform(*scale, size=3)) @ (np.eye(3) + np.triu(rng.normal(0, 0.1, (3, 3)), 1))
+    affine[:3, 3] = rng.uniform(-shift, shift, size=3)
+    return affine
+
+
+def aligned_affine(rng, voxel, permutation, flips):
+    """Axis-aligned affine with permuted and flipped axes."""
+    affine = np.zeros((4, 4))
+    affine[3, 3] = 1
+    for a, p in enumerate(permutation):
+        affine[p, a] = voxel[a] * (-1 if flips[a] else 1)
+    affine[:3, 3] = rng.integers(-8, 8, size=3)
+    return affine
+
+
+class SuvrCalculateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.rng = np.random.default_rng(0)
+        suvr_calculate.plan_cache.clear()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        suvr_calculate.plan_cache.clear()
+
+    def save(self, name, data, affine):
+        path = os.path.join(self.tmp.name, name)
+        nib.save(nib.Nifti1Image(data, affine), path)
+        return path
+
+    def cases(self, n):
+        """Random pairs of grids, general and axis-aligned, some with exact half-voxel ties."""
+        for c in range(n):
+            original_shape = tuple(self.rng.integers(5, 12, size=3))
+            refer_shape = tuple(self.rng.integers(4, 10, size=3))
+            if c % 3 == 0:
+                original_affine = aligned_affine(self.rng, (2, 2, 2), (0, 1, 2), (False,) * 3)
+                refer_affine = aligned_affine(self.rng, (1, 1, 1), self.rng.permutation(3), self.rng.random(3) < 0.5)
+            elif c % 3 == 1:
+                original_affine = random_affine(self.rng)
+                refer_affine = aligned_affine(self.rng, self.rng.uniform(0.5, 3, 3), self.rng.permutation(3),
+                                              self.rng.random(3) < 0.5)
+            else:
+                original_affine = random_affine(self.rng)
+                refer_affine = random_affine(self.rng)
+            data = self.rng.integers(0, 50, size=original_shape).astype(np.float32)
+            yield data, original_affine, refer_shape, refer_affine
+
+    def test_exact_matches_loop(self):
+        for c, (data, original_affine, refer_shape, refer_affine) in enumerate(self.cases(9)):
+            original = self.save(f'original{c}.nii', data, original_affine)
+            refer = self.save(f'refer{c}.nii', np.zeros(refer_shape, np.float32), refer_affine)
+            expected = exact_loop(np.asanyarray(nib.load(original).dataobj, dtype=np.float64),
+                                  nib.load(original).affine, refer_shape, nib.load(refer).affine)
+            for threads in (1, 3):
+                for slab_voxels in (1, 37, 1 << 21):
+                    with self.subTest(case=c, threads=threads, slab_voxels=slab_voxels):
+                        new_img, affine = suvr_calculate.deform_img_based_on_other_img_exact(
+                            original, refer, threads=threads, slab_voxels=slab_voxels)
+                        np.testing.assert_array_equal(affine, nib.load(refer).affine)
+                        self.assertEqual(new_img.dtype, expected.dtype)
+                        np.testing.assert_array_equal(new_img, expected)
+
+    def test_nearest_matches_map_coordinates(self):
+        for c, (data, original_affine, refer_shape, refer_affine) in enumerate(self.cases(12)):
+            expected = full_grid(data, original_affine, refer_shape, refer_affine, order=0)
+            for slab_voxels in (1, 29, 1 << 18):
+                with self.subTest(case=c, slab_voxels=slab_voxels):
+                    suvr_calculate.plan_cache.clear()
+                    new_img = suvr_calculate.resample_to_reference(
+                        data, original_affine, refer_shape, refer_affine, slab_voxels=slab_voxels)
+                    np.testing.assert_array_equal(new_img, expected)
+
+    def test_linear_matches_map_coordinates(self):
+        for c, (data, original_affine, refer_shape, refer_affine) in enumerate(self.cases(6)):
+            expected = full_grid(data, original_affine, refer_shape, refer_affine, order=1)
+            with self.subTest(case=c):
+                new_img = suvr_calculate.resample_to_reference(
+                    data, original_affine, refer_shape, refer_affine, interpolation_order=1, slab_voxels=41)
+                np.testing.assert_allclose(new_img, expected, rtol=1e-6, atol=1e-5)
+
+    def test_plan_cache(self):
+        cases = list(self.cases(suvr_calculate.plan_cache_size + 2))
+        data, original_affine, refer_shape, refer_affine = cases[0]
+        plan = suvr_calculate.nearest_plan(data.shape, original_affine, refer_shape, refer_affine)
+        self.assertIs(suvr_calculate.nearest_plan(data.shape, original_affine, refer_shape, refer_affine), plan)
+
+        # Subjects with the same geometry reuse the plan for their own data
+        other = self.rng.integers(0, 50, size=data.shape).astype(np.float32)
+        np.testing.assert_array_equal(
+            suvr_calculate.resample_to_reference(other, original_affine, refer_shape, refer_affine),
+            full_grid(other, original_affine, refer_shape, refer_affine, order=0))
+        self.assertEqual(len(suvr_calculate.plan_cache), 1)
+
+        # A different geometry gets its own plan
+        shifted = original_affine.copy()
+        shifted[:3, 3] += 0.3
+        self.assertIsNot(suvr_calculate.nearest_plan(data.shape, shifted, refer_shape, refer_affine), plan)
+        np.testing.assert_array_equal(
+            suvr_calculate.resample_to_reference(data, shifted, refer_shape, refer_affine),
+            full_grid(data, shifted, refer_shape, refer_affine, order=0))
+
+        # Least recently used plans are evicted beyond the cache size
+        for data, original_affine, refer_shape, refer_affine in cases[1:]:
+            suvr_calculate.resample_to_reference(data, original_affine, refer_shape, refer_affine)
+        self.assertEqual(len(suvr_calculate.plan_cache), suvr_calculate.plan_cache_size)
+        data, original_affine, refer_shape, refer_affine = cases[0]
+        self.assertIsNot(suvr_calculate.nearest_plan(data.shape, original_affine, refer_shape, refer_affine), plan)
+
+
+if __name__ == '__main__':
+    unittest.main()
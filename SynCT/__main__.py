@@ -0,0 +1,13 @@
+import os
+import sys
+
+# Module scripts and the bundled SynthMorph package import each other as
+# top-level modules, as they do inside Slicer.
+module_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, module_dir)
+sys.path.append(os.path.join(module_dir, 'mri_synthmorph'))
+
+from batch_cli import main
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,535 @@
+"""Headless batch processing of subject folders.
+
+Runs every batch stage of the SynCT module without Slicer:
+
+    python -m SynCT batch <stage> --base-dir DIR [options]
+
+or runs a pipeline of stages defined in a TOML or YAML file, skipping those
+that are up to date:
+
+    python -m SynCT pipeline FILE
+
+`python -m SynCT watch INBOX --output-dir DIR` converts series as they
+arrive in an inbox folder, optionally running a pipeline on the results.
+
+`python -m SynCT benchmark-dicom DIR` times the DICOM converters on a series,
+and `python -m SynCT benchmark-synthmorph MOVING FIXED` times the XLA and
+reduced-precision SynthMorph inference paths against float32 on an image pair.
+
+SynthStrip exported with `python -m SynCT export-synthstrip model.onnx` runs
+faster on the CPU, by passing the exported file as the skull-strip model.
+
+Each subfolder of the base directory is a subject. File options name files
+inside each subject folder, except for options documented as paths.
+"""
+
+import os
+import sys
+import argparse
+
+import batch_processing
+import preprocess
+
+
+def parse_ints(text):
+    return tuple(int(x) for x in text.split(','))
+
+
+def series_criteria(arg):
+    """Series selection options of the DICOM stages, see `dicom_index.matches`."""
+    keys = ('description', 'min_slices', 'max_slices', 'min_thickness', 'max_thickness')
+    return {k: getattr(arg, k) for k in keys if getattr(arg, k) is not None}
+
+
+# Tasks by stage. Each maps a subject folder to `(function, args, kwargs)`,
+# or to None for skipping a subject without the inputs of the stage.
+def dicom_ct_task(arg, subject, path):
+    fold_path = os.path.join(path, arg.dicom_dir)
+    if os.path.isdir(fold_path):
+        output_file = os.path.join(arg.output_dir, subject, arg.output)
+        args = (fold_path, output_file, arg.index, not arg.dicom2nifti)
+        return preprocess.dicom_to_nifti_ct, args, series_criteria(arg)
+
+
+def dicom_pet_task(arg, subject, path):
+    fold_path = os.path.join(path, arg.dicom_dir)
+    if os.path.isdir(fold_path):
+        output_file = os.path.join(arg.output_dir, subject, arg.output)
+        args = (fold_path, output_file, arg.index, not arg.dicom2nifti, arg.suv_mode)
+        return preprocess.dicom_to_nifti_pet, args, series_criteria(arg)
+
+
+def ct_clip_task(arg, subject, path):
+    file_path = os.path.join(path, arg.input)
+    if os.path.isfile(file_path):
+        normalize = 'True' if arg.normalize else 'False'
+        output_file = os.path.join(path, arg.output)
+        return preprocess.ct_clip, (file_path, output_file, arg.min, arg.max, normalize, arg.dtype), {}
+
+
+def skull_strip_task(arg, subject, path):
+    file_path = os.path.join(path, arg.input)
+    if os.path.isfile(file_path):
+        output_file = os.path.join(path, arg.output)
+        mask_file = os.path.join(path, arg.mask) if arg.mask else None
+        threads = max(1, (os.cpu_count() or 1) // arg.jobs)
+        kwargs = dict(output=output_file, mask=mask_file, model=arg.model, threads=threads, no_csf=arg.no_csf,
+                      precision=arg.precision)
+        return batch_processing.synthstrip, (file_path,), kwargs
+
+
+def mask_task(arg, subject, path):
+    file_path = os.path.join(path, arg.input)
+    mask_path = os.path.join(path, arg.mask)
+    if os.path.isfile(file_path) and os.path.isfile(mask_path):
+        output_file = os.path.join(path, arg.output)
+        return preprocess.apply_mask, (file_path, mask_path, output_file), {}
+
+
+def space_task(arg, subject, path):
+    import space_register
+
+    file_path = os.path.join(path, arg.input)
+    if os.path.isfile(file_path):
+        output_file = os.path.join(path, arg.output)
+        args = (file_path, arg.fixed, arg.shape, arg.voxsize, output_file, arg.method)
+        return space_register.resample_file, args, {}
+
+
+def apply_task(arg, subject, path):
+    file_path = os.path.join(path, arg.input)
+    field_path = os.path.join(path, arg.field)
+    if os.path.isfile(file_path) and os.path.isfile(field_path):
+        output_file = os.path.join(path, arg.output)
+        return batch_processing.synthmorph_apply, (field_path, file_path, output_file), dict(method=arg.method)
+
+
+def dice_task(arg, subject, path):
+    import dice_calculate as dc
+
+    label1_path = os.path.join(path, arg.label1)
+    label2_path = os.path.join(path, arg.label2)
+    if os.path.isfile(label1_path) and os.path.isfile(label2_path):
+        return dc.dice_compute, (label1_path, label2_path), dict(labels=arg.labels)
+
+
+def suvr_task(arg, subject, path):
+    from suvr_calculate import compute_subject_suvr
+
+    pet_path = os.path.join(path, arg.input)
+    if os.path.isfile(pet_path):
+        label_output = os.path.join(path, arg.label_output) if arg.label_output else None
+        return compute_subject_suvr, (pet_path, arg.label_image, arg.labels), dict(label_output=label_output)
+
+
+def suvr_mapping_task(arg, subject, path):
+    from suvr_calculate import suvr_mapping
+
+    pet_path = os.path.join(path, arg.input)
+    mask_path = os.path.join(path, arg.mask)
+    if os.path.isfile(pet_path) and os.path.isfile(mask_path):
+        output_file = os.path.join(path, arg.output)
+        return suvr_mapping, (pet_path, mask_path, output_file), {}
+
+
+# Summaries of stages that write a table for all subjects.
+def dice_finish(arg, subjects, results, errors):
+    import dice_calculate as dc
+    dc.save_dice_results(subjects, results, arg.labels, arg.output)
+
+
+def suvr_finish(arg, subjects, results, errors):
+    from suvr_calculate import save_suvr_results
+    save_suvr_results(subjects, results, errors, arg.labels, arg.output)
+
+
+def progress(done, total):
+    print(f'Processed {done}/{total} subjects', flush=True)
+
+
+def run_tasks(arg, subjects):
+    """Fan the tasks of all subjects out over a process pool."""
+    executor = batch_processing.BatchExecutor(arg.jobs)
+    for subject in subjects:
+        task = arg.task(arg, subject, os.path.join(arg.base_dir, subject))
+        if task is None:
+            print(f'Skipping {subject}: inputs not found')
+            continue
+        fn, args, kwargs = task
+        executor.submit(subject, fn, *args, **kwargs)
+
+    try:
+        results, errors = executor.run(callback=progress)
+    except KeyboardInterrupt:
+        executor.cancel()
+        raise
+
+    if arg.finish is not None:
+        arg.finish(arg, subjects, results, errors)
+
+    return errors
+
+
+def run_register(arg, subjects):
+    """Register all subjects with one SynthMorph network, in batches."""
+    from synthmorph.engine import RegistrationEngine
+
+    engine = RegistrationEngine(model=arg.model, threads=arg.jobs, cache_dir=arg.cache_dir, xla=arg.xla,
+                                precision=arg.precision)
+    for subject in subjects:
+        path = os.path.join(arg.base_dir, subject)
+        file_path = os.path.join(path, arg.input)
+        if not os.path.isfile(file_path):
+            print(f'Skipping {subject}: inputs not found')
+            continue
+        kwargs = dict(out_moving=os.path.join(path, arg.output))
+        if arg.field:
+            kwargs.update(trans=os.path.join(path, arg.field))
+        engine.submit(file_path, arg.fixed, **kwargs)
+
+    mem_limit = None if arg.mem_limit is None else int(arg.mem_limit * 1024 ** 3)
+    return engine.run(
+        callback=lambda i, total, moving: progress(i, total),
+        batch_size=arg.batch_size,
+        mem_limit=mem_limit,
+    )
+
+
+def benchmark_dicom(arg):
+    """Time the native and dicom2nifti converters on a series and compare their output."""
+    import tempfile
+    import time
+    import numpy as np
+    import nibabel as nib
+
+    header, files = preprocess.find_series(arg.dicom_dir, arg.modality, arg.index, **series_criteria(arg))
+    factor = preprocess.suv_factor(header) if arg.modality == 'PT' else None
+    print(f'{header.get("SeriesDescription")}: {len(files)} slices')
+
+    images = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, native in (('dicom2nifti', False), ('native', True)):
+            output = os.path.join(tmp, f'{name}.nii')
+            times = []
+            for _ in range(arg.repeat):
+                start = time.perf_counter()
+                preprocess.convert_series(files, output, suv_factor=factor, native=native)
+                times.append(time.perf_counter() - start)
+            images[name] = nib.load(output)
+            images[name].get_fdata()
+            print(f'{name:>12}: {min(times):.3f} s (best of {arg.repeat})')
+
+    ref, out = images['dicom2nifti'], images['native']
+    if ref.shape != out.shape:
+        print(f'Shape differs: {ref.shape} vs {out.shape}', file=sys.stderr)
+        return 1
+    affine = np.abs(ref.affine - out.affine).max()
+    data = np.abs(ref.get_fdata() - out.get_fdata()).max()
+    print(f'Largest affine difference: {affine:.2e}, largest intensity difference: {data:.2e}')
+    if affine > arg.atol or data > arg.atol * max(1, np.abs(ref.get_fdata()).max()):
+        print(f'Converters differ by more than {arg.atol}', file=sys.stderr)
+        return 1
+    return 0
+
+
+def benchmark_synthmorph(arg):
+    """Time SynthMorph inference paths on an image pair and compare them with eager float32.
+
+    XLA must reproduce the float32 transforms within the tolerance. Reduced
+    precisions are reported by their displacement error and, with a label
+    map of the moving image, the Dice overlap of the labels moved by the
+    float32 transform and by theirs.
+    """
+    import time
+    import numpy as np
+    import surfa as sf
+    import tensorflow as tf
+    import label_stats
+    from synthmorph import registration
+
+    def best(func):
+        times = []
+        for _ in range(arg.repeat):
+            start = time.perf_counter()
+            out = [np.asarray(x) for x in func()]
+            times.append(time.perf_counter() - start)
+        return min(times), out
+
+    labels = None
+    if arg.labels:
+        labels = sf.load_volume(arg.labels).data
+        label_ids = np.unique(labels)
+        label_ids = label_ids[label_ids != 0]
+
+    status = 0
+    for extent in arg.extent:
+        var = argparse.Namespace(model=arg.model, extent=extent, steps=arg.steps, weights=None, moving=arg.moving,
+                                 fixed=arg.fixed, init=None, mid_space=False, threads=None)
+        prep = registration.prepare(var)
+        inputs = prep['inputs']
+        if arg.model not in ('affine', 'rigid'):
+            inputs = (tf.constant([0.5]), *inputs)
+
+        def eager(model):
+            pred = tuple(map(tf.squeeze, model(inputs)))
+            return registration.compose_outputs(prep, pred)
+
+        model = registration.load_model(var)
+        base_time, ref = best(lambda: eager(model))
+        print(f'Extent {extent}: float32 {base_time:.2f} s')
+
+        # The first call compiles.
+        xla = registration.XlaInference(model)
+        start = time.perf_counter()
+        xla.predict(prep, inputs)
+        compile_time = time.perf_counter() - start
+        xla_time, out = best(lambda: xla.predict(prep, inputs)[1])
+        diff = max(np.abs(a - b).max() for a, b in zip(ref, out))
+        print(f'{"XLA":>12}: {xla_time:.2f} s ({base_time / xla_time:.1f}x, compiled in {compile_time:.1f} s), '
+              f'largest transform difference {diff:.2e}')
+        if diff > arg.atol:
+            print(f'XLA transforms differ by more than {arg.atol} at extent {extent}', file=sys.stderr)
+            status = 1
+
+        shape = prep['fix'].shape
+        ref_shift = registration.dense_shift(ref[0], shape)
+        if labels is not None:
+            ref_labels = registration.warp_labels(labels, ref[0], shape)
+
+        for precision in arg.precision:
+            reduced = registration.load_model(argparse.Namespace(**vars(var), precision=precision))
+            if precision == 'int8' and not isinstance(reduced, registration.QuantizedModel) \
+                    or precision == 'bfloat16' and not registration.bf16_supported():
+                print(f'{precision:>12}: unavailable')
+                continue
+            reduced_time, out = best(lambda: eager(reduced))
+
+            # Displacement error of the forward transform in moving voxels
+            error = np.linalg.norm(registration.dense_shift(out[0], shape) - ref_shift, axis=-1)
+            report = f'{precision:>12}: {reduced_time:.2f} s ({base_time / reduced_time:.1f}x), ' \
+                     f'displacement error mean {error.mean():.3f}, max {error.max():.3f} voxels'
+            if labels is not None:
+                moved = registration.warp_labels(labels, out[0], shape)
+                dice = label_stats.dice(ref_labels, moved, label_ids)
+                report += f', Dice mean {dice.mean():.4f}, min {dice.min():.4f}'
+            print(report)
+
+    return status
+
+
+def export_synthstrip(arg):
+    """Export SynthStrip and check the exported model against the eager one."""
+    import synthstrip_engine
+
+    model = arg.model or synthstrip_engine.model_file(arg.no_csf)
+    synthstrip_engine.export_model(model, arg.output, shape=arg.shape)
+    print(f'Exported {model} to {arg.output}')
+    if arg.no_check:
+        return 0
+
+    diff = synthstrip_engine.parity(model, arg.output, shape=arg.shape)
+    print(f'Largest SDT difference to the eager model: {diff:.2e}')
+    if diff > arg.atol:
+        print(f'Exported model differs by more than {arg.atol}', file=sys.stderr)
+        return 1
+    return 0
+
+
+def parser():
+    p = argparse.ArgumentParser(prog='python -m SynCT', description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = p.add_subparsers(dest='command', required=True)
+    b = commands.add_parser('batch', help='process all subject folders of a directory')
+    stages = b.add_subparsers(dest='stage', required=True, metavar='stage')
+
+    def stage(name, help, task=None, finish=None, run=run_tasks):
+        s = stages.add_parser(name, help=help)
+        s.add_argument('--base-dir', required=True, help='directory of subject folders')
+        s.add_argument('-j', '--jobs', type=int, default=batch_processing.default_workers(),
+                       help='number of parallel workers, defaults to SYNCT_BATCH_WORKERS or the CPU count')
+        s.set_defaults(task=task, finish=finish, run=run)
+        return s
+
+    def series_options(s):
+        s.add_argument('--description', help='regular expression selecting series by description')
+        s.add_argument('--min-slices', type=int, help='minimum number of slices of the series')
+        s.add_argument('--max-slices', type=int, help='maximum number of slices of the series')
+        s.add_argument('--min-thickness', type=float, help='minimum slice thickness in mm')
+        s.add_argument('--max-thickness', type=float, help='maximum slice thickness in mm')
+        s.add_argument('--index', help='DICOM index database, defaults to SYNCT_DICOM_INDEX or the user cache')
+
+    def dicom_stage(name, help, task):
+        s = stage(name, help, task=task)
+        s.add_argument('--dicom-dir', required=True, help='DICOM folder')
+        s.add_argument('--output-dir', required=True, help='output path, receiving one folder per subject')
+        s.add_argument('--dicom2nifti', action='store_true', help='convert with dicom2nifti instead of decoding slices in threads')
+        series_options(s)
+        return s
+
+    s = dicom_stage('dicom-ct', 'convert CT DICOM series to NIfTI', task=dicom_ct_task)
+    s.add_argument('--output', default='ct.nii', help='output file, defaults to ct.nii')
+
+    s = dicom_stage('dicom-pet', 'convert PET DICOM series to SUV NIfTI', task=dicom_pet_task)
+    s.add_argument('--output', default='pet.nii', help='output file, defaults to pet.nii')
+    s.add_argument('--suv-mode', choices=('slope', 'float32'), default='slope',
+                   help='store the SUV factor in scl_slope, or float32 SUV data for tools ignoring it')
+
+    s = stage('ct-clip', 'clip CT intensities to a window', task=ct_clip_task)
+    s.add_argument('--input', required=True, help='input image file')
+    s.add_argument('--min', type=float, required=True, help='lower threshold')
+    s.add_argument('--max', type=float, required=True, help='upper threshold')
+    s.add_argument('--normalize', action='store_true', help='min-max normalize after clipping')
+    s.add_argument('--dtype', choices=('float32', 'uint8', 'uint16'), default='float32',
+                   help='output type, integer types are quantized with scl_slope, defaults to float32')
+    s.add_argument('--output', required=True, help='output image file')
+
+    s = stage('skull-strip', 'skull-strip images with SynthStrip', task=skull_strip_task)
+    s.add_argument('--input', required=True, help='input image file')
+    s.add_argument('--output', required=True, help='stripped image file')
+    s.add_argument('--mask', help='brain mask file')
+    s.add_argument('--model', help='SynthStrip weights path, or a model exported with export-synthstrip')
+    s.add_argument('--no-csf', action='store_true', help='exclude CSF from the brain border')
+    s.add_argument('--precision', choices=('float32', 'bfloat16'), default='float32',
+                   help='inference precision, bfloat16 needs CPU support, defaults to float32')
+
+    s = stage('mask', 'apply a brain mask to images', task=mask_task)
+    s.add_argument('--input', required=True, help='input image file')
+    s.add_argument('--mask', required=True, help='mask file')
+    s.add_argument('--output', required=True, help='output image file')
+
+    s = stage('space', 'resample images into network space', task=space_task)
+    s.add_argument('--input', required=True, help='input image file')
+    s.add_argument('--fixed', required=True, help='fixed image path')
+    s.add_argument('--shape', type=parse_ints, default=(192, 192, 192), help='network shape, defaults to 192,192,192')
+    s.add_argument('--voxsize', type=parse_ints, default=(1, 1, 1), help='network voxel size, defaults to 1,1,1')
+    s.add_argument('--method', choices=('linear', 'nearest'), default='nearest', help='interpolation, defaults to nearest')
+    s.add_argument('--output', required=True, help='output image file')
+
+    s = stage('register', 'register images to a fixed image with SynthMorph', run=run_register)
+    s.add_argument('--input', required=True, help='moving image file')
+    s.add_argument('--fixed', required=True, help='fixed image path')
+    s.add_argument('--output', required=True, help='moved image file')
+    s.add_argument('--field', help='transform file')
+    s.add_argument('--model', choices=('joint', 'deform', 'affine', 'rigid'), default='deform',
+                   help='transformation model, defaults to deform, the only one with bundled weights')
+    s.add_argument('--batch-size', type=int, default=4, help='image pairs per forward pass, defaults to 4')
+    s.add_argument('--mem-limit', type=float, help='memory budget for batched inference in GiB')
+    s.add_argument('--cache-dir', help='directory caching fixed images in network space')
+    s.add_argument('--xla', action='store_true', help='compile inference with XLA, faster on the CPU for large images')
+    s.add_argument('--precision', choices=('float32', 'bfloat16', 'int8'), default='float32',
+                   help='inference precision, int8 requires `mri_synthmorph compile -q`, defaults to float32')
+
+    s = stage('apply', 'apply SynthMorph transforms to images', task=apply_task)
+    s.add_argument('--input', required=True, help='input image file')
+    s.add_argument('--field', required=True, help='transform file')
+    s.add_argument('--method', choices=('linear', 'nearest'), default='linear', help='interpolation, defaults to linear')
+    s.add_argument('--output', required=True, help='output image file')
+
+    s = stage('dice', 'compute Dice overlap of label maps', task=dice_task, finish=dice_finish)
+    s.add_argument('--label1', required=True, help='first label map file')
+    s.add_argument('--label2', required=True, help='second label map file')
+    s.add_argument('--labels', type=parse_ints, required=True, help='comma-separated labels')
+    s.add_argument('--output', required=True, help='Excel table path')
+
+    s = stage('suvr', 'compute regional SUVR', task=suvr_task, finish=suvr_finish)
+    s.add_argument('--input', required=True, help='PET image file')
+    s.add_argument('--label-image', required=True, help='label map path')
+    s.add_argument('--labels', type=parse_ints, required=True, help='comma-separated labels')
+    s.add_argument('--label-output', help='file saving the label map resampled to PET space')
+    s.add_argument('--output', required=True, help='Excel table path')
+
+    s = stage('suvr-mapping', 'normalize PET images by a reference region', task=suvr_mapping_task)
+    s.add_argument('--input', required=True, help='PET image file')
+    s.add_argument('--mask', required=True, help='reference region mask file')
+    s.add_argument('--output', required=True, help='SUVR image file')
+
+    s = commands.add_parser('export-synthstrip', help='export SynthStrip to TorchScript or ONNX')
+    s.add_argument('output', help='exported file, .onnx for ONNX or .ts for TorchScript')
+    s.add_argument('--model', help='SynthStrip checkpoint, defaults to the installed weights')
+    s.add_argument('--no-csf', action='store_true', help='export the weights excluding CSF from the brain border')
+    s.add_argument('--shape', type=parse_ints, default=(192, 192, 192), help='tracing shape, defaults to 192,192,192')
+    s.add_argument('--no-check', action='store_true', help='skip comparing the exported and eager models')
+    s.add_argument('--atol', type=float, default=1e-3, help='largest SDT difference the check accepts, defaults to 1e-3')
+
+    s = commands.add_parser('benchmark-dicom', help='time and compare the DICOM converters on a series')
+    s.add_argument('dicom_dir', help='DICOM folder')
+    s.add_argument('--modality', default='CT', choices=('CT', 'PT'), help='modality of the series, defaults to CT')
+    s.add_argument('--repeat', type=int, default=3, help='conversions per converter, defaults to 3')
+    s.add_argument('--atol', type=float, default=1e-3, help='largest relative difference accepted, defaults to 1e-3')
+    series_options(s)
+
+    s = commands.add_parser('benchmark-synthmorph', help='time and compare SynthMorph inference paths on an image pair')
+    s.add_argument('moving', help='moving image')
+    s.add_argument('fixed', help='fixed image')
+    s.add_argument('--model', choices=('joint', 'deform', 'affine', 'rigid'), default='deform',
+                   help='transformation model, defaults to deform, the only one with bundled weights')
+    s.add_argument('--extent', type=int, nargs='+', choices=(192, 256), default=(192, 256),
+                   help='extents of the registration space, defaults to 192 and 256')
+    s.add_argument('--steps', type=int, default=7, help='integration steps, defaults to 7')
+    s.add_argument('--repeat', type=int, default=3, help='runs per inference path, defaults to 3')
+    s.add_argument('--atol', type=float, default=1e-2,
+                   help='largest XLA transform difference accepted, in voxels, defaults to 1e-2')
+    s.add_argument('--precision', nargs='+', choices=('bfloat16', 'int8'), default=(),
+                   help='reduced precisions to compare with float32')
+    s.add_argument('--labels', help='label map of the moving image, for the Dice overlap of reduced precisions')
+
+    s = commands.add_parser('watch', help='convert DICOM series as they arrive in an inbox folder')
+    s.add_argument('inbox', help='folder receiving DICOM files')
+    s.add_argument('--output-dir', required=True, help='output path, receiving one folder per patient')
+    s.add_argument('--ct-output', default='ct.nii', help='CT output file, defaults to ct.nii')
+    s.add_argument('--pet-output', default='pet.nii', help='PET output file, defaults to pet.nii')
+    s.add_argument('--settle', type=float, default=60, help='seconds a series must stay unchanged, defaults to 60')
+    s.add_argument('--interval', type=float, default=10, help='seconds between polls, defaults to 10')
+    s.add_argument('-j', '--jobs', type=int, default=batch_processing.default_workers(),
+                   help='number of parallel conversions, defaults to SYNCT_BATCH_WORKERS or the CPU count')
+    s.add_argument('--pipeline', help='pipeline file run over the output directory after conversions')
+    s.add_argument('--suv-mode', choices=('slope', 'float32'), default='slope',
+                   help='store the SUV factor in scl_slope, or float32 SUV data for tools ignoring it')
+    s.add_argument('--dicom2nifti', action='store_true', help='convert with dicom2nifti instead of decoding slices in threads')
+    series_options(s)
+
+    s = commands.add_parser('pipeline', help='run the stages of a pipeline file that are out of date')
+    s.add_argument('config', help='pipeline file, TOML or YAML')
+    s.add_argument('--base-dir', help='directory of subject folders, overriding the pipeline file')
+    s.add_argument('-j', '--jobs', type=int, help='number of parallel workers, overriding the pipeline file')
+    s.add_argument('--force', nargs='+', default=(), metavar='stage', help='rerun stages even if up to date')
+    s.add_argument('-n', '--dry-run', action='store_true', help='list out-of-date stages without running them')
+
+    return p
+
+
+def main(argv=None):
+    arg = parser().parse_args(argv)
+
+    if arg.command == 'pipeline':
+        import pipeline
+        return pipeline.main(arg)
+
+    if arg.command == 'export-synthstrip':
+        return export_synthstrip(arg)
+
+    if arg.command == 'benchmark-dicom':
+        return benchmark_dicom(arg)
+
+    if arg.command == 'benchmark-synthmorph':
+        return benchmark_synthmorph(arg)
+
+    if arg.command == 'watch':
+        import watch
+        return watch.main(arg)
+
+    if not os.path.isdir(arg.base_dir):
+        print(f'Base directory does not exist: {arg.base_dir}', file=sys.stderr)
+        return 1
+
+    subjects = batch_processing.list_subjects(arg.base_dir)
+    if not subjects:
+        print(f'No subject folders in {arg.base_dir}', file=sys.stderr)
+        return 1
+
+    errors = arg.run(arg, subjects)
+    for subject, e in errors.items():
+        print(f'Failed {subject}: {e}', file=sys.stderr)
+
+    print(f'Completed {arg.stage}: {len(subjects)} subjects, {len(errors)} failed')
+    return 1 if errors else 0
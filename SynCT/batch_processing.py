@@ -0,0 +1,203 @@
+import os
+import sys
+import time
+import multiprocessing
+import concurrent.futures
+
+
+def list_subjects(base_dir):
+    """Sorted names of the subject folders in a base directory."""
+    subdirs = [d for d in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, d))]
+    subdirs.sort()
+    return subdirs
+
+
+def default_workers():
+    """Number of worker processes, from SYNCT_BATCH_WORKERS or the CPU count."""
+    workers = os.environ.get('SYNCT_BATCH_WORKERS')
+    if workers:
+        return max(1, int(workers))
+    return os.cpu_count() or 1
+
+
+def init_worker(threads):
+    """Limit the threads of numerical libraries in a worker process.
+
+    Every worker processes a subject of its own, so that letting each one use
+    all cores would oversubscribe the machine.
+
+    """
+    threads = str(threads)
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS'):
+        os.environ[var] = threads
+
+
+def process_context():
+    """Multiprocessing context for worker processes.
+
+    Workers are spawned rather than forked, as forking a process that already
+    initialized Qt or TensorFlow is unsafe. Inside Slicer, `sys.executable`
+    may be the application itself, which cannot run a worker. Use the
+    PythonSlicer launcher next to it instead.
+
+    """
+    ctx = multiprocessing.get_context('spawn')
+
+    exe = os.path.basename(sys.executable).lower()
+    if 'python' not in exe:
+        ext = '.exe' if sys.platform == 'win32' else ''
+        launcher = os.path.join(os.path.dirname(sys.executable), f'PythonSlicer{ext}')
+        if os.path.isfile(launcher):
+            ctx.set_executable(launcher)
+
+    return ctx
+
+
+class BatchExecutor:
+    """Run one task per subject on a pool of workers.
+
+    Tasks are submitted under a key, usually the subject folder name. Results
+    and exceptions are collected by `poll`, which never blocks. A GUI calls it
+    from a timer, and headless callers use `run`.
+
+    Parameters
+    ----------
+    workers : int, optional
+        Number of workers. Defaults to `default_workers()`.
+    processes : bool, optional
+        Run tasks in worker processes. Threads are only useful for tasks that
+        release the GIL or share state that cannot be pickled, such as a
+        loaded network.
+    persistent : bool, optional
+        Keep the pool open when all tasks finished, for callers that submit
+        tasks as earlier ones complete. They call `shutdown` when done.
+
+    """
+
+    def __init__(self, workers=None, processes=True, persistent=False):
+        self.workers = workers or default_workers()
+        if processes:
+            threads = max(1, (os.cpu_count() or 1) // self.workers)
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=process_context(),
+                initializer=init_worker,
+                initargs=(threads,),
+            )
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+
+        self.persistent = persistent
+        self.futures = {}
+        self.total = 0
+        self.results = {}
+        self.errors = {}
+        self.cancelled = False
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Queue `fn(*args, **kwargs)` for the subject `key`."""
+        self.futures[self.executor.submit(fn, *args, **kwargs)] = key
+        self.total += 1
+
+    def poll(self):
+        """Collect finished tasks.
+
+        Returns
+        -------
+        done : int
+            Number of finished, failed, or cancelled tasks.
+        total : int
+            Number of submitted tasks.
+
+        """
+        for future in [f for f in self.futures if f.done()]:
+            key = self.futures.pop(future)
+            if future.cancelled():
+                continue
+            e = future.exception()
+            if e is None:
+                self.results[key] = future.result()
+            else:
+                print(f'Error processing {key}: {e}')
+                self.errors[key] = e
+
+        if self.finished and not self.persistent:
+            self.shutdown()
+
+        return self.total - len(self.futures), self.total
+
+    @property
+    def finished(self):
+        return not self.futures
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def cancel(self):
+        """Drop all tasks that have not started. Running tasks complete."""
+        self.cancelled = True
+        for future in self.futures:
+            future.cancel()
+
+    def run(self, callback=None, interval=0.2):
+        """Wait for all tasks, calling `callback(done, total)` on progress.
+
+        Returns
+        -------
+        results, errors : dict
+            Task results and exceptions by key.
+
+        """
+        last = None
+        while True:
+            done, total = self.poll()
+            if callback is not None and done != last:
+                callback(done, total)
+                last = done
+            if self.finished:
+                break
+            time.sleep(interval)
+
+        return self.results, self.errors
+
+
+# Tasks without a Slicer scene, for worker processes.
+def synthstrip(image, output=None, mask=None, model=None, threads=None, no_csf=False, precision='float32'):
+    """Skull-strip an image with the SynthStrip engine of this process.
+
+    The first call in a worker loads the model, later calls reuse it.
+
+    """
+    import synthstrip_engine
+
+    engine = synthstrip_engine.get_engine(model=model, no_csf=no_csf, threads=threads, precision=precision)
+    engine.run(image, out=output, mask=mask)
+    return output
+
+
+def synthmorph_apply(trans, image, output, method='linear', dtype='float32', fill=0):
+    """Apply a SynthMorph transform to an image, as `mri_synthmorph apply`."""
+    import surfa as sf
+
+    which = 'affine' if str(trans).endswith('.lta') else 'warp'
+    trans = getattr(sf, f'load_{which}')(trans)
+    sf.load_volume(image).transform(trans, method=method, resample=True, fill=fill).astype(dtype).save(output)
+    return output
+
+
+def synthmorph_register(engine, jobs, batch_size=1, mem_limit=None):
+    """Register a group of subjects with a loaded `RegistrationEngine`.
+
+    The engine holds the network, so this task runs in a thread. Jobs are
+    `(moving, fixed, kwargs)` tuples, as accepted by `engine.submit`.
+
+    Returns
+    -------
+    errors : dict
+        Exception raised by each failed job, keyed by moving-image path.
+
+    """
+    for moving, fixed, kwargs in jobs:
+        engine.submit(moving, fixed, **kwargs)
+    return engine.run(batch_size=batch_size, mem_limit=mem_limit)
@@ -4,26 +4,66 @@ os.environ['NEURITE_BACKEND'] = 'pytorch'
 os.environ['VXM_BACKEND'] = 'pytorch'
 
 import numpy as np
-import torch
 import voxelmorph as vxm
-import nibabel as nib
+
+import label_stats
 
 
 def dice_compute(moving_path, fixed_path, labels):
     moving_seg = vxm.py.utils.load_volfile(moving_path)
     fixed_seg = vxm.py.utils.load_volfile(fixed_path)
 
-    moving_seg = np.expand_dims(np.expand_dims(moving_seg, axis=0), axis=4)
-    moving_seg = torch.from_numpy(moving_seg).float().permute(0, 4, 1, 2, 3)
-    fixed_seg = np.expand_dims(np.expand_dims(fixed_seg, axis=0), axis=4)
-    fixed_seg = torch.from_numpy(fixed_seg).float().permute(0, 4, 1, 2, 3)
-
-    overlap = vxm.py.utils.dice(moving_seg.cpu().numpy(), fixed_seg.cpu().numpy(), labels=labels)
+    # 与vxm.py.utils.dice一致，不计算标签0；所有标签一次遍历完成
+    labels = [label for label in labels if label != 0]
+    overlap = label_stats.dice(moving_seg, fixed_seg, labels)
 
     # print('Dice: %.4f +/- %.4f' % (np.mean(overlap), np.std(overlap)))
     return (np.mean(overlap), np.std(overlap))
 
 
+def save_dice_results(subdirs, dice_results, label_maps, output_path):
+    """按子文件夹顺序将Dice结果保存到Excel文件"""
+    import pandas as pd
+
+    # 准备结果数据结构
+    results = {
+        'Folder': [],
+        'Label_Maps': [],
+        'Dice_Mean': [],
+        'Dice_Std': []
+    }
+
+    for subdir in subdirs:
+        if subdir not in dice_results:
+            continue
+        dice_result = dice_results[subdir]
+        print('%s Dice: %.4f +/- %.4f' % (subdir, dice_result[0], dice_result[1]))
+
+        results['Folder'].append(subdir)
+        results['Label_Maps'].append(str(label_maps))
+        results['Dice_Mean'].append(float(dice_result[0]))
+        results['Dice_Std'].append(float(dice_result[1]))
+
+    # 保存结果到Excel文件
+    df = pd.DataFrame(results)
+
+    # 使用openpyxl引擎以支持格式设置
+    with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name='Dice_Results')
+
+        # 获取工作表对象进行格式设置
+        worksheet = writer.sheets['Dice_Results']
+
+        # 设置列宽
+        worksheet.column_dimensions['A'].width = 20
+        worksheet.column_dimensions['B'].width = 20
+        worksheet.column_dimensions['C'].width = 15
+        worksheet.column_dimensions['D'].width = 12
+        worksheet.column_dimensions['E'].width = 12
+
+    print(f"结果已保存到: {output_path}")
+
+
 
 
 # if __name__ == "__main__":
@@ -0,0 +1,195 @@
+"""Conversion of a single DICOM series to a NIfTI volume.
+
+Slices are decoded in a thread pool straight into a preallocated array,
+rescaled in the same pass, and the affine is computed from the position and
+orientation of the slices. Compressed transfer syntaxes are decoded by the
+pixel data handlers installed for pydicom.
+"""
+
+import concurrent.futures
+
+import nibabel as nib
+import numpy as np
+import pydicom
+
+
+# Tags needed for the geometry and scaling of a slice
+geometry_tags = [
+    'ImagePositionPatient', 'ImageOrientationPatient', 'PixelSpacing', 'Rows', 'Columns', 'NumberOfFrames',
+    'SamplesPerPixel', 'BitsAllocated', 'BitsStored', 'PixelRepresentation', 'RescaleSlope', 'RescaleIntercept',
+]
+
+
+def read_geometry(path):
+    return pydicom.dcmread(path, stop_before_pixels=True, specific_tags=geometry_tags)
+
+
+def slice_order(headers, tolerance=0.1):
+    """Sort slices along the normal of their common orientation.
+
+    Parameters
+    ----------
+    headers : list of pydicom.Dataset
+        Slice headers.
+    tolerance : float, optional
+        Allowed deviation of slice spacing and orientation, in millimeters.
+
+    Returns
+    -------
+    order : np.ndarray
+        Indices of the headers, from the first slice to the last.
+    position : np.ndarray
+        Sorted slice positions in LPS coordinates, of shape (N, 3).
+    orientation : np.ndarray
+        Row and column direction cosines, of shape (6,).
+
+    """
+    if len(headers) < 2:
+        raise ValueError('a volume needs at least two slices')
+
+    if any('ImagePositionPatient' not in h or 'ImageOrientationPatient' not in h for h in headers):
+        raise ValueError('slices lack position or orientation')
+
+    orientation = np.asarray(headers[0].ImageOrientationPatient, dtype=np.float64)
+    for h in headers:
+        if h.get('NumberOfFrames', 1) not in (None, '', 1, '1'):
+            raise ValueError('multi-frame images are not supported')
+        if np.abs(np.asarray(h.ImageOrientationPatient, dtype=np.float64) - orientation).max() > 1e-3:
+            raise ValueError('slices differ in orientation')
+
+    normal = np.cross(orientation[:3], orientation[3:])
+    position = np.asarray([h.ImagePositionPatient for h in headers], dtype=np.float64)
+    order = np.argsort(position @ normal, kind='stable')
+    position = position[order]
+
+    # Slices must be distinct and evenly spaced, and stacked along the normal
+    step = np.diff(position, axis=0)
+    gap = step @ normal
+    if gap.min() < tolerance:
+        raise ValueError('slices overlap, the series holds more than one volume')
+    if np.abs(step - step.mean(axis=0)).max() > tolerance:
+        raise ValueError('slices are not evenly spaced')
+
+    return order, position, orientation
+
+
+def series_affine(position, orientation, spacing):
+    """RAS affine of a volume indexed by (column, row, slice).
+
+    Parameters
+    ----------
+    position : np.ndarray
+        Sorted slice positions in LPS coordinates, of shape (N, 3).
+    orientation : np.ndarray
+        Row and column direction cosines.
+    spacing : sequence of float
+        PixelSpacing, the distance between rows and between columns.
+
+    """
+    affine = np.eye(4)
+    affine[:3, 0] = orientation[:3] * float(spacing[1])
+    affine[:3, 1] = orientation[3:] * float(spacing[0])
+    affine[:3, 2] = (position[-1] - position[0]) / (len(position) - 1)
+    affine[:3, 3] = position[0]
+
+    # DICOM patient coordinates are LPS
+    affine[:2] *= -1
+    return affine
+
+
+def load_series(files, scale=None, threads=None, dtype=None, keep_raw=False, axcodes=('L', 'A', 'S')):
+    """Load a DICOM series as a NIfTI image.
+
+    Parameters
+    ----------
+    files : list of str
+        Files of the series, in any order.
+    scale : float, optional
+        Factor applied after rescaling, such as the SUV factor of PET.
+    threads : int, optional
+        Threads reading and decoding slices.
+    dtype : np.dtype, optional
+        Output type. Defaults to int16 for integer data that fits, such as
+        CT, and float32 otherwise.
+    keep_raw : bool, optional
+        Keep the stored integers and write the rescaling, including the
+        scale, to scl_slope and scl_inter. When slices differ in rescaling,
+        as PET slices often do, the rescaled data are saved as int16 with a
+        common slope chosen by nibabel.
+    axcodes : tuple of str, optional
+        Orientation of the output axes, LAS as written by dicom2nifti.
+
+    Returns
+    -------
+    nib.Nifti1Image
+
+    """
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        headers = list(executor.map(read_geometry, files))
+        order, position, orientation = slice_order(headers)
+        headers = [headers[i] for i in order]
+        files = [files[i] for i in order]
+
+        first = headers[0]
+        rows, cols = int(first.Rows), int(first.Columns)
+        if any(int(h.Rows) != rows or int(h.Columns) != cols for h in headers):
+            raise ValueError('slices differ in size')
+        if int(first.get('SamplesPerPixel', 1)) != 1:
+            raise ValueError('color images are not supported')
+
+        slope = np.asarray([float(h.get('RescaleSlope', 1) or 1) for h in headers])
+        inter = np.asarray([float(h.get('RescaleIntercept', 0) or 0) for h in headers])
+        if scale is not None:
+            slope = slope * scale
+            inter = inter * scale
+
+        # Stored integers with a rescaling common to all slices
+        header_scaling = None
+        if keep_raw and np.ptp(slope) == 0 and np.ptp(inter) == 0:
+            signed = int(first.get('PixelRepresentation', 0)) == 1
+            dtype = np.dtype(f'{"i" if signed else "u"}{int(first.get("BitsAllocated", 16)) // 8}')
+            header_scaling = (slope[0], inter[0])
+            slope = np.ones_like(slope)
+            inter = np.zeros_like(inter)
+
+        if dtype is None:
+            dtype = np.float32
+            bits = int(first.get('BitsStored', 16))
+            signed = int(first.get('PixelRepresentation', 0)) == 1
+            low, high = (-(1 << bits - 1), (1 << bits - 1) - 1) if signed else (0, (1 << bits) - 1)
+            info = np.iinfo(np.int16)
+            if (slope == 1).all() and (inter == np.round(inter)).all() \
+                    and low + inter.min() >= info.min and high + inter.max() <= info.max:
+                dtype = np.int16
+
+        # Slices of the C-ordered array are contiguous, for decoding in place
+        data = np.empty((len(files), rows, cols), dtype=dtype)
+
+        def decode(k):
+            pixels = pydicom.dcmread(files[k]).pixel_array
+            if slope[k] == 1:
+                data[k] = pixels
+            else:
+                np.multiply(pixels, slope[k], out=data[k], casting='unsafe')
+            if inter[k] != 0:
+                data[k] += data.dtype.type(inter[k])
+
+        list(executor.map(decode, range(len(files))))
+
+    # Transposing gives the (column, row, slice) layout in Fortran order
+    affine = series_affine(position, orientation, first.PixelSpacing)
+    image = nib.Nifti1Image(data.transpose(2, 1, 0), affine)
+
+    ornt = nib.orientations.ornt_transform(
+        nib.orientations.io_orientation(affine), nib.orientations.axcodes2ornt(axcodes))
+    image = image.as_reoriented(ornt)
+    image.header.set_xyzt_units(2)
+    if header_scaling is not None:
+        image.header.set_slope_inter(*header_scaling)
+    elif keep_raw:
+        # Unset scaling lets nibabel choose the slope when saving
+        image.set_data_dtype(np.int16)
+        image.header.set_slope_inter(None, None)
+    else:
+        image.header.set_slope_inter(1, 0)
+    return image
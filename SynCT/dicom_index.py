@@ -0,0 +1,317 @@
+"""Persistent index of DICOM series in study folders.
+
+Reads only the headers of DICOM files, in threads, and records patient,
+study, series and radiopharmaceutical tags in an SQLite database. Updating
+the index re-reads only files whose size or modification time changed, so
+that converters can look series up instead of opening files.
+"""
+
+import os
+import re
+import json
+import sqlite3
+import concurrent.futures
+
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+
+# Header tags read from every file
+file_tags = [
+    'PatientID', 'StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID', 'Modality', 'SeriesNumber',
+    'SeriesDescription', 'SliceThickness', 'InstanceNumber', 'AcquisitionTime', 'SeriesTime', 'PatientWeight',
+    'Units', 'DecayCorrection', 'RescaleSlope', 'RescaleIntercept', 'RadiopharmaceuticalInformationSequence',
+]
+
+# Bumped when the indexed tags change, which discards older indexes
+version = 2
+
+schema = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER,
+    size INTEGER,
+    series_uid TEXT,
+    instance_number INTEGER,
+    acquisition_time TEXT
+);
+CREATE INDEX IF NOT EXISTS files_series ON files (series_uid);
+CREATE TABLE IF NOT EXISTS series (
+    series_uid TEXT PRIMARY KEY,
+    patient_id TEXT,
+    study_uid TEXT,
+    modality TEXT,
+    description TEXT,
+    header TEXT
+);
+'''
+
+
+def default_index_path():
+    """Index database, from SYNCT_DICOM_INDEX or in the user cache folder."""
+    path = os.environ.get('SYNCT_DICOM_INDEX')
+    if path:
+        return path
+    return os.path.join(os.path.expanduser('~'), '.cache', 'SynCT', 'dicom_index.sqlite')
+
+
+def text(value):
+    return None if value is None else str(value)
+
+
+def number(value):
+    try:
+        return None if value is None or value == '' else float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def read_header(path):
+    """Series-level tags of a DICOM file, or None if it is not DICOM."""
+    try:
+        ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=file_tags)
+    except (InvalidDicomError, OSError, ValueError):
+        return None
+
+    series_uid = ds.get('SeriesInstanceUID')
+    if series_uid is None:
+        return None
+
+    header = dict(
+        PatientID=text(ds.get('PatientID')),
+        StudyInstanceUID=text(ds.get('StudyInstanceUID')),
+        SeriesInstanceUID=str(series_uid),
+        Modality=text(ds.get('Modality')),
+        SeriesNumber=number(ds.get('SeriesNumber')),
+        SeriesDescription=text(ds.get('SeriesDescription')),
+        SliceThickness=number(ds.get('SliceThickness')),
+        InstanceNumber=number(ds.get('InstanceNumber')),
+        # Type 2 element, may be present but empty
+        AcquisitionTime=text(ds.get('AcquisitionTime')) or None,
+        SeriesTime=text(ds.get('SeriesTime')),
+        PatientWeight=number(ds.get('PatientWeight')),
+        Units=text(ds.get('Units')),
+        DecayCorrection=text(ds.get('DecayCorrection')),
+        RescaleSlope=number(ds.get('RescaleSlope')),
+        RescaleIntercept=number(ds.get('RescaleIntercept')),
+    )
+
+    # Radiopharmaceutical tags of PET series
+    sequence = ds.get('RadiopharmaceuticalInformationSequence')
+    if sequence:
+        item = sequence[0]
+        header.update(
+            RadionuclideTotalDose=number(item.get('RadionuclideTotalDose')),
+            RadiopharmaceuticalStartTime=text(item.get('RadiopharmaceuticalStartTime')),
+            RadiopharmaceuticalStartDateTime=text(item.get('RadiopharmaceuticalStartDateTime')),
+            RadionuclideHalfLife=number(item.get('RadionuclideHalfLife')),
+        )
+
+    return header
+
+
+def matches(header, description=None, min_slices=None, max_slices=None, min_thickness=None, max_thickness=None):
+    """Check if a series satisfies selection criteria.
+
+    Parameters
+    ----------
+    header : dict
+        Series tags, with the number of files under 'files'.
+    description : str, optional
+        Regular expression searched in SeriesDescription, ignoring case.
+    min_slices, max_slices : int, optional
+        Range of the number of files.
+    min_thickness, max_thickness : float, optional
+        Range of SliceThickness in millimeters. Series without the tag do
+        not match a range.
+
+    """
+    if description and not re.search(description, header.get('SeriesDescription') or '', re.IGNORECASE):
+        return False
+
+    slices = header.get('files', 0)
+    if min_slices is not None and slices < min_slices:
+        return False
+    if max_slices is not None and slices > max_slices:
+        return False
+
+    if min_thickness is not None or max_thickness is not None:
+        thickness = header.get('SliceThickness')
+        if thickness is None:
+            return False
+        if min_thickness is not None and thickness < min_thickness:
+            return False
+        if max_thickness is not None and thickness > max_thickness:
+            return False
+
+    return True
+
+
+class DicomIndex:
+    """SQLite index of DICOM files and series.
+
+    Parameters
+    ----------
+    path : str, optional
+        Database file, defaults to `default_index_path()`.
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_index_path()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.db = sqlite3.connect(self.path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != version:
+            self.db.executescript(f'DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS series; PRAGMA user_version = {version};')
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def under(directory):
+        """Range of indexed paths inside a directory, for a primary-key scan."""
+        prefix = os.path.join(os.path.abspath(directory), '')
+        return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+    def update(self, root, threads=None, callback=None):
+        """Index the DICOM files below a folder.
+
+        Only files that are new or whose size or modification time changed
+        are read. Files that disappeared are dropped.
+
+        Parameters
+        ----------
+        root : str
+            Folder to index.
+        threads : int, optional
+            Threads reading headers. Defaults to the CPU count.
+        callback : callable, optional
+            Called with `(done, total)` as files are read.
+
+        Returns
+        -------
+        changed : int
+            Number of files read.
+
+        """
+        low, high = self.under(root)
+        known = {
+            path: (mtime_ns, size) for path, mtime_ns, size in
+            self.db.execute('SELECT path, mtime_ns, size FROM files WHERE path >= ? AND path < ?', (low, high))
+        }
+
+        # Walk the tree, comparing file stamps with the index
+        changed = []
+        for dirpath, dirnames, filenames in os.walk(os.path.abspath(root)):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                stamp = (stat.st_mtime_ns, stat.st_size)
+                if known.pop(path, None) != stamp:
+                    changed.append((path, stamp))
+
+        # Read the headers of new and changed files
+        rows = []
+        series = {}
+        threads = threads or os.cpu_count() or 1
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            headers = executor.map(read_header, [path for path, _ in changed])
+            for i, ((path, stamp), header) in enumerate(zip(changed, headers)):
+                if header is None:
+                    rows.append((path, *stamp, None, None, None))
+                else:
+                    uid = header['SeriesInstanceUID']
+                    rows.append((path, *stamp, uid, header['InstanceNumber'], header['AcquisitionTime']))
+                    series[uid] = header
+                if callback is not None:
+                    callback(i + 1, len(changed))
+
+        with self.db:
+            self.db.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in known])
+            self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self.db.executemany('INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?, ?)', [
+                (uid, h['PatientID'], h['StudyInstanceUID'], h['Modality'], h['SeriesDescription'], json.dumps(h))
+                for uid, h in series.items()
+            ])
+
+        return len(changed)
+
+    def series(self, directory=None, modality=None, **criteria):
+        """Indexed series, optionally those with files in a folder or of a modality.
+
+        Further keyword arguments select series as `matches` does.
+
+        Returns
+        -------
+        list of dict
+            Series tags, with the number of files under 'files' and the latest
+            modification time of a file under 'mtime_ns'. Sorted by patient,
+            study, and series time.
+
+        """
+        query = '''
+            SELECT s.series_uid, s.header, COUNT(f.path), MAX(f.mtime_ns)
+            FROM series s JOIN files f ON f.series_uid = s.series_uid
+        '''
+        where, params = [], []
+        if directory is not None:
+            where.append('f.path >= ? AND f.path < ?')
+            params += self.under(directory)
+        if modality is not None:
+            where.append('s.modality = ?')
+            params.append(modality)
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' GROUP BY s.series_uid'
+
+        out = []
+        for uid, header, count, mtime_ns in self.db.execute(query, params):
+            header = json.loads(header)
+            header['files'] = count
+            header['mtime_ns'] = mtime_ns
+            if matches(header, **criteria):
+                out.append(header)
+
+        out.sort(key=lambda h: (h['PatientID'] or '', h['StudyInstanceUID'] or '', h['SeriesTime'] or ''))
+        return out
+
+    def files(self, series_uid, directory=None):
+        """Files of a series sorted by instance number, optionally in a folder."""
+        query = 'SELECT path FROM files WHERE series_uid = ?'
+        params = [series_uid]
+        if directory is not None:
+            query += ' AND path >= ? AND path < ?'
+            params += self.under(directory)
+        query += ' ORDER BY instance_number, path'
+        return [path for path, in self.db.execute(query, params)]
+
+    def header(self, series_uid):
+        """Series tags for computing SUV.
+
+        AcquisitionTime is the earliest acquisition time of the files, which
+        is the scan start of the series.
+
+        """
+        row = self.db.execute('SELECT header FROM series WHERE series_uid = ?', (series_uid,)).fetchone()
+        if row is None:
+            raise KeyError(f'series {series_uid} is not indexed')
+        header = json.loads(row[0])
+
+        times = [t for t, in self.db.execute(
+            "SELECT acquisition_time FROM files WHERE series_uid = ? AND acquisition_time IS NOT NULL "
+            "AND acquisition_time != ''", (series_uid,))]
+        if times:
+            header['AcquisitionTime'] = min(times, key=lambda t: float(t))
+        return header
+
@@ -0,0 +1,130 @@
+import numpy as np
+
+
+# 多标签区域统计：一次遍历体素，代替逐标签生成全体积掩码
+def label_index(label_data, labels):
+    """
+    将体素标签映射为标签序号
+
+    返回与label_data形状相同的整数数组，值为体素标签在labels中的位置，
+    不属于任何标签的体素为len(labels)。
+    """
+    labels = np.asarray(labels).ravel()
+    data = np.asarray(label_data)
+    n = len(labels)
+    if n == 0 or data.size == 0:
+        return np.full(data.shape, n, dtype=np.intp)
+
+    # 整数标签图像（包括get_fdata读出的浮点数组）直接查表
+    lo, hi = data.min(), data.max()
+    if np.isfinite([lo, hi]).all() and hi - lo < (1 << 24) and (labels == np.round(labels)).all():
+        lo = int(lo)
+        ints = data.astype(np.intp)
+        integral = True if np.issubdtype(data.dtype, np.integer) else (ints == data)
+
+        lut = np.full(int(hi) - lo + 1, n, dtype=np.intp)
+        inside = (labels >= lo) & (labels <= hi)
+        # 重复的标签取第一个位置
+        for i in np.flatnonzero(inside)[::-1]:
+            lut[int(labels[i]) - lo] = i
+
+        ints -= lo
+        index = lut[ints]
+        if integral is not True:
+            index[~integral] = n
+        return index
+
+    order = np.argsort(labels, kind='stable')
+    sorted_labels = labels[order]
+
+    pos = np.searchsorted(sorted_labels, data)
+    pos = np.minimum(pos, n - 1)
+    match = sorted_labels[pos] == data
+
+    return np.where(match, order[pos], n)
+
+
+def regional_stats(label_data, values, labels):
+    """
+    计算每个标签区域内数值的统计量
+
+    NaN体素不参与统计，单独计数。没有有效体素的标签，均值、标准差、最小值和最大值为NaN。
+
+    返回:
+        字典，键为count、nan_count、sum、sumsq、mean、std、min、max，值为按labels顺序的数组
+    """
+    # 重复的标签只统计一次
+    labels, inverse = np.unique(np.asarray(labels).ravel(), return_inverse=True)
+    n = len(labels)
+    index = label_index(label_data, labels).ravel()
+    values = np.asarray(values, dtype=np.float64).ravel()
+    if index.shape != values.shape:
+        raise ValueError(f"Label and value shape mismatch: {np.shape(label_data)} vs {np.shape(values)}")
+
+    # 只保留属于标签的体素
+    inside = index < n
+    index = index[inside]
+    values = values[inside]
+
+    nan = np.isnan(values)
+    nan_count = np.bincount(index[nan], minlength=n)
+    if nan.any():
+        index = index[~nan]
+        values = values[~nan]
+
+    count = np.bincount(index, minlength=n)
+    total = np.bincount(index, weights=values, minlength=n)
+    sumsq = np.bincount(index, weights=values * values, minlength=n)
+
+    minimum = np.full(n, np.inf)
+    maximum = np.full(n, -np.inf)
+    np.minimum.at(minimum, index, values)
+    np.maximum.at(maximum, index, values)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        var = np.maximum(sumsq / count - mean * mean, 0)
+
+    empty = count == 0
+    minimum[empty] = np.nan
+    maximum[empty] = np.nan
+
+    stats = dict(
+        count=count,
+        nan_count=nan_count,
+        sum=total,
+        sumsq=sumsq,
+        mean=mean,
+        std=np.sqrt(var),
+        min=minimum,
+        max=maximum,
+    )
+    return {k: v[inverse] for k, v in stats.items()}
+
+
+def confusion(label_data1, label_data2, labels):
+    """
+    两个标签图像的重叠矩阵
+
+    返回(n + 1, n + 1)的数组，第(i, j)项为第一个图像中标签为labels[i]、
+    第二个图像中标签为labels[j]的体素数，最后一行和列对应其他标签。labels不能重复。
+    """
+    if np.shape(label_data1) != np.shape(label_data2):
+        raise ValueError(f"Label shape mismatch: {np.shape(label_data1)} vs {np.shape(label_data2)}")
+
+    n = len(labels) + 1
+    index1 = label_index(label_data1, labels).ravel()
+    index2 = label_index(label_data2, labels).ravel()
+    return np.bincount(index1 * n + index2, minlength=n * n).reshape(n, n)
+
+
+def dice(label_data1, label_data2, labels):
+    """每个标签的Dice系数，与vxm.py.utils.dice一致"""
+    labels, inverse = np.unique(np.asarray(labels).ravel(), return_inverse=True)
+    overlap = confusion(label_data1, label_data2, labels)
+
+    # 最后一行和列为其他标签，不计算Dice
+    top = 2 * np.diag(overlap)[:-1]
+    bottom = overlap.sum(axis=1)[:-1] + overlap.sum(axis=0)[:-1]
+    bottom = np.maximum(bottom, np.finfo(float).eps)
+    return (top / bottom)[inverse]
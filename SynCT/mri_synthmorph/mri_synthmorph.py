@@ -18,12 +18,14 @@ default = {
     'method': 'linear',
     'type': 'float32',
     'fill': 0,
+    'precision': 'float32',
 }
 choices = {
     'model': ('joint', 'deform', 'affine', 'rigid'),
     'extent': (192, 256),
     'method': ('linear', 'nearest'),
     'type': ('uint8', 'uint16', 'int16', 'int32', 'float32'),
+    'precision': ('float32', 'bfloat16', 'int8'),
 }
 limits = {
     'steps': 5,
@@ -82,6 +84,9 @@ help_general = f'''{prog}
         {b}apply{n}
                 Apply an existing transform to another 3D image or label map.
 
+        {b}compile{n}
+                Save networks for fast loading by later registrations.
+
         {b}-h{n}
                 Print this help text and exit.
 
@@ -204,6 +209,19 @@ help_register = f'''{prog}-register
                 but may crop the anatomy of interest. Defaults to
                 {default['extent']}.
 
+        {b}-x{n}
+                Compile the network, the warp integration, and the conversion
+                of the transforms to the image spaces with XLA. Compiling
+                takes time once, which pays off on the CPU for large images.
+
+        {b}-p{n} {u}precision{n}
+                Inference precision ({', '.join(choices['precision'])}).
+                Defaults to {default['precision']}. Bfloat16 computes in mixed
+                precision on CPUs with bfloat16 instructions. Int8 runs the
+                network quantized by {b}{prog} compile -q{n} with TFLite.
+                Either falls back to float32 if unavailable. Check the accuracy
+                on your data before trading it for speed.
+
         {b}-w{n} {u}weights{n}
                 Use alternative model weights, exclusively. Repeat the flag
                 to set affine and deformable weights for joint registration,
@@ -220,9 +238,16 @@ help_register = f'''{prog}-register
                 select GPU 0. Ignored without {b}-g{n}.
 
         FREESURFER_HOME
-                Load model weights from directory {u}FREESURFER_HOME/models{n}.
+                Load model weights from directory {u}FREESURFER_HOME/models{n},
+                falling back to the weights next to the SynthMorph package.
                 Ignored when specifying weights with {b}-w{n}.
 
+        SYNTHMORPH_MODELS
+                Load networks saved by {b}{prog} compile{n} from this directory
+                instead of the directory {u}compiled{n} next to the SynthMorph
+                package. Networks are built from the weights if there is no
+                up-to-date compiled network for the model, extent, and steps.
+
 {b}EXAMPLES{n}
         Joint affine-deformable registration, saving the moved image:
                 # {prog} register -o out.nii mov.nii fix.nii
@@ -297,13 +322,81 @@ help_apply = f'''{prog}-apply
                 # {prog} apply -m nearest warp.nii labels.nii out.nii
 '''
 
+help_compile = f'''{prog}-compile
+
+{b}NAME{n}
+        {b}{prog}-compile{n} - save SynthMorph networks for fast loading
+
+{b}SYNOPSIS{n}
+        {b}{prog} compile{n} [options]
+
+{b}DESCRIPTION{n}
+        Build SynthMorph networks, load their weights, and save them as
+        TensorFlow SavedModels with a fixed input signature. Registrations
+        with the same model, extent, and integration steps load the saved
+        network instead of constructing it and probing its weight files,
+        which takes a few seconds off their start-up. Saved networks are
+        ignored once their weights or the TensorFlow version change.
+        Deformable models are saved twice, also without the backward
+        transform for registrations that save neither {b}-T{n} nor {b}-O{n}.
+
+        Without options, compiles every model whose weights are found at
+        the default extent and steps. The options are as follows:
+
+        {b}-m{n} {u}model{n}
+                Transformation model ({', '.join(choices['model'])}). Repeat
+                the flag to compile several models.
+
+        {b}-e{n} {u}extent{n}
+                Isotropic extent of the registration space in unit voxels
+                {choices['extent']}. Repeat the flag to compile several
+                extents. Defaults to {default['extent']}.
+
+        {b}-n{n} {u}steps{n}
+                Integration steps for deformable registration. Repeat the flag
+                to compile several step counts. Defaults to {default['steps']}.
+
+        {b}-d{n} {u}dir{n}
+                Save the networks to {u}dir{n}. Defaults to SYNTHMORPH_MODELS or
+                the directory {u}compiled{n} next to the SynthMorph package.
+
+        {b}-c{n}
+                Compare each saved network with the built one on random
+                images, and fail if they differ by more than 1e-4.
+
+        {b}-q{n} {u}image{n}
+                Also quantize the networks to int8 for {b}-p int8{n}, calibrating
+                on {u}image{n} registered to the image of {b}-Q{n}. Repeat the
+                flag to add calibration images. A few representative subjects
+                suffice.
+
+        {b}-Q{n} {u}image{n}
+                Fixed image of the calibration pairs, for example a template.
+
+        {b}-j{n} {u}threads{n}
+                Number of TensorFlow threads. System default if unspecified.
+
+        {b}-h{n}
+                Print this help text and exit.
+
+{b}EXAMPLES{n}
+        Compile all models for the default extent and steps:
+                # {prog} compile
+
+        Compile joint registration at both extents, checking the result:
+                # {prog} compile -m joint -e 192 -e 256 -c
+
+        Quantize joint registration, calibrating on three subjects:
+                # {prog} compile -m joint -Q mni.nii -q s1.nii -q s2.nii -q s3.nii
+'''
+
 
 # Command-line parsing.
 p = argparse.ArgumentParser()
 p.format_help = lambda: utils.rewrap_text(help_general, end='\n\n')
 
 sub = p.add_subparsers(dest='command')
-commands = {f: sub.add_parser(f) for f in ('register', 'apply')}
+commands = {f: sub.add_parser(f) for f in ('register', 'apply', 'compile')}
 
 
 def add_flags(f):
@@ -337,6 +430,8 @@ r.add_argument('-g', dest='gpu', action='store_true')
 r.add_argument('-r', dest='hyper', metavar='lambda', type=float, **add_flags('hyper'))
 r.add_argument('-n', dest='steps', metavar='steps', type=int, **add_flags('steps'))
 r.add_argument('-e', dest='extent', type=int, **add_flags('extent'))
+r.add_argument('-x', dest='xla', action='store_true')
+r.add_argument('-p', dest='precision', **add_flags('precision'))
 r.add_argument('-w', dest='weights', metavar='weights', action='append')
 r.add_argument('-v', dest='verbose', action='store_true')
 r.add_argument('-d', dest='out_dir', metavar='dir', type=pathlib.Path)
@@ -352,6 +447,20 @@ a.add_argument('-t', dest='type', **add_flags('type'))
 a.add_argument('-f', dest='fill', metavar='fill', type=float, **add_flags('fill'))
 a.format_help = lambda: utils.rewrap_text(help_apply, end='\n\n')
 
+# Compilation arguments.
+k = commands['compile']
+k.add_argument('-m', dest='model', action='append', choices=choices['model'],
+               type=lambda x: utils.resolve_abbrev(x, strings=choices['model']))
+k.add_argument('-e', dest='extent', action='append', type=int, choices=choices['extent'])
+k.add_argument('-n', dest='steps', metavar='steps', action='append', type=int)
+k.add_argument('-d', dest='out_dir', metavar='dir')
+k.add_argument('-c', dest='check', action='store_true')
+k.add_argument('-q', dest='calibration', metavar='image', action='append')
+k.add_argument('-Q', dest='calibration_fixed', metavar='image')
+k.add_argument('-j', dest='threads', metavar='threads', type=int)
+k.add_argument('-v', dest='verbose', action='store_true')
+k.format_help = lambda: utils.rewrap_text(help_compile, end='\n\n')
+
 
 # Parse arguments.
 if len(sys.argv) == 1:
@@ -360,7 +469,7 @@ if len(sys.argv) == 1:
 
 # Command resolution.
 c = sys.argv[1] = utils.resolve_abbrev(sys.argv[1], commands)
-if len(sys.argv) == 2 and c in commands:
+if len(sys.argv) == 2 and c in ('register', 'apply'):
     commands[c].print_usage()
     exit(0)
 
@@ -415,6 +524,71 @@ if arg.command == 'apply':
         sf.load_volume(inp).transform(trans, **prop).astype(arg.type).save(out)
 
 
+if arg.command == 'compile':
+
+    # Argument checking.
+    arg.extent = arg.extent or [default['extent']]
+    arg.steps = arg.steps or [default['steps']]
+    if min(arg.steps) < limits['steps']:
+        sf.system.fatal('too few integration steps')
+
+    if bool(arg.calibration) != bool(arg.calibration_fixed):
+        sf.system.fatal('quantization requires both -q and -Q')
+
+    # TensorFlow setup.
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '0' if arg.verbose else '3'
+    os.environ['NEURITE_BACKEND'] = 'tensorflow'
+    os.environ['VXM_BACKEND'] = 'tensorflow'
+    import itertools
+    import tensorflow as tf
+    from synthmorph import registration
+
+    if arg.threads:
+        tf.config.threading.set_inter_op_parallelism_threads(arg.threads)
+        tf.config.threading.set_intra_op_parallelism_threads(arg.threads)
+
+    # Without -m, compile the models whose weights are installed.
+    if not arg.model:
+        arg.model = []
+        for model in choices['model']:
+            _, missing = registration.find_weights(argparse.Namespace(model=model, weights=None))
+            if missing:
+                print(f'Skipping {model}: cannot find weights {", ".join(missing)}')
+            else:
+                arg.model.append(model)
+        if not arg.model:
+            sf.system.fatal('cannot find weights, set environment variable FREESURFER_HOME')
+
+    # Matrix models do not depend on the steps. Deformable models also get a
+    # variant without the backward transform.
+    variants = set()
+    for model, extent, steps in itertools.product(arg.model, arg.extent, arg.steps):
+        is_mat = model in ('affine', 'rigid')
+        variants.add((model, extent, None if is_mat else steps, True))
+        if not is_mat:
+            variants.add((model, extent, steps, False))
+
+    for model, extent, steps, bidir in sorted(variants, key=str):
+        var = argparse.Namespace(model=model, extent=extent, steps=steps, weights=None, bidir=bidir)
+        path = registration.compile_model(var, arg.out_dir)
+        print(f'Saved {path}')
+        if arg.check:
+            diff = registration.parity(var, arg.out_dir)
+            print(f'Largest transform difference to the built network: {diff:.2e}')
+            if diff > 1e-4:
+                sf.system.fatal(f'compiled network {path} differs from the built one')
+
+        if arg.calibration:
+            calibration = []
+            for image in arg.calibration:
+                pair = argparse.Namespace(**vars(var), moving=image, fixed=arg.calibration_fixed, init=None,
+                                          mid_space=False)
+                calibration.append(registration.prepare(pair)['inputs'])
+            path = registration.quantize_model(var, calibration, arg.out_dir)
+            print(f'Saved {path}')
+
+
 print('Thank you for choosing SynthMorph. Please cite us!')
 print(utils.rewrap_text(ref))
 
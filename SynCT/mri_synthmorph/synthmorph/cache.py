@@ -0,0 +1,155 @@
+import os
+import hashlib
+import collections
+import numpy as np
+from synthmorph import registration
+
+
+class TemplateCache:
+    """Cache of fixed images taken to network space.
+
+    Registering many images to the same template resamples and normalizes the
+    template identically every time. This cache stores the network input and
+    the transforms between network and template space in memory and,
+    optionally, on disk. Entries are keyed by a hash of the file content, the
+    network shape, and the network voxel size, so that editing the template
+    or changing the extent invalidates them. Both levels evict the least
+    recently used entries once they exceed their size limit.
+
+    Parameters
+    ----------
+    cache_dir : str or pathlib.Path, optional
+        Directory for persistent entries. None means caching in memory only.
+    max_bytes : int, optional
+        Size limit of the in-memory cache in bytes.
+    max_disk_bytes : int, optional
+        Size limit of the on-disk cache in bytes.
+
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=1024 ** 3, max_disk_bytes=8 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = collections.OrderedDict()
+        self.hashes = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def file_hash(self, path):
+        """Hash file content, reusing the result while size and mtime are unchanged."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        stamp = (path, stat.st_size, stat.st_mtime_ns)
+        if stamp not in self.hashes:
+            h = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+            self.hashes[stamp] = h.hexdigest()
+
+        return self.hashes[stamp]
+
+    def key(self, path, shape, voxsize=1):
+        """Cache key of a template for a network shape and voxel size."""
+        shape = 'x'.join(map(str, shape))
+        return f'{self.file_hash(path)}_{shape}_{voxsize}'
+
+    def get(self, path, fix, shape):
+        """Return a template in network space, computing it on a miss.
+
+        Parameters
+        ----------
+        path : str or pathlib.Path
+            Template file, used for the content hash.
+        fix : surfa.Volume
+            Template loaded from `path`.
+        shape : (3,) array-like
+            Spatial shape of the network space.
+
+        Returns
+        -------
+        out : tuple
+            Same as `registration.prepare_fixed`.
+
+        """
+        key = self.key(path, shape)
+
+        # Memory.
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        # Disk.
+        out = self.load(key)
+        if out is None:
+            net_to_fix, fix_to_net, inp = registration.prepare_fixed(fix, shape=shape)
+            out = (np.asarray(net_to_fix), np.asarray(fix_to_net), np.asarray(inp))
+            self.save(key, out)
+
+        self.entries[key] = out
+        self.evict()
+        return out
+
+    def nbytes(self):
+        return sum(x.nbytes for out in self.entries.values() for x in out)
+
+    def evict(self):
+        """Drop least recently used entries from memory, keeping the newest."""
+        while len(self.entries) > 1 and self.nbytes() > self.max_bytes:
+            self.entries.popitem(last=False)
+
+    def filename(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def load(self, key):
+        if self.cache_dir is None:
+            return None
+
+        f = self.filename(key)
+        try:
+            with np.load(f) as npz:
+                out = (npz['net_to_fix'], npz['fix_to_net'], npz['inp'])
+        except (OSError, KeyError, ValueError):
+            return None
+
+        # Mark as recently used.
+        os.utime(f)
+        return out
+
+    def save(self, key, out):
+        if self.cache_dir is None:
+            return
+
+        # Write atomically, as several processes may share the directory.
+        f = self.filename(key)
+        tmp = f'{f}.{os.getpid()}.tmp'
+        net_to_fix, fix_to_net, inp = out
+        with open(tmp, 'wb') as fp:
+            np.savez(fp, net_to_fix=net_to_fix, fix_to_net=fix_to_net, inp=inp)
+        os.replace(tmp, f)
+        self.evict_disk()
+
+    def evict_disk(self):
+        """Delete least recently used files until the directory fits its limit."""
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npz'):
+                continue
+            f = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(f)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, f))
+
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for _, size, f in files[:-1]:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(f)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,253 @@
+import argparse
+import collections
+import pathlib
+import tensorflow as tf
+from synthmorph import registration
+from synthmorph.cache import TemplateCache
+
+
+# Defaults of `mri_synthmorph register`.
+default = {
+    'model': 'joint',
+    'hyper': 0.5,
+    'extent': 192,
+    'steps': 7,
+}
+
+# Per-job options of `mri_synthmorph register`. The model, extent, integration
+# steps, weights, precision, and XLA compilation are fixed when the engine
+# builds the network.
+job_options = {
+    'out_moving': None,
+    'out_fixed': None,
+    'header_only': False,
+    'trans': None,
+    'inverse': None,
+    'init': None,
+    'mid_space': False,
+    'hyper': default['hyper'],
+    'verbose': False,
+    'out_dir': None,
+}
+
+
+class RegistrationEngine:
+    """Long-lived SynthMorph registration engine.
+
+    Loads the network once, from `mri_synthmorph compile` output if there is
+    one, or else by building it and loading its weights, then registers any
+    number of image pairs with it. Deformable networks are loaded on first
+    use in two variants: jobs that save neither the inverse transform nor
+    the moved fixed image use a network that skips the backward transform.
+    Each job produces the same output files and transforms as a call to
+    `mri_synthmorph register` with the same options, without paying for the
+    TensorFlow import, graph construction, and weight loading again.
+
+    Parameters
+    ----------
+    model : str, optional
+        Transformation model: 'joint', 'deform', 'affine', or 'rigid'.
+    extent : int, optional
+        Isotropic extent of the registration space, 192 or 256.
+    steps : int, optional
+        Integration steps for deformable registration.
+    weights : list of str, optional
+        Alternative model weights. Only the deformable weights ship with
+        the extension, other models need FREESURFER_HOME or weights.
+    threads : int, optional
+        Number of TensorFlow threads. System default if unspecified.
+    cache_dir : str or pathlib.Path, optional
+        Directory persisting fixed images in network space across processes.
+        None means caching them in memory only.
+    xla : bool, optional
+        Run inference and the composition of the outputs compiled with XLA.
+        Compilation happens once per image shape, on the first job of the
+        shape.
+    precision : str, optional
+        Inference precision: 'float32', 'bfloat16' for mixed precision on
+        CPUs with bfloat16 instructions, or 'int8' for the TFLite network
+        saved by `mri_synthmorph compile -q`.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the weights of the model cannot be found.
+
+    """
+
+    def __init__(self, model=default['model'], extent=default['extent'],
+                 steps=default['steps'], weights=None, threads=None,
+                 cache_dir=None, xla=False, precision='float32'):
+        # Threading. TensorFlow only accepts these settings before running
+        # any operation, so they apply to the process and not to a job.
+        if threads:
+            try:
+                tf.config.threading.set_inter_op_parallelism_threads(threads)
+                tf.config.threading.set_intra_op_parallelism_threads(threads)
+            except RuntimeError:
+                print('TensorFlow already initialized, ignoring thread count')
+
+        # Fail before any job is queued rather than on the first batch.
+        _, missing = registration.find_weights(argparse.Namespace(model=model, weights=weights))
+        if missing:
+            raise FileNotFoundError(f'cannot find {model} weights {", ".join(missing)}, set '
+                                    'FREESURFER_HOME or pass weights')
+
+        self.options = dict(model=model, extent=extent, steps=steps,
+                            weights=weights, xla=xla, precision=precision)
+        self.threads = threads
+        self.models = {}
+        self.cache = TemplateCache(cache_dir)
+        self.jobs = collections.deque()
+
+    def network(self, bidir):
+        """Network predicting both transforms or only the forward one.
+
+        Loads the network on first use.
+
+        """
+        if bidir not in self.models:
+            arg = argparse.Namespace(**self.options, threads=self.threads, bidir=bidir)
+            model = registration.load_model(arg)
+            if self.options['xla']:
+                model = registration.xla_model(model)
+            self.models[bidir] = model
+
+        return self.models[bidir]
+
+    def job(self, moving, fixed, **kwargs):
+        """Assemble the arguments of a registration job.
+
+        Parameters
+        ----------
+        moving, fixed : str or pathlib.Path
+            Moving and fixed image paths.
+        **kwargs
+            Options of `mri_synthmorph register` by destination name, for
+            example `out_moving` (-o) or `trans` (-t). See `job_options`.
+
+        Returns
+        -------
+        arg : argparse.Namespace
+            Arguments accepted by `registration.register`.
+
+        """
+        unknown = set(kwargs) - set(job_options)
+        if unknown:
+            raise TypeError(f'unknown registration options: {", ".join(sorted(unknown))}')
+
+        arg = dict(job_options, **kwargs)
+        arg.update(self.options, moving=str(moving), fixed=str(fixed), threads=None)
+
+        # Argument checking, as on the command line.
+        if arg['header_only'] and arg['model'] not in ('affine', 'rigid'):
+            raise ValueError('-H is not compatible with deformable registration')
+        if arg['mid_space'] and not arg['init']:
+            raise ValueError('-M requires matrix initialization')
+        if not 0 < arg['hyper'] < 1:
+            raise ValueError('regularization strength not in open interval (0, 1)')
+
+        if arg['out_dir'] is not None:
+            arg['out_dir'] = pathlib.Path(arg['out_dir'])
+
+        return argparse.Namespace(**arg)
+
+    def register(self, moving, fixed, **kwargs):
+        """Register a moving to a fixed image immediately.
+
+        Parameters
+        ----------
+        moving, fixed : str or pathlib.Path
+            Moving and fixed image paths.
+        **kwargs
+            Options of `mri_synthmorph register`. See `job`.
+
+        """
+        arg = self.job(moving, fixed, **kwargs)
+        try:
+            model = self.network(registration.bidirectional(arg))
+            registration.register(arg, model=model, cache=self.cache)
+        except SystemExit as e:
+            # Surfa reports invalid inputs by exiting, which must not end a
+            # long-lived process.
+            raise RuntimeError(f'registration of {arg.moving} failed') from e
+
+    def submit(self, moving, fixed, **kwargs):
+        """Queue a registration job. See `register`."""
+        self.jobs.append((moving, fixed, kwargs))
+
+    def run(self, callback=None, batch_size=1, mem_limit=None):
+        """Process all queued jobs in order.
+
+        Parameters
+        ----------
+        callback : callable, optional
+            Function called as `callback(i, total, moving)` before each job,
+            or before each batch of jobs.
+        batch_size : int, optional
+            Number of image pairs stacked along the batch axis of the network.
+            Pairs sharing a fixed image resample it to network space once.
+        mem_limit : int, optional
+            Memory budget for batched inference in bytes, further limiting
+            the batch size.
+
+        Returns
+        -------
+        errors : dict
+            Exception raised by each failed job, keyed by moving-image path.
+
+        """
+        if batch_size > 1 or mem_limit is not None:
+            return self.run_batch(callback, batch_size, mem_limit)
+
+        errors = {}
+        total = len(self.jobs)
+        i = 0
+        while self.jobs:
+            moving, fixed, kwargs = self.jobs.popleft()
+            if callback is not None:
+                callback(i, total, moving)
+            try:
+                self.register(moving, fixed, **kwargs)
+            except Exception as e:
+                print(f'Error registering {moving}: {e}')
+                errors[str(moving)] = e
+            i += 1
+
+        return errors
+
+    def run_batch(self, callback=None, batch_size=8, mem_limit=None):
+        """Process all queued jobs in batches. See `run`."""
+        errors = {}
+        args = []
+        while self.jobs:
+            moving, fixed, kwargs = self.jobs.popleft()
+            try:
+                args.append(self.job(moving, fixed, **kwargs))
+            except Exception as e:
+                print(f'Error registering {moving}: {e}')
+                errors[str(moving)] = e
+
+        if not args:
+            return errors
+
+        try:
+            failed = registration.register_batch(
+                args,
+                model=self.network(any(registration.bidirectional(arg) for arg in args)),
+                batch_size=batch_size,
+                mem_limit=mem_limit,
+                callback=callback,
+                cache=self.cache,
+            )
+        except SystemExit as e:
+            # As in `register`, but the whole batch fails together.
+            failed = {}
+            for arg in args:
+                error = RuntimeError(f'registration of {arg.moving} failed')
+                error.__cause__ = e
+                print(f'Error registering {arg.moving}: {error}')
+                failed[arg.moving] = error
+
+        errors.update(failed)
+        return errors
@@ -1,5 +1,13 @@
 import os
+import json
+import argparse
 import h5py
+import hashlib
+import types
+import shutil
+import functools
+import pathlib
+import time
 import numpy as np
 import surfa as sf
 import tensorflow as tf
@@ -7,6 +15,7 @@ import voxelmorph as vxm
 
 
 # Settings.
+precisions = ('float32', 'bfloat16', 'int8')
 weights = {
     'joint': ('synthmorph.affine.2.h5', 'synthmorph.deform.3.h5',),
     'deform': ('synthmorph.deform.3.h5',),
@@ -100,8 +109,8 @@ def transform(im, trans, shape=None, normalize=False, batch=False):
     return out
 
 
-def load_weights(model, weights):
-    """Load weights into model or submodel.
+def probe_weights(model, weights):
+    """Load weights into model or submodel by trial and error.
 
     Attempts to load (all) weights into a model or one of its submodels. If
     that fails, `model` may be a submodel of what we got weights for, and we
@@ -114,6 +123,12 @@ def load_weights(model, weights):
     weights : str or pathlib.Path
         Path to weights file.
 
+    Returns
+    -------
+    out : list
+        HDF5 dataset loaded into each variable of `model.weights`, or None
+        for variables the file does not cover.
+
     Raises
     ------
     ValueError
@@ -136,9 +151,21 @@ def load_weights(model, weights):
     for mod in models:
         try:
             mod.load_weights(weights)
-            return
-        except ValueError as e:
-            pass
+        except ValueError:
+            continue
+
+        # Keras pairs layers with weights and their HDF5 groups in order.
+        with h5py.File(weights, mode='r') as h5:
+            root = weights_root(h5)
+            groups = [root[lay] for lay in root.attrs['layer_names']]
+            groups = [g for g in groups if len(g.attrs['weight_names'])]
+            layers = [f for f in mod.layers if f.weights]
+            pairs = []
+            for lay, g in zip(layers, groups):
+                var = lay.trainable_weights + lay.non_trainable_weights
+                pairs.extend(zip(var, [g[w].name for w in g.attrs['weight_names']]))
+
+        return weight_map(model, pairs)
 
     # Assume `model` is a submodel of what we got weights for.
     with h5py.File(weights, mode='r') as h5:
@@ -150,26 +177,695 @@ def load_weights(model, weights):
         for lay, wei in zip(layers, weights):
             try:
                 model.set_weights([h5[lay][w] for w in wei])
-                return
+                return weight_map(model, zip(model.weights, [h5[lay][w].name for w in wei]))
             except ValueError as e:
                 if lay is layers[-1]:
                     raise e
 
 
-def register(arg):
+def weights_root(h5):
+    """Group holding the layers of a Keras HDF5 file, as `load_weights` reads it."""
+    if 'layer_names' not in h5.attrs and 'model_weights' in h5:
+        return h5['model_weights']
+    return h5
+
+
+def weight_map(model, pairs):
+    """Dataset of each variable of a model, from (variable, dataset) pairs."""
+    index = {id(v): i for i, v in enumerate(model.weights)}
+    out = [None] * len(index)
+    for v, name in pairs:
+        out[index[id(v)]] = name
+    return out
+
+
+def file_hash(path):
+    """SHA-256 of a file."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def model_key(model):
+    """Key of a model structure, from the shapes of its variables in order."""
+    shapes = [v.shape.as_list() for v in model.weights]
+    return hashlib.sha256(json.dumps(shapes).encode()).hexdigest()[:16]
+
+
+def manifest_path(weights):
+    """Manifest of a weights file, stored next to it."""
+    return f'{weights}.manifest.json'
+
+
+def load_weights(model, weights):
+    """Load weights into model or submodel.
+
+    The first load of a weights file into a model structure finds the
+    matching submodel or layer by trial and error with `probe_weights`, and
+    records the HDF5 dataset of every variable in a manifest next to the
+    file. Later loads verify the manifest against the SHA-256 of the file and
+    read exactly the listed datasets, without building wrapper models.
+
+    Parameters
+    ----------
+    model : TensorFlow model
+        Model to initialize.
+    weights : str or pathlib.Path
+        Path to weights file.
+
+    Raises
+    ------
+    ValueError
+        If unsuccessful at loading any weights.
+
+    """
+    path = manifest_path(weights)
+    digest = file_hash(weights)
+    key = model_key(model)
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest.get('sha256') != digest:
+            manifest = dict(sha256=digest, models={})
+    except (OSError, ValueError):
+        manifest = dict(sha256=digest, models={})
+
+    names = manifest['models'].get(key)
+    if names is not None and len(names) == len(model.weights):
+        with h5py.File(weights, mode='r') as h5:
+            pairs = [(v, h5[n]) for v, n in zip(model.weights, names) if n is not None]
+            if all(tuple(v.shape) == d.shape for v, d in pairs):
+                tf.keras.backend.batch_set_value([(v, d[()]) for v, d in pairs])
+                return
+        print(f'Manifest {path} does not match the model, probing {weights}')
+
+    names = probe_weights(model, weights)
+
+    # The manifest only saves time, failing to write it is not an error.
+    manifest['models'][key] = names
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f'Cannot write weights manifest {path}: {e}')
+
+
+def find_weights(arg):
+    """Weight files of `build_model`, and those that cannot be found.
+
+    Alternative weights replace the defaults of the model. Each default file
+    is looked up in FREESURFER_HOME/models first, then next to this module,
+    where the extension bundles the deformable weights only.
+
+    Parameters
+    ----------
+    arg : argparse.Namespace
+        Registration arguments. Uses `model` and `weights`.
+
+    Returns
+    -------
+    files : list of pathlib.Path
+        Weight files found, in loading order.
+    missing : list of str
+        Weight files not found.
+
+    """
+    if arg.weights:
+        files = [pathlib.Path(f) for f in arg.weights]
+        return files, [str(f) for f in files if not f.is_file()]
+
+    dirs = [pathlib.Path(__file__).parent]
+    fs = os.environ.get('FREESURFER_HOME')
+    if fs:
+        dirs.insert(0, pathlib.Path(fs, 'models'))
+
+    files, missing = [], []
+    for f in weights[arg.model]:
+        found = [d / f for d in dirs if (d / f).is_file()]
+        if found:
+            files.append(found[0])
+        else:
+            missing.append(f)
+
+    return files, missing
+
+
+def weight_files(arg):
+    """Weight files loaded into the network of `build_model`.
+
+    Exits if any is missing. See `find_weights`.
+
+    Parameters
+    ----------
+    arg : argparse.Namespace
+        Registration arguments. Uses `model` and `weights`.
+
+    Returns
+    -------
+    out : list of pathlib.Path
+        Weight files, in loading order.
+
+    """
+    files, missing = find_weights(arg)
+    if missing:
+        sf.system.fatal(f'cannot find weights {", ".join(missing)}, set environment variable '
+                        'FREESURFER_HOME or weights')
+
+    return files
+
+
+@functools.lru_cache(maxsize=None)
+def bf16_supported():
+    """Whether TensorFlow runs bfloat16 natively on the CPU.
+
+    Neither TensorFlow nor every operating system reports the AVX512-BF16 and
+    AMX instructions, and oneDNN only uses them if it is enabled. The result
+    is therefore measured: without native support, TensorFlow emulates
+    bfloat16 several times slower than float32. On Linux, CPU flags lacking
+    the instructions answer without measuring. The result is cached.
+
+    """
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+        if 'avx512_bf16' not in flags and 'amx_bf16' not in flags:
+            return False
+    except OSError:
+        pass
+
+    # Time a small convolution like those of the networks in both precisions,
+    # after a warm-up call.
+    x = tf.random.stateless_normal((1, 32, 32, 32, 16), seed=(0, 0))
+    k = tf.random.stateless_normal((3, 3, 3, 16, 16), seed=(0, 1))
+    times = {}
+    try:
+        with tf.device('/CPU:0'):
+            for dtype in (tf.float32, tf.bfloat16):
+                inputs = (tf.cast(x, dtype), tf.cast(k, dtype))
+                tf.nn.conv3d(*inputs, strides=(1,) * 5, padding='SAME')
+                start = time.perf_counter()
+                for _ in range(3):
+                    tf.nn.conv3d(*inputs, strides=(1,) * 5, padding='SAME').numpy()
+                times[dtype] = time.perf_counter() - start
+    except (tf.errors.InvalidArgumentError, tf.errors.NotFoundError, tf.errors.UnimplementedError):
+        return False
+
+    return times[tf.bfloat16] < times[tf.float32]
 
-    # Parse arguments.
+
+def build_model(arg):
+    """Construct a SynthMorph network and load its weights.
+
+    Building the Keras graph and loading the weights dominate the run time of
+    a single registration. Callers registering several image pairs can build
+    the model once and pass it to `register` for every pair. Prefer
+    `load_model`, which loads a network saved by `compile_model` if there is
+    one.
+
+    Parameters
+    ----------
+    arg : argparse.Namespace
+        Registration arguments. Uses `model`, `extent`, `steps`, and
+        `weights`, as parsed by `mri_synthmorph register`, and `precision`
+        and `bidir` if set. With 'bfloat16', layers compute in bfloat16 under
+        the Keras mixed-precision policy, if the CPU supports it. With `bidir`
+        false, deformable networks predict only the forward transform, see
+        `bidirectional`.
+
+    Returns
+    -------
+    model : TensorFlow model
+        Initialized network, with float32 outputs.
+
+    """
     in_shape = (arg.extent,) * 3
     is_mat = arg.model in ('affine', 'rigid')
+    mixed = getattr(arg, 'precision', 'float32') == 'bfloat16' and bf16_supported()
+
+    # Layers take the compute type of the policy active when they are
+    # constructed, while variables stay float32.
+    policy = tf.keras.mixed_precision.global_policy()
+    if mixed:
+        tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+
+    # Network. For deformable-only registration, `HyperVxmJoint` ignores the
+    # `mid_space` argument, and the initialization will determine the space.
+    try:
+        prop = dict(in_shape=in_shape, bidir=is_mat or getattr(arg, 'bidir', True))
+        if is_mat:
+            prop.update(make_dense=False, rigid=arg.model == 'rigid')
+            model = vxm.networks.VxmAffineFeatureDetector(**prop)
+
+        else:
+            prop.update(mid_space=True, int_steps=arg.steps, skip_affine=arg.model == 'deform')
+            model = vxm.networks.HyperVxmJoint(**prop)
+    finally:
+        tf.keras.mixed_precision.set_global_policy(policy)
+
+    # Weights.
+    arg.weights = weight_files(arg)
+    for f in arg.weights:
+        load_weights(model, weights=f)
+
+    if mixed:
+        outputs = [tf.cast(x, tf.float32) for x in model.outputs]
+        model = tf.keras.Model(model.inputs, outputs)
+
+    print('模型加载完成！')
+    return model
+
+
+def network_outputs(out):
+    """Transforms predicted by a network, as a tuple of one or two tensors."""
+    return tuple(tf.nest.flatten(out))
+
+
+def requested(arg):
+    """Directions of the transform used by the requested outputs.
+
+    Parameters
+    ----------
+    arg : argparse.Namespace
+        Registration arguments, as parsed by `mri_synthmorph register`.
+
+    Returns
+    -------
+    out : tuple of bool
+        Whether the outputs use the forward transform, from fixed to moving
+        voxel coordinates, and whether they use the backward transform.
+
+    """
+    forward = bool(arg.out_moving or arg.trans or arg.out_dir)
+    backward = bool(arg.out_fixed or arg.inverse or arg.out_dir)
+    return forward, backward
+
+
+def bidirectional(arg):
+    """Whether registering needs a network predicting both transforms.
+
+    Deformable networks without the backward output skip integrating the
+    inverse warp. Matrix networks always predict both, as inverting a matrix
+    costs nothing.
+
+    """
+    return arg.model in ('affine', 'rigid') or requested(arg)[1]
+
+
+def compiled_dir():
+    """Directory of compiled networks, SYNTHMORPH_MODELS or next to this module."""
+    path = os.environ.get('SYNTHMORPH_MODELS')
+    if path:
+        return path
+    return os.path.join(os.path.dirname(__file__), 'compiled')
+
+
+def compiled_path(arg, directory=None):
+    """SavedModel directory of a (model, extent, steps) variant.
+
+    Matrix models do not integrate, and their variants ignore `steps`.
+    Deformable variants predicting only the forward transform end in `.fw`.
+
+    """
+    name = f'{arg.model}.{arg.extent}'
+    if arg.model not in ('affine', 'rigid'):
+        name += f'.{arg.steps}'
+        if not getattr(arg, 'bidir', True):
+            name += '.fw'
+    return os.path.join(directory or compiled_dir(), name)
+
+
+def compiled_meta(arg):
+    """Description of a variant and its weights, stored with the SavedModel.
+
+    A compiled network is used only if the description still matches, so
+    that replacing weights or upgrading TensorFlow falls back to building.
+
+    """
+    files = []
+    for f in weight_files(arg):
+        stat = os.stat(f)
+        files.append([os.path.basename(f), stat.st_size, stat.st_mtime_ns])
+
+    return dict(
+        model=arg.model,
+        extent=arg.extent,
+        steps=None if arg.model in ('affine', 'rigid') else arg.steps,
+        bidir=arg.model in ('affine', 'rigid') or getattr(arg, 'bidir', True),
+        weights=files,
+        tensorflow=tf.__version__,
+    )
+
+
+class CompiledModel:
+    """Network loaded from a SavedModel written by `compile_model`.
+
+    Called like the Keras model, with the inputs of `register`: the moving
+    and fixed images, preceded by the regularization weights for deformable
+    models. Returns the forward and backward transforms.
+
+    Parameters
+    ----------
+    module : tf.Module
+        Object returned by `tf.saved_model.load`.
+    is_mat : bool
+        The network predicts matrix transforms.
+
+    """
+
+    def __init__(self, module, is_mat):
+        self.module = module
+        self.is_mat = is_mat
+
+    def __call__(self, inputs):
+        images = [tf.cast(x, tf.float32) for x in inputs[-2:]]
+        if self.is_mat:
+            return self.module.predict(*images)
+
+        hyper = tf.reshape(tf.cast(inputs[0], tf.float32), (-1, 1))
+        return self.module.predict(hyper, *images)
+
+
+def compile_model(arg, directory=None):
+    """Build a network and save it as a SavedModel with a fixed signature.
+
+    The saved function takes images of shape (batch, *extent, 1), and the
+    regularization weights of shape (batch, 1) for deformable models, with a
+    free batch size. Loading it restores the traced graph and its variables
+    without constructing Keras layers or probing weight files.
+
+    Parameters
+    ----------
+    arg : argparse.Namespace
+        Registration arguments. Uses `model`, `extent`, `steps`, and
+        `weights`, as parsed by `mri_synthmorph register`.
+    directory : str, optional
+        Directory receiving the variant. Defaults to `compiled_dir()`.
+
+    Returns
+    -------
+    path : str
+        SavedModel directory.
+
+    """
+    model = build_model(arg)
+    image = tf.TensorSpec((None, *(arg.extent,) * 3, 1), tf.float32)
+
+    if arg.model in ('affine', 'rigid'):
+        @tf.function(input_signature=(image, image))
+        def predict(mov, fix):
+            return network_outputs(model((mov, fix)))
+
+    else:
+        @tf.function(input_signature=(tf.TensorSpec((None, 1), tf.float32), image, image))
+        def predict(hyper, mov, fix):
+            return network_outputs(model((hyper, mov, fix)))
+
+    module = tf.Module()
+    module.model = model
+    module.predict = predict
+
+    # Save next to the destination and swap, so that readers never see a
+    # partial model.
+    path = compiled_path(arg, directory)
+    tmp = f'{path}.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    tf.saved_model.save(module, tmp)
+    with open(os.path.join(tmp, 'synthmorph.json'), 'w') as f:
+        json.dump(compiled_meta(arg), f, indent=1)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    return path
+
+
+class QuantizedModel:
+    """Network quantized to int8 by `quantize_model`, run by TFLite.
+
+    Called like the Keras model. The TFLite model has a batch size of 1, and
+    batches run one pair at a time.
+
+    Parameters
+    ----------
+    path : str
+        TFLite file.
+    is_mat : bool
+        The network predicts matrix transforms.
+    threads : int, optional
+        Number of interpreter threads. System default if unspecified.
+
+    """
+
+    def __init__(self, path, is_mat, threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=threads)
+        self.runner = self.interpreter.get_signature_runner()
+        self.is_mat = is_mat
+
+    def __call__(self, inputs):
+        mov, fix = (np.asarray(x, np.float32) for x in inputs[-2:])
+        if not self.is_mat:
+            hyper = np.reshape(np.asarray(inputs[0], np.float32), (-1, 1))
+
+        outputs = []
+        for i in range(mov.shape[0]):
+            feed = dict(mov=mov[i:i + 1], fix=fix[i:i + 1])
+            if not self.is_mat:
+                feed.update(hyper=hyper[i:i + 1])
+            out = self.runner(**feed)
+            outputs.append([out[k] for k in sorted(out)])
+
+        return tuple(tf.constant(np.concatenate(x)) for x in zip(*outputs))
+
+
+def quantized_path(arg, directory=None):
+    """TFLite file of the int8 network of a variant."""
+    return f'{compiled_path(arg, directory)}.int8.tflite'
+
+
+def quantize_model(arg, calibration, directory=None):
+    """Quantize a network to int8 by TFLite post-training quantization.
+
+    Convolution weights and activations are quantized with ranges observed
+    on the calibration inputs. Operations without int8 kernels, like the
+    spatial transformers, stay float32.
+
+    Parameters
+    ----------
+    arg : argparse.Namespace
+        Registration arguments, as for `build_model`. Uses `hyper` for the
+        calibration of deformable models if set.
+    calibration : list of tuple
+        Network inputs of calibration pairs, the moving and fixed images in
+        network space with a batch dimension of 1, as in the output of
+        `prepare`. A few representative subjects suffice.
+    directory : str, optional
+        Directory receiving the variant. Defaults to `compiled_dir()`.
+
+    Returns
+    -------
+    path : str
+        TFLite file.
+
+    """
+    is_mat = arg.model in ('affine', 'rigid')
+    model = build_model(argparse.Namespace(**{**vars(arg), 'precision': 'float32'}))
+    image = tf.TensorSpec((1, *(arg.extent,) * 3, 1), tf.float32)
+
+    if is_mat:
+        @tf.function(input_signature=(image, image))
+        def predict(mov, fix):
+            return network_outputs(model((mov, fix)))
+
+    else:
+        @tf.function(input_signature=(tf.TensorSpec((1, 1), tf.float32), image, image))
+        def predict(hyper, mov, fix):
+            return network_outputs(model((hyper, mov, fix)))
+
+    hyper = np.full((1, 1), getattr(arg, 'hyper', 0.5), np.float32)
+
+    def representative():
+        for mov, fix in calibration:
+            images = [np.asarray(mov, np.float32), np.asarray(fix, np.float32)]
+            yield images if is_mat else [hyper, *images]
+
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([predict.get_concrete_function()], model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative
+    converter.target_spec.supported_ops = [
+        tf.lite.OpsSet.TFLITE_BUILTINS_INT8,
+        tf.lite.OpsSet.TFLITE_BUILTINS,
+        tf.lite.OpsSet.SELECT_TF_OPS,
+    ]
+    data = converter.convert()
+
+    path = quantized_path(arg, directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'wb') as f:
+        f.write(data)
+    with open(f'{path}.json', 'w') as f:
+        json.dump(compiled_meta(arg), f, indent=1)
+    os.replace(f'{path}.tmp', path)
+    return path
 
-    # Threading.
-    if arg.threads:
-        tf.config.threading.set_inter_op_parallelism_threads(arg.threads)
-        tf.config.threading.set_intra_op_parallelism_threads(arg.threads)
+
+def load_quantized(arg, directory=None):
+    """Load the int8 network of a variant, or None if there is no up-to-date one."""
+    path = quantized_path(arg, directory)
+    try:
+        with open(f'{path}.json') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if meta != compiled_meta(arg):
+        print(f'Not using quantized model {path}: compiled from other weights or TensorFlow version')
+        return None
+
+    return QuantizedModel(path, is_mat=arg.model in ('affine', 'rigid'), threads=getattr(arg, 'threads', None))
+
+
+def load_model(arg, directory=None):
+    """Load the compiled network of a variant, or build it.
+
+    Falls back to `build_model` if no network was compiled for the model,
+    extent, and steps of `arg`, or if it was compiled from other weights or
+    with another TensorFlow version.
+
+    With `arg.precision` set to 'int8', loads the network quantized by
+    `quantize_model`, and with 'bfloat16', builds a mixed-precision network.
+    Both fall back to float32 if the network or the CPU support is missing.
+
+    Parameters
+    ----------
+    arg : argparse.Namespace
+        Registration arguments, as for `build_model`.
+    directory : str, optional
+        Directory of compiled networks. Defaults to `compiled_dir()`.
+
+    Returns
+    -------
+    model : CompiledModel, QuantizedModel, or TensorFlow model
+        Initialized network, called the same way in all cases.
+
+    """
+    precision = getattr(arg, 'precision', 'float32')
+    if precision == 'int8':
+        model = load_quantized(arg, directory)
+        if model is not None:
+            print('模型加载完成！')
+            return model
+        print(f'No int8 model at {quantized_path(arg, directory)}, using float32')
+
+    if precision == 'bfloat16':
+        if bf16_supported():
+            return build_model(arg)
+        print('CPU does not run bfloat16 natively, using float32')
+
+    path = compiled_path(arg, directory)
+    try:
+        with open(os.path.join(path, 'synthmorph.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return build_model(arg)
+
+    try:
+        if meta != compiled_meta(arg):
+            raise ValueError('compiled from other weights or TensorFlow version')
+        module = tf.saved_model.load(path)
+    except (OSError, ValueError, tf.errors.OpError) as e:
+        print(f'Not using compiled model {path}: {e}')
+        return build_model(arg)
+
+    print('模型加载完成！')
+    return CompiledModel(module, is_mat=arg.model in ('affine', 'rigid'))
+
+
+def parity(arg, directory=None, seed=0):
+    """Largest difference between the compiled and the built network.
+
+    Parameters
+    ----------
+    arg : argparse.Namespace
+        Registration arguments, as for `build_model`.
+    directory : str, optional
+        Directory of compiled networks. Defaults to `compiled_dir()`.
+    seed : int, optional
+        Seed of the random input images.
+
+    Returns
+    -------
+    out : float
+        Largest absolute difference of the predicted transforms.
+
+    """
+    shape = (1, *(arg.extent,) * 3, 1)
+    rng = np.random.default_rng(seed)
+    inputs = tuple(tf.constant(rng.random(shape, dtype=np.float32)) for _ in range(2))
+    if arg.model not in ('affine', 'rigid'):
+        inputs = (tf.constant([[0.5]]), *inputs)
+
+    compiled = load_model(arg, directory)
+    if not isinstance(compiled, CompiledModel):
+        raise ValueError(f'no usable compiled model at {compiled_path(arg, directory)}')
+
+    built = build_model(argparse.Namespace(**{**vars(arg), 'precision': 'float32'}))
+    return max(
+        float(tf.reduce_max(tf.abs(a - b)))
+        for a, b in zip(compiled(inputs), network_outputs(built(inputs)))
+    )
+
+
+def prepare_fixed(fix, shape):
+    """Take a fixed image to network space.
+
+    Parameters
+    ----------
+    fix : surfa.Volume
+        Fixed image.
+    shape : (3,) array-like
+        Spatial shape of the network space.
+
+    Returns
+    -------
+    out : tuple
+        Transform from network to fixed-image space, its inverse, and the
+        normalized fixed image in network space with a batch dimension.
+
+    """
+    net_to_fix, fix_to_net = network_space(fix, shape=shape)
+    inp = transform(fix, net_to_fix, shape=shape, normalize=True, batch=True)
+    return net_to_fix, fix_to_net, inp
+
+
+def prepare(arg, fix=None, fixed=None):
+    """Load the input images and take them to network space.
+
+    Parameters
+    ----------
+    arg : argparse.Namespace
+        Registration arguments, as parsed by `mri_synthmorph register`.
+    fix : surfa.Volume, optional
+        Fixed image, if already loaded from `arg.fixed`.
+    fixed : tuple, optional
+        Output of `prepare_fixed` for the fixed image of `arg`, to reuse when
+        registering several images to the same fixed image. Ignored for
+        mid-space initialization, which moves the fixed network space.
+
+    Returns
+    -------
+    prep : dict
+        Images, coordinate transforms, and network inputs of the pair.
+
+    """
+    in_shape = (arg.extent,) * 3
 
     # Input data.
     mov = sf.load_volume(arg.moving)
-    fix = sf.load_volume(arg.fixed)
+    if fix is None:
+        fix = sf.load_volume(arg.fixed)
     if not len(mov.shape) == len(fix.shape) == 3:
         sf.system.fatal('input images are not single-frame volumes')
 
@@ -181,13 +877,11 @@ def register(arg):
     # via resampling, updating the header, or passed on the command line alike.
     center = fix if arg.model == 'deform' else None
     net_to_mov, mov_to_net = network_space(mov, shape=in_shape, center=center)
-    net_to_fix, fix_to_net = network_space(fix, shape=in_shape)
-
-    # Coordinate transforms from and to world space. There is only one world.
-    mov_to_ras = mov.geom.vox2world.matrix
-    fix_to_ras = fix.geom.vox2world.matrix
-    ras_to_mov = mov.geom.world2vox.matrix
-    ras_to_fix = fix.geom.world2vox.matrix
+    if fixed is None or arg.mid_space:
+        net_to_fix, fix_to_net = network_space(fix, shape=in_shape)
+        inp_fix = None
+    else:
+        net_to_fix, fix_to_net, inp_fix = fixed
 
     # Incorporate an initial matrix transform from moving to fixed coordinates,
     # as LTAs store the inverse. For mid-space initialization, compute the
@@ -214,53 +908,144 @@ def register(arg):
     # the correct voxel-to-RAS matrix after incorporating an initial transform,
     # an image viewer taking this matrix into account will show an unchanged
     # image. The networks only see the voxel data, which have been moved.
+    if inp_fix is None:
+        inp_fix = transform(fix, net_to_fix, shape=in_shape, normalize=True, batch=True)
     inputs = (
         transform(mov, net_to_mov, shape=in_shape, normalize=True, batch=True),
-        transform(fix, net_to_fix, shape=in_shape, normalize=True, batch=True),
+        inp_fix,
     )
 
-    # Network. For deformable-only registration, `HyperVxmJoint` ignores the
-    # `mid_space` argument, and the initialization will determine the space.
-    prop = dict(in_shape=in_shape, bidir=True)
-    if is_mat:
-        prop.update(make_dense=False, rigid=arg.model == 'rigid')
-        model = vxm.networks.VxmAffineFeatureDetector(**prop)
+    return dict(
+        mov=mov,
+        fix=fix,
+        net_to_mov=net_to_mov,
+        mov_to_net=mov_to_net,
+        net_to_fix=net_to_fix,
+        fix_to_net=fix_to_net,
+        inputs=inputs,
+    )
 
-    else:
-        prop.update(mid_space=True, int_steps=arg.steps, skip_affine=arg.model == 'deform')
-        model = vxm.networks.HyperVxmJoint(**prop)
-        inputs = (tf.constant([arg.hyper]), *inputs)
 
-    output_dir = os.path.join(
-            os.path.dirname(__file__),  # 当前脚本目录
-        )
-    import pathlib
-    script_dir = pathlib.Path(__file__).parent
-    deform_file = script_dir / "synthmorph.deform.3.h5"
+def compose_outputs(prep, pred, need=(True, True)):
+    """Convert transforms between network spaces to the original voxel spaces.
 
-    # Weights.
-    arg.weights = [deform_file]
+    Parameters
+    ----------
+    prep : dict
+        Output of `prepare` for the image pair.
+    pred : tuple of TensorFlow tensors
+        Forward and, if predicted, backward transform in network space,
+        without batch dimension.
+    need : tuple of bool, optional
+        Directions to convert, see `requested`. Dense warps take the shape
+        of their target image, which makes converting them expensive for
+        high-resolution images.
 
-    # if not arg.weights:
-    #     fs = os.environ.get('FREESURFER_HOME')
-    #     if not fs:
-    #         sf.system.fatal('set environment variable FREESURFER_HOME or weights')
-    #     arg.weights = [os.path.join(fs, 'models', f) for f in weights[arg.model]]
+    Returns
+    -------
+    out : tuple
+        Transform from fixed to moving voxel coordinates, of the shape of the
+        fixed image for warps, and its inverse. None for the directions that
+        are not needed.
 
-    for f in arg.weights:
-        load_weights(model, weights=f)
+    """
+    def chain(left, trans, right, shape):
+        # Matrix transforms compose in double precision, like the matrices
+        # between network and voxel spaces. Dense warps are single precision.
+        dtype = tf.float64 if vxm.utils.is_affine_shape(trans.shape) else tf.float32
+        left, trans, right = (tf.cast(f, dtype) for f in (left, trans, right))
+        return vxm.utils.compose((left, trans, right), shift_center=False, shape=shape)
 
-    print('模型加载完成！')
+    fw, bw = (*pred, None)[:2]
+    if need[0]:
+        fw = chain(prep['net_to_mov'], fw, prep['fix_to_net'], shape=prep['fix'].shape)
+    if need[1]:
+        if bw is None:
+            raise ValueError('the network does not predict the backward transform')
+        bw = chain(prep['net_to_fix'], bw, prep['mov_to_net'], shape=prep['mov'].shape)
+    return fw if need[0] else None, bw if need[1] else None
+
+
+def dense_shift(trans, shape):
+    """Displacement field of a transform from `compose_outputs` on a voxel grid.
+
+    Parameters
+    ----------
+    trans : array-like
+        Matrix or displacement field.
+    shape : (3,) array-like
+        Spatial shape of the grid, used for matrices.
+
+    Returns
+    -------
+    out : np.ndarray
+        Displacement field of shape (*shape, 3).
+
+    """
+    trans = tf.cast(trans, tf.float32)
+    if vxm.utils.is_affine_shape(trans.shape):
+        trans = vxm.utils.affine_to_dense_shift(trans, shape=shape, shift_center=False)
+    return np.asarray(trans)
+
+
+def warp_labels(labels, trans, shape):
+    """Move a label map with a transform from `compose_outputs`.
 
-    # Inference. The first transform maps from the moving to the fixed image,
-    # or equivalently, from fixed to moving coordinates. The second is the
+    Parameters
+    ----------
+    labels : array-like
+        Label map in moving voxel space.
+    trans : array-like
+        Transform from fixed to moving voxel coordinates.
+    shape : (3,) array-like
+        Shape of the fixed image.
+
+    Returns
+    -------
+    out : np.ndarray
+        Integer label map in fixed voxel space, by nearest-neighbor
+        interpolation.
+
+    """
+    labels = tf.cast(labels, tf.float32)[..., tf.newaxis]
+    trans = tf.cast(trans, tf.float32)
+    out = vxm.utils.transform(labels, trans, interp_method='nearest', fill_value=0, shift_center=False, shape=shape)
+    return np.asarray(out[..., 0]).astype(np.int64)
+
+
+def save_outputs(arg, prep, pred, trans=None):
+    """Convert predicted transforms to the original spaces and save outputs.
+
+    Parameters
+    ----------
+    arg : argparse.Namespace
+        Registration arguments, as parsed by `mri_synthmorph register`.
+    prep : dict
+        Output of `prepare` for the image pair.
+    pred : tuple of TensorFlow tensors
+        Forward and backward transforms in network space, without batch
+        dimension.
+    trans : tuple of TensorFlow tensors, optional
+        Output of `compose_outputs` for `pred`, if already computed, with at
+        least the directions of `requested(arg)`.
+
+    """
+    in_shape = (arg.extent,) * 3
+    is_mat = arg.model in ('affine', 'rigid')
+    mov, fix, inputs = prep['mov'], prep['fix'], prep['inputs']
+    net_to_mov, net_to_fix = prep['net_to_mov'], prep['net_to_fix']
+
+    # Coordinate transforms from and to world space. There is only one world.
+    mov_to_ras = mov.geom.vox2world.matrix
+    fix_to_ras = fix.geom.vox2world.matrix
+
+    # The first transform maps from the moving to the fixed image, or
+    # equivalently, from fixed to moving coordinates. The second is the
     # inverse. Convert transforms between moving and fixed network spaces to
-    # transforms between the original voxel spaces.
-    pred = tuple(map(tf.squeeze, model(inputs)))
-    # print('获得pred')
-    fw, bw = pred
-    fw = vxm.utils.compose((net_to_mov, fw, fix_to_net), shift_center=False, shape=fix.shape)
-    bw = vxm.utils.compose((net_to_fix, bw, mov_to_net), shift_center=False, shape=mov.shape)
+    # transforms between the original voxel spaces. Dense warps are converted
+    # only for the outputs that use them, matrices always.
+    need = (True, True) if is_mat else requested(arg)
+    fw, bw = compose_outputs(prep, pred, need) if trans is None else trans
 
     # print('1')
     # Associate image geometries with the transforms. LTAs store the inverse.
@@ -271,8 +1056,10 @@ def register(arg):
         format = dict(space='world')
 
     else:
-        fw = sf.Warp(fw, source=mov, target=fix, format=sf.Warp.Format.disp_crs)
-        bw = sf.Warp(bw, source=fix, target=mov, format=sf.Warp.Format.disp_crs)
+        if need[0]:
+            fw = sf.Warp(fw, source=mov, target=fix, format=sf.Warp.Format.disp_crs)
+        if need[1]:
+            bw = sf.Warp(bw, source=fix, target=mov, format=sf.Warp.Format.disp_crs)
         format = dict(format=sf.Warp.Format.disp_ras)
 
     # print('2')
@@ -302,8 +1089,8 @@ def register(arg):
         # Input images.
         mov = sf.ImageGeometry(in_shape, vox2world=mov_to_ras @ net_to_mov)
         fix = sf.ImageGeometry(in_shape, vox2world=fix_to_ras @ net_to_fix)
-        mov = sf.Volume(inputs[-2][0], geometry=fix if arg.init else mov)
-        fix = sf.Volume(inputs[-1][0], geometry=fix)
+        mov = sf.Volume(inputs[0][0], geometry=fix if arg.init else mov)
+        fix = sf.Volume(inputs[1][0], geometry=fix)
         mov.save(filename=arg.out_dir / 'inp_1.nii.gz')
         fix.save(filename=arg.out_dir / 'inp_2.nii.gz')
 
@@ -327,7 +1114,265 @@ def register(arg):
         mov.transform(fw).save(filename=arg.out_dir / 'out_1.nii.gz')
         fix.transform(bw).save(filename=arg.out_dir / 'out_2.nii.gz')
 
-    # print('5')
+
+class XlaInference:
+    """SynthMorph inference compiled with XLA.
+
+    Calling the object runs the network forward pass as a jit-compiled
+    function, for batches of any size. For a single pair, `predict` also
+    compiles the integration of the warps and their composition with the
+    network-space matrices into the same function. Compiled functions are
+    kept per pair of image shapes and needed directions, and reused for later
+    pairs of the same shapes. Shapes that XLA fails to compile run eagerly.
+
+    Parameters
+    ----------
+    model : TensorFlow model or CompiledModel
+        Network returned by `load_model`.
+
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.forward = tf.function(lambda inputs: network_outputs(model(inputs)), jit_compile=True)
+        self.functions = {}
+
+    def __call__(self, inputs):
+        return self.forward(inputs)
+
+    def fused(self, inputs, net_to_mov, fix_to_net, net_to_fix, mov_to_net, fix_shape, mov_shape, need):
+        pred = tuple(p[0] for p in network_outputs(self.model(inputs)))
+
+        # Composition only needs the shapes of the images.
+        prep = dict(
+            net_to_mov=net_to_mov,
+            fix_to_net=fix_to_net,
+            net_to_fix=net_to_fix,
+            mov_to_net=mov_to_net,
+            fix=types.SimpleNamespace(shape=fix_shape),
+            mov=types.SimpleNamespace(shape=mov_shape),
+        )
+        return pred, compose_outputs(prep, pred, need)
+
+    def predict(self, prep, inputs, need=(True, True)):
+        """Predict and compose the transforms of a pair.
+
+        Parameters
+        ----------
+        prep : dict
+            Output of `prepare` for the image pair.
+        inputs : tuple of TensorFlow tensors
+            Network inputs of the pair, with a batch dimension of 1.
+        need : tuple of bool, optional
+            Directions to convert to the image spaces, see `requested`.
+
+        Returns
+        -------
+        pred : tuple of TensorFlow tensors
+            Transforms in network space, as passed to `save_outputs`.
+        trans : tuple of TensorFlow tensors
+            Output of `compose_outputs` for `pred`.
+
+        """
+        key = (tuple(prep['fix'].shape), tuple(prep['mov'].shape), tuple(need))
+        if key not in self.functions:
+            fused = functools.partial(self.fused, fix_shape=key[0], mov_shape=key[1], need=key[2])
+            self.functions[key] = tf.function(fused, jit_compile=True)
+
+        func = self.functions[key]
+        if func is not None:
+            # Double precision, as `compose_outputs` composes matrices eagerly.
+            mats = [tf.constant(prep[k], tf.float64) for k in ('net_to_mov', 'fix_to_net', 'net_to_fix', 'mov_to_net')]
+            try:
+                return func(inputs, *mats)
+            except (tf.errors.InvalidArgumentError, tf.errors.UnimplementedError) as e:
+                print(f'XLA compilation failed for shapes {key}, running eagerly: {e}')
+                self.functions[key] = None
+
+        pred = tuple(map(tf.squeeze, network_outputs(self.model(inputs))))
+        return pred, compose_outputs(prep, pred, need)
+
+
+def xla_model(model):
+    """Wrap a network in `XlaInference`, unless TFLite runs it."""
+    if isinstance(model, QuantizedModel):
+        print('XLA does not apply to int8 models, running TFLite')
+        return model
+    return model if isinstance(model, XlaInference) else XlaInference(model)
+
+
+def register(arg, model=None, cache=None):
+    """Register a moving to a fixed image and save the requested outputs.
+
+    Parameters
+    ----------
+    arg : argparse.Namespace
+        Registration arguments, as parsed by `mri_synthmorph register`.
+    model : TensorFlow model, CompiledModel, or XlaInference, optional
+        Network returned by `load_model` for the same `model`, `extent`, and
+        `steps`, predicting both transforms if `bidirectional(arg)`. None
+        means loading it. With `arg.xla`, inference and the composition of
+        the outputs run compiled with XLA.
+    cache : synthmorph.cache.TemplateCache, optional
+        Cache of fixed images in network space.
+
+    """
+    # Threading.
+    if arg.threads:
+        tf.config.threading.set_inter_op_parallelism_threads(arg.threads)
+        tf.config.threading.set_intra_op_parallelism_threads(arg.threads)
+
+    if cache is None or arg.mid_space:
+        prep = prepare(arg)
+    else:
+        fix = sf.load_volume(arg.fixed)
+        fixed = cache.get(arg.fixed, fix, shape=(arg.extent,) * 3)
+        prep = prepare(arg, fix=fix, fixed=fixed)
+
+    # Network. Skip the backward transform unless an output uses it.
+    is_mat = arg.model in ('affine', 'rigid')
+    if model is None:
+        model = load_model(argparse.Namespace(**{**vars(arg), 'bidir': bidirectional(arg)}))
+    if getattr(arg, 'xla', False):
+        model = xla_model(model)
+
+    inputs = prep['inputs']
+    if not is_mat:
+        inputs = (tf.constant([arg.hyper]), *inputs)
+
+    # Inference.
+    if isinstance(model, XlaInference):
+        pred, trans = model.predict(prep, inputs, need=(True, True) if is_mat else requested(arg))
+    else:
+        pred = tuple(map(tf.squeeze, network_outputs(model(inputs))))
+        trans = None
+    save_outputs(arg, prep, pred, trans)
+
     vmpeak = sf.system.vmpeak()
     if vmpeak is not None:
         print(f'#@# mri_synthmorph: {arg.model}, threads: {arg.threads}, VmPeak: {vmpeak}')
+
+
+def batch_size_for_memory(arg, mem_limit):
+    """Estimate how many image pairs fit into one batch.
+
+    The estimate is coarse. Activations of the 256-filter convolutions at half
+    resolution dominate the memory use of both networks, and roughly four of
+    them are alive at the same time during inference.
+
+    Parameters
+    ----------
+    arg : argparse.Namespace
+        Registration arguments. Uses `extent`.
+    mem_limit : int
+        Memory budget for inference in bytes.
+
+    Returns
+    -------
+    out : int
+        Number of image pairs, at least 1.
+
+    """
+    half = (arg.extent // 2) ** 3
+    per_pair = half * 256 * 4 * 4
+    return max(1, int(mem_limit // per_pair))
+
+
+def register_batch(args, model=None, batch_size=8, mem_limit=None, callback=None, cache=None):
+    """Register several image pairs, stacking them along the batch axis.
+
+    Images sharing a fixed image are resampled to network space only once,
+    and inference runs on batches of moving images. Each pair produces the
+    same outputs as `register` with the same arguments.
+
+    Parameters
+    ----------
+    args : list of argparse.Namespace
+        Registration arguments for each pair. All pairs must use the same
+        `model`, `extent`, and `steps`.
+    model : TensorFlow model, CompiledModel, or XlaInference, optional
+        Network returned by `load_model`, predicting both transforms if any
+        pair is `bidirectional`. None means loading it. With `xla` set in the
+        arguments, the forward pass runs compiled with XLA.
+    batch_size : int, optional
+        Maximum number of pairs per forward pass.
+    mem_limit : int, optional
+        Memory budget for inference in bytes, further limiting the batch size.
+        See `batch_size_for_memory`.
+    callback : callable, optional
+        Function called as `callback(i, total, moving)` before each batch,
+        with the index and moving image of its first pair.
+    cache : synthmorph.cache.TemplateCache, optional
+        Cache of fixed images in network space, shared across calls.
+
+    Returns
+    -------
+    errors : dict
+        Exception raised for each failed pair, keyed by moving image.
+
+    """
+    if not args:
+        return {}
+
+    first = args[0]
+    for arg in args:
+        if (arg.model, arg.extent, arg.steps) != (first.model, first.extent, first.steps):
+            raise ValueError('batched pairs must share model, extent, and steps')
+
+    in_shape = (first.extent,) * 3
+    is_mat = first.model in ('affine', 'rigid')
+    if mem_limit is not None:
+        batch_size = min(batch_size, batch_size_for_memory(first, mem_limit))
+    batch_size = max(1, batch_size)
+
+    if model is None:
+        bidir = any(bidirectional(arg) for arg in args)
+        model = load_model(argparse.Namespace(**{**vars(first), 'bidir': bidir}))
+    if getattr(first, 'xla', False):
+        model = xla_model(model)
+
+    # Fixed images in network space, by path.
+    fixed = {}
+
+    errors = {}
+    for start in range(0, len(args), batch_size):
+        if callback is not None:
+            callback(start, len(args), args[start].moving)
+
+        chunk = []
+        for arg in args[start:start + batch_size]:
+            try:
+                if arg.fixed not in fixed:
+                    fix = sf.load_volume(arg.fixed)
+                    if cache is None:
+                        fixed[arg.fixed] = fix, prepare_fixed(fix, shape=in_shape)
+                    else:
+                        fixed[arg.fixed] = fix, cache.get(arg.fixed, fix, shape=in_shape)
+                fix, pre = fixed[arg.fixed]
+                chunk.append((arg, prepare(arg, fix=fix, fixed=pre)))
+            except (Exception, SystemExit) as e:
+                print(f'Error preparing {arg.moving}: {e}')
+                errors[arg.moving] = e
+
+        if not chunk:
+            continue
+
+        # Stack the pairs along the batch axis.
+        inputs = [prep['inputs'] for _, prep in chunk]
+        inputs = tuple(tf.concat(x, axis=0) for x in zip(*inputs))
+        if not is_mat:
+            inputs = (tf.constant([[arg.hyper] for arg, _ in chunk]), *inputs)
+        pred = network_outputs(model(inputs))
+
+        for i, (arg, prep) in enumerate(chunk):
+            try:
+                save_outputs(arg, prep, pred=tuple(p[i] for p in pred))
+            except (Exception, SystemExit) as e:
+                print(f'Error saving {arg.moving}: {e}')
+                errors[arg.moving] = e
+
+    vmpeak = sf.system.vmpeak()
+    if vmpeak is not None:
+        print(f'#@# mri_synthmorph: {first.model}, batch: {batch_size}, VmPeak: {vmpeak}')
+
+    return errors
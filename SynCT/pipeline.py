@@ -0,0 +1,442 @@
+"""Declarative end-to-end pipelines over subject folders.
+
+A pipeline file names stages and their options, the same options as the
+corresponding `python -m SynCT batch` stage. For example, in TOML:
+
+    base_dir = "/data/study"
+    jobs = 16
+
+    [stages.ct]
+    run = "dicom-ct"
+    dicom_dir = "CT"
+    output = "ct.nii"
+
+    [stages.clip]
+    run = "ct-clip"
+    input = "ct.nii"
+    min = -100
+    max = 200
+    output = "ct_clip.nii.gz"
+
+A stage depends on another when it reads a file the other writes in the
+subject folder, or when it lists the other under `after`. The scheduler runs
+independent subjects and stages concurrently. It skips a stage of a subject
+when its outputs exist and neither its options nor its inputs changed since
+the last run, so that changing one stage only reruns that stage and what
+depends on it. Inputs are compared by size and modification time, or by
+content with `hash = "content"`. The state of past runs is kept in
+`.synct_pipeline.json` in the base directory.
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import collections
+
+import batch_cli
+import batch_processing
+
+
+# Files of each stage, by option name. Subject inputs and outputs are relative
+# to the subject folder, paths are shared by all subjects. Stages writing a
+# table summarize all subjects in the file named by `output`.
+files = {
+    'dicom-ct': dict(inputs=('dicom_dir',), outputs=('output',)),
+    'dicom-pet': dict(inputs=('dicom_dir',), outputs=('output',)),
+    'ct-clip': dict(inputs=('input',), outputs=('output',)),
+    'skull-strip': dict(inputs=('input',), paths=('model',), outputs=('output', 'mask')),
+    'mask': dict(inputs=('input', 'mask'), outputs=('output',)),
+    'space': dict(inputs=('input',), paths=('fixed',), outputs=('output',)),
+    'register': dict(inputs=('input',), paths=('fixed',), outputs=('output', 'field')),
+    'apply': dict(inputs=('input', 'field'), outputs=('output',)),
+    'dice': dict(inputs=('label1', 'label2'), table=True),
+    'suvr': dict(inputs=('input',), paths=('label_image',), outputs=('label_output',), table=True),
+    'suvr-mapping': dict(inputs=('input', 'mask'), outputs=('output',)),
+}
+
+# Options that do not affect the outputs.
+ignore = ('base_dir', 'jobs', 'task', 'finish', 'run', 'command', 'stage')
+
+
+def load(path):
+    """Load a pipeline file, in TOML or, with PyYAML installed, YAML format."""
+    if path.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise RuntimeError('reading YAML pipelines requires PyYAML, use TOML instead')
+        with open(path) as f:
+            return yaml.safe_load(f)
+
+    try:
+        import tomllib
+    except ImportError:
+        import tomli as tomllib
+    with open(path, 'rb') as f:
+        return tomllib.load(f)
+
+
+def stage_options(name, conf, base_dir, jobs):
+    """Parse the options of a stage with the parser of the batch runner."""
+    conf = dict(conf)
+    kind = conf.pop('run', None)
+    conf.pop('after', None)
+    if kind not in files:
+        raise ValueError(f'stage {name} runs unknown stage type {kind!r}, choose from {", ".join(files)}')
+
+    # Outputs of DICOM conversion default to the subject folders.
+    if kind in ('dicom-ct', 'dicom-pet'):
+        conf.setdefault('output_dir', base_dir)
+
+    argv = ['batch', kind, '--base-dir', base_dir, '--jobs', str(jobs)]
+    for key, value in conf.items():
+        flag = '--' + key.replace('_', '-')
+        if value is True:
+            argv.append(flag)
+        elif value is False or value is None:
+            continue
+        elif isinstance(value, (list, tuple)):
+            argv.append(f"{flag}={','.join(map(str, value))}")
+        else:
+            argv.append(f'{flag}={value}')
+
+    try:
+        return batch_cli.parser().parse_args(argv)
+    except SystemExit:
+        raise ValueError(f'invalid options for stage {name}')
+
+
+class Stage:
+    """A configured stage, with the files it reads and writes per subject."""
+
+    def __init__(self, name, conf, base_dir, jobs):
+        self.name = name
+        self.kind = conf.get('run')
+        self.arg = stage_options(name, conf, base_dir, jobs)
+        self.after = list(conf.get('after', ()))
+
+        spec = files[self.kind]
+        self.table = spec.get('table', False)
+        self.inputs = [getattr(self.arg, k) for k in spec.get('inputs', ())]
+        self.paths = [getattr(self.arg, k) for k in spec.get('paths', ()) if getattr(self.arg, k)]
+        self.outputs = [getattr(self.arg, k) for k in spec.get('outputs', ()) if getattr(self.arg, k)]
+
+        # Options defining the result, excluding the table path.
+        options = {k: v for k, v in vars(self.arg).items() if k not in ignore}
+        if self.table:
+            options.pop('output')
+        self.options = json.dumps(dict(kind=self.kind, **options), sort_keys=True, default=str)
+
+    def output_files(self, subject):
+        if self.kind in ('dicom-ct', 'dicom-pet'):
+            return [os.path.join(self.arg.output_dir, subject, f) for f in self.outputs]
+        path = os.path.join(self.arg.base_dir, subject)
+        return [os.path.join(path, f) for f in self.outputs]
+
+    def input_files(self, subject):
+        path = os.path.join(self.arg.base_dir, subject)
+        return [os.path.join(path, f) for f in self.inputs] + self.paths
+
+
+def order(stages):
+    """Dependencies of each stage, checking for cycles."""
+    writers = {}
+    for s in stages.values():
+        if s.kind in ('dicom-ct', 'dicom-pet') and os.path.abspath(s.arg.output_dir) != os.path.abspath(s.arg.base_dir):
+            continue
+        for f in s.outputs:
+            writers[f] = s.name
+
+    deps = {}
+    for s in stages.values():
+        deps[s.name] = {writers[f] for f in s.inputs if f in writers and writers[f] != s.name}
+        for d in s.after:
+            if d not in stages:
+                raise ValueError(f'stage {s.name} runs after unknown stage {d}')
+            deps[s.name].add(d)
+
+    # Depth-first search for cycles.
+    state = {}
+    def visit(name, chain):
+        if state.get(name) == 'done':
+            return
+        if state.get(name) == 'visiting':
+            raise ValueError(f'pipeline has a cycle: {" -> ".join(chain + [name])}')
+        state[name] = 'visiting'
+        for d in deps[name]:
+            visit(d, chain + [name])
+        state[name] = 'done'
+
+    for name in stages:
+        visit(name, [])
+
+    return deps
+
+
+class Stamps:
+    """Fingerprints of input files, by size and mtime or by content."""
+
+    def __init__(self, content=False):
+        self.content = content
+        self.hashes = {}
+
+    def file(self, path):
+        stat = os.stat(path)
+        if not self.content:
+            return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if key not in self.hashes:
+            h = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+            self.hashes[key] = h.hexdigest()
+        return self.hashes[key]
+
+    def __call__(self, path):
+        if not os.path.exists(path):
+            return None
+        if not os.path.isdir(path):
+            return self.file(path)
+
+        # Directories such as DICOM series change with any file they contain.
+        out = []
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for name in sorted(names):
+                f = os.path.join(root, name)
+                out.append((os.path.relpath(f, path), self.file(f)))
+        return out
+
+
+class Pipeline:
+    """Schedule the stages of a pipeline over all subjects.
+
+    Parameters
+    ----------
+    config : dict
+        Pipeline definition, see the module documentation.
+    base_dir : str, optional
+        Directory of subject folders, overriding the definition.
+    jobs : int, optional
+        Number of worker processes, overriding the definition.
+    force : iterable of str, optional
+        Stages to rerun even if up to date.
+
+    """
+
+    def __init__(self, config, base_dir=None, jobs=None, force=()):
+        self.base_dir = base_dir or config.get('base_dir')
+        if not self.base_dir or not os.path.isdir(self.base_dir):
+            raise ValueError(f'base directory does not exist: {self.base_dir}')
+
+        self.jobs = jobs or config.get('jobs') or batch_processing.default_workers()
+        conf = config.get('stages') or {}
+        if not conf:
+            raise ValueError('pipeline defines no stages')
+
+        self.stages = {n: Stage(n, c, self.base_dir, self.jobs) for n, c in conf.items()}
+        self.deps = order(self.stages)
+        self.force = set(force)
+        self.stamps = Stamps(content=config.get('hash', 'mtime') == 'content')
+        self.state_file = os.path.join(self.base_dir, config.get('state', '.synct_pipeline.json'))
+        self.state = self.load_state()
+        self.engine = None
+
+    def load_state(self):
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self):
+        tmp = f'{self.state_file}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, indent=1, default=float)
+        os.replace(tmp, self.state_file)
+
+    def signature(self, stage, subject):
+        inputs = [(f, self.stamps(f)) for f in stage.input_files(subject)]
+        text = json.dumps([stage.options, inputs])
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def up_to_date(self, stage, subject, signature):
+        if stage.name in self.force:
+            return False
+        record = self.state.get(subject, {}).get(stage.name)
+        if record is None or record['signature'] != signature:
+            return False
+        if stage.table and 'result' not in record:
+            return False
+        return all(os.path.exists(f) for f in stage.output_files(subject))
+
+    def task(self, stage, subject):
+        path = os.path.join(self.base_dir, subject)
+        if stage.kind != 'register':
+            return stage.arg.task(stage.arg, subject, path)
+
+        file_path = os.path.join(path, stage.arg.input)
+        if not os.path.isfile(file_path):
+            return None
+        if self.engine is None:
+            from synthmorph.engine import RegistrationEngine
+            self.engine = RegistrationEngine(model=stage.arg.model, threads=self.jobs,
+                                             cache_dir=stage.arg.cache_dir, xla=stage.arg.xla,
+                                             precision=stage.arg.precision)
+        kwargs = dict(out_moving=os.path.join(path, stage.arg.output))
+        if stage.arg.field:
+            kwargs.update(trans=os.path.join(path, stage.arg.field))
+        return batch_processing.synthmorph_register, (self.engine, [(file_path, stage.arg.fixed, kwargs)]), {}
+
+    def run(self, dry_run=False):
+        """Run all stages that are out of date.
+
+        Returns
+        -------
+        errors : dict
+            Exception by `(subject, stage)` for failed stages.
+
+        """
+        subjects = batch_processing.list_subjects(self.base_dir)
+        if not subjects:
+            raise ValueError(f'no subject folders in {self.base_dir}')
+
+        # The registration engine holds the network, so it runs in a thread.
+        pools = dict(
+            process=batch_processing.BatchExecutor(self.jobs, persistent=True),
+            thread=batch_processing.BatchExecutor(1, processes=False, persistent=True),
+        )
+        pending = [(sub, name) for sub in subjects for name in self.stages]
+        status = {}
+        signatures = {}
+        counts = collections.Counter()
+        errors = {}
+
+        def start(key):
+            """Run or skip a stage whose dependencies finished."""
+            sub, name = key
+            stage = self.stages[name]
+            deps = [status[(sub, d)] for d in self.deps[name]]
+            if any(s in ('failed', 'blocked') for s in deps):
+                return 'blocked'
+
+            signatures[key] = self.signature(stage, sub)
+            if self.up_to_date(stage, sub, signatures[key]):
+                return 'up to date'
+
+            task = self.task(stage, sub)
+            if task is None:
+                return 'missing inputs'
+            if dry_run:
+                print(f'Would run {name} for {sub}')
+                return 'done'
+
+            fn, args, kwargs = task
+            pools['thread' if stage.kind == 'register' else 'process'].submit(key, fn, *args, **kwargs)
+            return 'running'
+
+        def finish(key, result=None, error=None):
+            sub, name = key
+            if error is not None:
+                print(f'Failed {name} for {sub}: {error}', flush=True)
+                status[key] = 'failed'
+                errors[key] = error
+                return
+
+            print(f'Finished {name} for {sub}', flush=True)
+            status[key] = 'done'
+            record = dict(signature=signatures[key])
+            if self.stages[name].table:
+                record['result'] = result
+            self.state.setdefault(sub, {})[name] = record
+
+        try:
+            while True:
+                # Start stages in order until none is ready.
+                progress = True
+                while progress:
+                    progress = False
+                    for key in list(pending):
+                        if any(status.get((key[0], d), 'running') == 'running' for d in self.deps[key[1]]):
+                            continue
+                        pending.remove(key)
+                        status[key] = start(key)
+                        counts[status[key]] += 1
+                        progress = True
+
+                # Collect finished stages.
+                changed = False
+                for pool in pools.values():
+                    pool.poll()
+                    for key, result in pool.results.items():
+                        # Registration reports failed jobs instead of raising.
+                        if self.stages[key[1]].kind == 'register' and result:
+                            finish(key, error=next(iter(result.values())))
+                        else:
+                            finish(key, result=result)
+                    for key, e in pool.errors.items():
+                        finish(key, error=e)
+                    changed |= bool(pool.results or pool.errors)
+                    pool.results.clear()
+                    pool.errors.clear()
+
+                if changed:
+                    self.save_state()
+                    continue
+                if all(pool.finished for pool in pools.values()):
+                    break
+                time.sleep(0.2)
+
+        except KeyboardInterrupt:
+            for pool in pools.values():
+                pool.cancel()
+            raise
+        finally:
+            for pool in pools.values():
+                pool.shutdown()
+            if not dry_run:
+                self.save_state()
+
+        if not dry_run:
+            self.write_tables(subjects, errors)
+
+        counts['done'] = sum(s == 'done' for s in status.values())
+        counts['failed'] = len(errors)
+        del counts['running']
+        print('Pipeline complete: ' + ', '.join(f'{v} {k}' for k, v in counts.items() if v))
+        return errors
+
+    def write_tables(self, subjects, errors):
+        """Summarize stages writing a table, from current and past results."""
+        for name, stage in self.stages.items():
+            if not stage.table:
+                continue
+            results = {}
+            failed = {}
+            for sub in subjects:
+                if (sub, name) in errors:
+                    failed[sub] = errors[(sub, name)]
+                    continue
+                record = self.state.get(sub, {}).get(name)
+                if record is not None and 'result' in record:
+                    results[sub] = record['result']
+            stage.arg.finish(stage.arg, subjects, results, failed)
+
+
+def main(arg):
+    """Run the pipeline of `python -m SynCT pipeline`."""
+    try:
+        pipeline = Pipeline(load(arg.config), base_dir=arg.base_dir, jobs=arg.jobs, force=arg.force)
+        unknown = pipeline.force - set(pipeline.stages)
+        if unknown:
+            raise ValueError(f'unknown stages: {", ".join(sorted(unknown))}')
+        errors = pipeline.run(dry_run=arg.dry_run)
+    except (OSError, ValueError, RuntimeError) as e:
+        print(f'Error: {e}', file=sys.stderr)
+        return 1
+
+    return 1 if errors else 0
@@ -0,0 +1,313 @@
+import os
+import functools
+
+import dicom2nifti
+import nibabel as nib
+import numpy as np
+import pydicom
+
+import dicom_convert
+import dicom_index
+
+
+# DICOM转NIfTI
+def conv_time(time_str):
+    return (float(time_str[:2]) * 3600 + float(time_str[2:4]) * 60 + float(time_str[4:13]))
+
+
+def suv_factor(header):
+    """由DICOM头信息计算SUV转换系数，header为标签名到值的映射"""
+    total_dose = float(header['RadionuclideTotalDose'])
+    start_time = header['RadiopharmaceuticalStartTime']
+    half_life = float(header['RadionuclideHalfLife'])
+    acq_time = header['AcquisitionTime']
+    weight = float(header['PatientWeight'])
+    time_diff = conv_time(acq_time) - conv_time(start_time)
+    act_dose = total_dose * 0.5 ** (time_diff / half_life)
+    return 1000 * weight / act_dose
+
+
+def calculate_suv_factor(dcm_path):
+    # 只读取头信息，不读取像素数据
+    ds = pydicom.dcmread(str(dcm_path), stop_before_pixels=True)
+    info = ds.RadiopharmaceuticalInformationSequence[0]
+    return suv_factor(dict(
+        RadionuclideTotalDose=info.RadionuclideTotalDose,
+        RadiopharmaceuticalStartTime=info.RadiopharmaceuticalStartTime,
+        RadionuclideHalfLife=info.RadionuclideHalfLife,
+        AcquisitionTime=ds.AcquisitionTime,
+        PatientWeight=ds.PatientWeight,
+    ))
+
+
+def find_series(dicom_dir, modality, index_path=None, **criteria):
+    """
+    从DICOM索引中查找目录下指定模态的序列
+
+    索引按文件修改时间增量更新，未变化的文件不会重新读取。其他关键字参数按序列描述、
+    层数和层厚筛选序列，见dicom_index.matches。有多个序列符合时，取文件最多的序列。
+
+    返回:
+        序列头信息和按InstanceNumber排序的文件列表
+    """
+    with dicom_index.DicomIndex(index_path) as index:
+        index.update(dicom_dir)
+        series = index.series(dicom_dir, modality=modality, **criteria)
+        if not series:
+            raise FileNotFoundError(f"No matching {modality} series found in {dicom_dir}")
+        if len(series) > 1:
+            print(f"{len(series)} {modality} series found in {dicom_dir}, using the largest")
+        uid = max(series, key=lambda s: s['files'])['SeriesInstanceUID']
+        return index.header(uid), index.files(uid, dicom_dir)
+
+
+def convert_series(files, output_file, suv_factor=None, native=True, suv_mode='slope'):
+    """
+    只将选中序列的文件转换为NIfTI，直接写入output_file，返回nibabel图像
+
+    native为True时多线程解码切片并在同一遍中乘以suv_factor，
+    不支持的序列（多帧、层间距不均匀等）使用dicom2nifti转换。suv_mode见convert_pet。
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+
+    if native:
+        try:
+            keep_raw = suv_factor is not None and suv_mode == 'slope'
+            nii = dicom_convert.load_series(files, scale=suv_factor, keep_raw=keep_raw)
+            nib.save(nii, output_file)
+            return nii
+        except ValueError as e:
+            print(f"Native conversion failed ({e}), using dicom2nifti")
+
+    dicoms = [pydicom.dcmread(f, defer_size='1 KB') for f in files]
+    nii = dicom2nifti.convert_dicom.dicom_array_to_nifti(dicoms, output_file, reorient_nifti=True)['NII']
+    if suv_factor is not None:
+        nii = convert_pet(nii, suv_factor, mode=suv_mode)
+        nib.save(nii, output_file)
+    return nii
+
+
+def convert_pet(pet, suv_factor, mode='float32'):
+    """
+    将PET图像转换为SUV单位，保留原头信息
+
+    mode为'slope'时不改写整数体素数据，SUV系数与原有的scl_slope相乘写入头信息，
+    保存后nibabel、SimpleITK等读取时按需缩放；浮点数据乘以系数后以int16和scl_slope保存。
+    mode为'float32'时写出乘以系数后的float32数据，供不读取scl_slope的工具使用。
+    """
+    header = pet.header.copy()
+
+    if mode == 'slope' and np.issubdtype(pet.get_data_dtype(), np.integer):
+        if nib.is_proxy(pet.dataobj):
+            raw = pet.dataobj.get_unscaled()
+            slope, inter = pet.dataobj.slope, pet.dataobj.inter
+        else:
+            raw = np.asanyarray(pet.dataobj)
+            slope, inter = header.get_slope_inter()
+            slope = 1.0 if slope is None else slope
+            inter = 0.0 if inter is None else inter
+
+        pet_suv = nib.Nifti1Image(raw, pet.affine, header)
+        pet_suv.header.set_slope_inter(slope * suv_factor, inter * suv_factor)
+        return pet_suv
+
+    # 直接读取为float32，原位乘以系数
+    pet_suv_data = pet.get_fdata(dtype=np.float32)
+    pet_suv_data *= suv_factor
+    pet_suv = nib.Nifti1Image(pet_suv_data, pet.affine, header)
+    if mode == 'slope':
+        # 不设置缩放，由nibabel保存时选择scl_slope
+        pet_suv.set_data_dtype(np.int16)
+        pet_suv.header.set_slope_inter(None, None)
+    else:
+        pet_suv.set_data_dtype(np.float32)
+        pet_suv.header.set_slope_inter(1, 0)
+    return pet_suv
+
+
+def dicom_to_nifti_ct(dicom_dir, output_file, index_path=None, native=True, **criteria):
+    """将CT的DICOM目录中选中的序列转换为NIfTI文件"""
+    header, files = find_series(dicom_dir, 'CT', index_path, **criteria)
+    convert_series(files, output_file, native=native)
+    return output_file
+
+
+def dicom_to_nifti_pet(dicom_dir, output_file, index_path=None, native=True, suv_mode='slope', **criteria):
+    """将PET的DICOM目录中选中的序列转换为SUV单位的NIfTI文件"""
+    # SUV系数来自索引中的序列头信息
+    header, files = find_series(dicom_dir, 'PT', index_path, **criteria)
+    convert_series(files, output_file, suv_factor=suv_factor(header), native=native, suv_mode=suv_mode)
+    return output_file
+
+
+def dicom_series_to_nifti(series_uid, output_file, index_path=None, native=True, suv_mode='slope'):
+    """将索引中的一个序列转换为NIfTI，PET序列转换为SUV单位"""
+    with dicom_index.DicomIndex(index_path) as index:
+        header = index.header(series_uid)
+        files = index.files(series_uid)
+
+    factor = suv_factor(header) if header['Modality'] == 'PT' else None
+    convert_series(files, output_file, suv_factor=factor, native=native, suv_mode=suv_mode)
+    return output_file
+
+
+# CT Clip
+def load_nifti(file_path):
+    nifti_img = nib.load(file_path)
+    data = nifti_img.get_fdata()
+    affine = nifti_img.affine
+    header = nifti_img.header
+    return data, affine, header
+
+
+# 设置阈值并进行Min-Max归一化
+def threshold_and_normalize(data, min_val: float, max_val: float, normalize: str):
+    # 设置阈值
+    data = np.clip(data, min_val, max_val)
+
+    if normalize == 'True':
+        # Min-Max归一化
+        data_min = np.min(data)
+        data_max = np.max(data)
+        if data_max - data_min == 0:
+            raise ValueError("The data has no variation; min and max values are equal.")
+        normalized_data = (data - data_min) / (data_max - data_min)
+    else:
+        normalized_data = data
+    return normalized_data
+
+
+def save_nifti(data, affine, header, output_file):
+    nifti_img = nib.Nifti1Image(data, affine, header=header)
+    nib.save(nifti_img, output_file)
+
+
+# 整数CT查表加窗：每个体素一次查表，不转换为float64
+@functools.lru_cache(maxsize=16)
+def window_lut(dtype, slope, inter, minimum, maximum, norm_range, out_dtype, out_slope, out_inter):
+    """
+    16位以内整数存储值到输出值的查找表，以dtype的最小值为索引起点
+
+    存储值先按slope和inter缩放，再截断到[minimum, maximum]；norm_range为(data_min, data_max)时
+    归一化到[0, 1]。整数输出按out_slope和out_inter量化。参数相同时重复使用，批量处理时各被试共用。
+    """
+    info = np.iinfo(dtype)
+    values = np.arange(info.min, info.max + 1, dtype=np.float64) * slope + inter
+    values = np.clip(values, minimum, maximum)
+    if norm_range is not None:
+        data_min, data_max = norm_range
+        values = (values - data_min) / (data_max - data_min)
+
+    out_dtype = np.dtype(out_dtype)
+    if out_dtype.kind in 'iu':
+        out_info = np.iinfo(out_dtype)
+        values = np.clip(np.round((values - out_inter) / out_slope), out_info.min, out_info.max)
+
+    lut = values.astype(out_dtype)
+    lut.flags.writeable = False
+    return lut
+
+
+def window_volume(nii, minimum: float, maximum: float, normalize: bool, dtype='float32', slab_voxels=1 << 22):
+    """
+    对整数CT体积查表加窗和归一化，与threshold_and_normalize结果一致
+
+    按最后一个轴分块处理，未压缩的NIfTI通过内存映射按块读取。
+
+    返回:
+        输出数组和需写入头信息的(scl_slope, scl_inter)；不是16位以内整数存储时返回None
+    """
+    raw_dtype = nii.get_data_dtype()
+    if raw_dtype.kind not in 'iu' or raw_dtype.itemsize > 2:
+        return None
+
+    if nib.is_proxy(nii.dataobj):
+        raw = np.asanyarray(nii.dataobj.get_unscaled())
+        slope, inter = float(nii.dataobj.slope), float(nii.dataobj.inter)
+    else:
+        raw = np.asanyarray(nii.dataobj)
+        slope, inter = 1.0, 0.0
+
+    # 沿最后一个轴的块在Fortran顺序的NIfTI数据中是连续的
+    step = max(1, slab_voxels // max(1, int(np.prod(raw.shape[:-1]))))
+    slabs = [np.s_[..., i:i + step] for i in range(0, raw.shape[-1], step)] if raw.ndim else [np.s_[...]]
+
+    # 截断后的最小值和最大值由存储值的范围决定
+    norm_range = None
+    if normalize:
+        low = min(raw[s].min() for s in slabs)
+        high = max(raw[s].max() for s in slabs)
+        ends = np.clip(sorted([low * slope + inter, high * slope + inter]), minimum, maximum)
+        if ends[1] - ends[0] == 0:
+            raise ValueError("The data has no variation; min and max values are equal.")
+        norm_range = (float(ends[0]), float(ends[1]))
+
+    # 整数输出的量化：归一化结果对应[0, 1]，否则对应窗口范围
+    dtype = np.dtype(dtype)
+    out_slope, out_inter = 1.0, 0.0
+    if dtype.kind in 'iu':
+        levels = np.iinfo(dtype).max - max(np.iinfo(dtype).min, 0)
+        if normalize:
+            out_slope = 1.0 / levels
+        else:
+            out_inter = float(minimum)
+            exact = float(minimum).is_integer() and slope.is_integer() and inter.is_integer()
+            out_slope = 1.0 if exact and maximum - minimum <= levels else (maximum - minimum) / levels
+
+    lut = window_lut(raw_dtype, slope, inter, float(minimum), float(maximum), norm_range, dtype.str,
+                     out_slope, out_inter)
+
+    # 有符号值翻转符号位即为相对最小值的偏移
+    flip = raw_dtype.kind == 'i'
+    index_dtype = np.dtype(f'u{raw_dtype.itemsize}')
+    sign = index_dtype.type(1 << (8 * raw_dtype.itemsize - 1))
+
+    out = np.empty(raw.shape, dtype=dtype, order='F')
+    for s in slabs:
+        index = np.asarray(raw[s])
+        if flip:
+            index = index.view(index_dtype) ^ sign
+        out[s] = lut[index]
+
+    return out, (out_slope, out_inter) if dtype.kind in 'iu' else (1, 0)
+
+
+def ct_clip(file_path, output_file, minimum: float, maximum: float, normalize: str, dtype='float32'):
+    """
+    CT截断到[minimum, maximum]，normalize为'True'时Min-Max归一化
+
+    dtype为float32，或uint8、uint16（量化后缩放写入scl_slope和scl_inter）。
+    整数CT查表处理，浮点CT使用threshold_and_normalize。
+    """
+    nii = nib.load(file_path)
+    result = window_volume(nii, minimum, maximum, normalize == 'True', dtype)
+
+    if result is None:
+        data = threshold_and_normalize(nii.get_fdata(dtype=np.float32), minimum, maximum, normalize)
+        scaling = (None, None) if np.dtype(dtype).kind in 'iu' else (1, 0)
+    else:
+        data, scaling = result
+
+    out = nib.Nifti1Image(data, nii.affine, nii.header.copy())
+    out.set_data_dtype(dtype)
+    out.header.set_slope_inter(*scaling)
+    nib.save(out, output_file)
+    return output_file
+
+
+# 使用掩码进行颅骨剥离
+def apply_mask(file_path, mask_path, output_file):
+    img = nib.load(file_path)
+    img_data = img.get_fdata()
+
+    mask = nib.load(mask_path)
+    mask_data = mask.get_fdata()
+
+    # 确保图像和掩码尺寸一致
+    if img_data.shape != mask_data.shape:
+        raise ValueError(f"Image and mask shape mismatch: {img_data.shape} vs {mask_data.shape}")
+
+    # 假设掩码是二值的，1为保留区域，0为背景
+    skull_stripped_img = nib.Nifti1Image(img_data * mask_data, img.affine, img.header)
+    nib.save(skull_stripped_img, output_file)
+    return output_file
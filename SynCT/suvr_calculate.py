@@ -0,0 +1,555 @@
+import os
+import tempfile
+import collections
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import map_coordinates
+
+from label_stats import regional_stats
+
+
+# 重采样
+def separable_axes(matrix, atol=1e-6):
+    """若变换矩阵每列只有一个非零元素（轴对齐或对角），返回每个输出轴对应的原始轴，否则返回None"""
+    nonzero = np.abs(matrix) > atol
+    if not (nonzero.sum(axis=0) == 1).all() or not (nonzero.sum(axis=1) == 1).all():
+        return None
+    return [int(np.argmax(nonzero[:, a])) for a in range(3)]
+
+
+def index_dtype(size):
+    """能表示0到size的最小索引类型，减少缓存索引的内存"""
+    return np.int32 if size < np.iinfo(np.int32).max else np.intp
+
+
+def separable_plan(original_shape, transform_matrix, refer_shape, axes):
+    """轴对齐变换的最近邻索引：每个轴单独计算一维索引后组合"""
+    size = int(np.prod(original_shape))
+    strides = np.cumprod((1,) + tuple(original_shape[:0:-1]))[::-1]
+    plan = np.zeros(refer_shape, dtype=np.intp)
+    invalid = np.zeros(refer_shape, dtype=bool)
+    for a, p in enumerate(axes):
+        # 与map_coordinates(order=0, mode='constant')一致：[0, n-1]之外为0，其余四舍五入
+        coords = np.arange(refer_shape[a]) * transform_matrix[p, a] + transform_matrix[p, 3]
+        valid = (coords >= 0) & (coords <= original_shape[p] - 1)
+        idx = np.where(valid, np.floor(coords + 0.5), 0).astype(np.intp)
+
+        shape = [1, 1, 1]
+        shape[a] = -1
+        plan += (idx * strides[p]).reshape(shape)
+        invalid |= ~valid.reshape(shape)
+
+    # 越界体素指向数据末尾追加的0
+    plan[invalid] = size
+    return plan.astype(index_dtype(size))
+
+
+def slab_plan(original_shape, inv_original_affine, refer_shape, refer_affine, slab_voxels):
+    """一般仿射变换的最近邻索引，沿z方向分块计算坐标，峰值内存只与块大小有关"""
+    size = int(np.prod(original_shape))
+    refer_x, refer_y, refer_z = refer_shape
+    plan = np.empty(refer_shape, dtype=index_dtype(size))
+    slab = max(1, slab_voxels // max(1, refer_x * refer_y))
+
+    for z0 in range(0, refer_z, slab):
+        z1 = min(z0 + slab, refer_z)
+
+        # 当前块的坐标网格
+        i, j, k = np.meshgrid(
+            np.arange(refer_x),
+            np.arange(refer_y),
+            np.arange(z0, z1),
+            indexing='ij'
+        )
+        coords = np.stack([i.ravel(), j.ravel(), k.ravel(), np.ones(i.size)]).T
+        del i, j, k
+
+        # 应用变换矩阵
+        origin_coords = (coords @ refer_affine.T) @ inv_original_affine.T
+        del coords
+
+        # 与map_coordinates(order=0, mode='constant')一致的取整与边界
+        index = np.zeros(len(origin_coords), dtype=np.intp)
+        valid = np.ones(len(origin_coords), dtype=bool)
+        for p, n in enumerate(original_shape):
+            c = origin_coords[:, p]
+            valid &= (c >= 0) & (c <= n - 1)
+            index = index * n + np.clip(np.floor(c + 0.5), 0, n - 1).astype(np.intp)
+        index[~valid] = size
+
+        plan[:, :, z0:z1] = index.reshape(refer_x, refer_y, z1 - z0)
+
+    return plan
+
+
+# 相同几何的重采样索引缓存：同一协议的被试PET网格一致，只需计算一次
+plan_cache = collections.OrderedDict()
+plan_cache_size = 8
+
+
+def nearest_plan(original_shape, original_affine, refer_shape, refer_affine, slab_voxels=1 << 18):
+    """
+    最近邻重采样的取值索引
+
+    返回参考网格形状的数组，值为原始数据展平后的索引，越界体素的值为原始数据体素数。
+    按(原始仿射, 原始尺寸, 参考仿射, 参考尺寸)缓存。
+    """
+    original_shape = tuple(int(n) for n in original_shape[:3])
+    refer_shape = tuple(int(n) for n in refer_shape[:3])
+    original_affine = np.asarray(original_affine, dtype=np.float64)
+    refer_affine = np.asarray(refer_affine, dtype=np.float64)
+
+    key = (original_affine.tobytes(), original_shape, refer_affine.tobytes(), refer_shape)
+    if key in plan_cache:
+        plan_cache.move_to_end(key)
+        return plan_cache[key]
+
+    inv_original_affine = np.linalg.inv(original_affine)
+    transform_matrix = inv_original_affine @ refer_affine
+    axes = separable_axes(transform_matrix[:3, :3])
+    if axes is not None:
+        plan = separable_plan(original_shape, transform_matrix, refer_shape, axes)
+    else:
+        plan = slab_plan(original_shape, inv_original_affine, refer_shape, refer_affine, slab_voxels)
+
+    plan_cache[key] = plan
+    while len(plan_cache) > plan_cache_size:
+        plan_cache.popitem(last=False)
+    return plan
+
+
+def apply_plan(original_data, plan):
+    """按索引取值，越界体素为0"""
+    flat = np.append(original_data.ravel(), 0)
+    return flat[plan]
+
+
+def resample_to_reference(original_data, original_affine, refer_shape, refer_affine,
+                          interpolation_order=0, slab_voxels=1 << 18):
+    """
+    将原始图像数据重采样到参考图像网格
+
+    最近邻插值使用缓存的取值索引，轴对齐时按轴分离计算；其他插值沿z方向分块计算坐标，
+    峰值内存只与块大小有关。
+    """
+    refer_shape = tuple(refer_shape[:3])
+
+    if interpolation_order == 0:
+        plan = nearest_plan(original_data.shape, original_affine, refer_shape, refer_affine, slab_voxels)
+        return apply_plan(original_data, plan)
+
+    inv_original_affine = np.linalg.inv(original_affine)
+    refer_x, refer_y, refer_z = refer_shape
+    new_img = np.empty(refer_shape, dtype=original_data.dtype)
+    slab = max(1, slab_voxels // max(1, refer_x * refer_y))
+
+    for z0 in range(0, refer_z, slab):
+        z1 = min(z0 + slab, refer_z)
+
+        # 当前块的坐标网格
+        i, j, k = np.meshgrid(
+            np.arange(refer_x),
+            np.arange(refer_y),
+            np.arange(z0, z1),
+            indexing='ij'
+        )
+        coords = np.stack([i.ravel(), j.ravel(), k.ravel(), np.ones(i.size)]).T
+        del i, j, k
+
+        # 应用变换矩阵
+        origin_coords = (coords @ refer_affine.T) @ inv_original_affine.T
+        del coords
+
+        # 使用插值获取原始图像值
+        new_img[:, :, z0:z1] = map_coordinates(
+            original_data,
+            origin_coords[:, :3].T.reshape(3, refer_x, refer_y, z1 - z0),
+            order=interpolation_order,
+            mode='constant',
+            cval=0.0
+        )
+
+    return new_img
+
+
+# suvr mapping
+def deform_img_based_on_other_img(original_img_path, refer_img_path, interpolation_order=0):
+    """
+    基于参考图像对原始图像进行空间变换
+    
+    参数:
+        original_img_path: 原始图像路径
+        refer_img_path: 参考图像路径
+        interpolation_order: 插值阶数，默认0为最近邻插值（与MATLAB代码一致）
+    
+    返回:
+        new_img_data: 变换后的图像数据
+        refer_affine: 参考图像的仿射矩阵
+    """
+    # 加载图像（参考图像只需要网格信息）
+    refer_img = nib.load(refer_img_path)
+    original_img = nib.load(original_img_path)
+    
+    # 使用插值获取原始图像值
+    new_img = resample_to_reference(
+        original_img.get_fdata(),
+        original_img.affine,
+        refer_img.shape,
+        refer_img.affine,
+        interpolation_order=interpolation_order
+    )
+    
+    return new_img, refer_img.affine
+
+class PETNormalizerWithRegistration:
+    def __init__(self):
+        self.pet_img = None
+        self.ref_mask_img = None
+        self.pet_data = None
+        self.ref_mask_data = None
+        self.registered_mask = None
+        
+    def load_images(self, pet_path, ref_mask_path):
+        """加载PET图像和参考脑区mask"""
+        try:
+            # 加载PET图像
+            self.pet_img = nib.load(pet_path)
+            self.pet_data = self.pet_img.get_fdata()
+            
+            # 加载参考脑区mask
+            self.ref_mask_img = nib.load(ref_mask_path)
+            self.ref_mask_data = self.ref_mask_img.get_fdata()
+            
+            print(f"PET图像尺寸: {self.pet_data.shape}")
+            print(f"PET图像分辨率: {self.pet_img.header.get_zooms()}")
+            print(f"参考脑区尺寸: {self.ref_mask_data.shape}")
+            print(f"参考脑区分辨率: {self.ref_mask_img.header.get_zooms()}")
+            
+            return True
+            
+        except Exception as e:
+            print(f"图像加载错误: {e}")
+            return False
+    
+    def check_image_compatibility(self):
+        """检查图像兼容性"""
+        pet_shape = self.pet_data.shape
+        ref_shape = self.ref_mask_data.shape
+        pet_affine = self.pet_img.affine
+        ref_affine = self.ref_mask_img.affine
+        
+        # 检查尺寸是否一致
+        shape_match = (pet_shape == ref_shape)
+        
+        # 检查仿射矩阵是否一致（允许小的数值差异）
+        affine_match = np.allclose(pet_affine, ref_affine, atol=1e-3)
+        
+        # 检查分辨率
+        pet_zooms = self.pet_img.header.get_zooms()
+        ref_zooms = self.ref_mask_img.header.get_zooms()
+        resolution_match = np.allclose(pet_zooms, ref_zooms, atol=0.1)
+        
+        print(f"图像尺寸匹配: {shape_match}")
+        print(f"仿射矩阵匹配: {affine_match}")
+        print(f"分辨率匹配: {resolution_match}")
+        
+        return shape_match and affine_match and resolution_match
+    
+    def register_mask_to_pet(self):
+        """
+        使用您提供的MATLAB代码方法将参考脑区mask配准到PET图像空间
+        """
+        print("开始图像配准...")
+        
+        # 保存临时文件用于配准（每次调用使用独立目录，多个进程可同时运行）
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            temp_pet_path = os.path.join(tmp_dir, "temp_pet.nii")
+            temp_mask_path = os.path.join(tmp_dir, "temp_mask.nii")
+
+            try:
+                # 保存临时文件
+                nib.save(self.pet_img, temp_pet_path)
+                nib.save(self.ref_mask_img, temp_mask_path)
+                
+                # 使用配准函数
+                registered_mask_data, pet_affine = deform_img_based_on_other_img(
+                    temp_mask_path, temp_pet_path
+                )
+                
+                # 创建新的mask图像
+                self.registered_mask = nib.Nifti1Image(
+                    registered_mask_data.astype(np.uint8), 
+                    pet_affine, 
+                    self.pet_img.header
+                )
+                
+                print("配准完成")
+                return True
+                
+            except Exception as e:
+                print(f"配准错误: {e}")
+                return False
+    
+    def calculate_suvr(self, use_registered_mask=True):
+        """计算SUVR归一化图像"""
+        print("计算SUVR...")
+        
+        # 选择使用的mask
+        if use_registered_mask and self.registered_mask is not None:
+            mask_data = self.registered_mask.get_fdata()
+        else:
+            mask_data = self.ref_mask_data
+        
+        # 确保mask与PET图像尺寸一致
+        if mask_data.shape != self.pet_data.shape:
+            print("警告: mask与PET图像尺寸不一致，使用配准后的mask")
+            if self.registered_mask is not None:
+                mask_data = self.registered_mask.get_fdata()
+            else:
+                raise ValueError("mask与PET图像尺寸不一致且无配准后的mask")
+        
+        # 提取参考脑区（mask值为1的区域）
+        reference_region = self.pet_data[mask_data == 1]
+        
+        if len(reference_region) == 0:
+            raise ValueError("参考脑区中没有有效的体素，请检查mask文件")
+        
+        # 计算参考脑区的平均强度
+        reference_mean = np.mean(reference_region)
+        print(f"参考脑区平均强度: {reference_mean:.4f}")
+        print(f"参考脑区体素数量: {len(reference_region)}")
+        
+        # 计算SUVR
+        suvr_data = self.pet_data / reference_mean
+        
+        # 创建新的NIfTI图像
+        suvr_img = nib.Nifti1Image(suvr_data, self.pet_img.affine, self.pet_img.header)
+        
+        print(f"SUVR计算完成，范围: [{suvr_data.min():.4f}, {suvr_data.max():.4f}]")
+        
+        return suvr_img, suvr_data
+    
+    def save_suvr_image(self, suvr_img, output_path):
+        """保存SUVR图像"""
+        nib.save(suvr_img, output_path)
+        print(f"SUVR图像已保存至: {output_path}")
+
+
+# SUVR Calculate
+def affine_rows(affine, i, j, k):
+    """按与逐点 `[i, j, k, 1] @ affine.T` 相同的累加顺序对坐标网格应用仿射变换"""
+    return [i * affine[r, 0] + j * affine[r, 1] + k * affine[r, 2] + affine[r, 3] for r in range(3)]
+
+
+def deform_img_based_on_other_img_exact(original_img_path, refer_img_path, threads=None, slab_voxels=1 << 21):
+    """
+    基于参考图像对原始图像进行空间变换
+
+    逐体素取整并裁剪到边界，按x方向分块向量化计算，结果与逐体素循环完全一致。
+    threads: 并行处理的线程数，默认使用全部CPU
+    slab_voxels: 每块的最大体素数，限制临时数组的内存
+    """
+    import concurrent.futures
+
+    # 加载图像
+    refer_img = nib.load(refer_img_path)
+    original_img = nib.load(original_img_path)
+    
+    # 获取图像数据
+    refer_shape = refer_img.shape[:3]
+    original_data = original_img.get_fdata()
+    
+    # 获取仿射矩阵（只求一次逆）
+    refer_affine = refer_img.affine
+    inv_original_affine = np.linalg.inv(original_img.affine)
+    
+    # 获取图像尺寸
+    refer_x, refer_y, refer_z = refer_shape
+    origin_shape = original_data.shape[:3]
+    
+    # 初始化新图像
+    new_img = np.empty(refer_shape)
+
+    # y、z方向的坐标网格，各块共用
+    j, k = np.meshgrid(np.arange(refer_y, dtype=np.float64), np.arange(refer_z, dtype=np.float64), indexing='ij')
+    slab = max(1, slab_voxels // max(1, refer_y * refer_z))
+
+    def process(x0):
+        x1 = min(x0 + slab, refer_x)
+        i = np.arange(x0, x1, dtype=np.float64)[:, None, None]
+
+        # 物理坐标转换，再转换到原始图像坐标空间
+        physical = affine_rows(refer_affine, i, j, k)
+        origin = affine_rows(inv_original_affine, *physical)
+
+        # 取整并进行边界检查
+        index = [np.clip(np.round(c).astype(int), 0, n - 1) for c, n in zip(origin, origin_shape)]
+
+        # 赋值
+        new_img[x0:x1] = original_data[index[0], index[1], index[2]]
+
+    threads = threads or os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(process, range(0, refer_x, slab)))
+
+    return new_img, refer_affine
+
+def save_registered_image(registered_data, affine_matrix, output_path, dtype=None):
+    """
+    保存配准后的图像
+    """
+    if dtype is not None:
+        registered_data = registered_data.astype(dtype)
+    
+    registered_img = nib.Nifti1Image(registered_data, affine_matrix)
+    nib.save(registered_img, output_path)
+
+def register_and_save(original_img_path, refer_img_path, output_path, 
+                      method='vectorized', interpolation_order=0, dtype=None):
+    """
+    配准并保存图像的完整函数
+    """
+    # 选择配准方法
+    if method == 'exact':
+        registered_data, affine = deform_img_based_on_other_img_exact(
+            original_img_path, refer_img_path
+        )
+    else:
+        registered_data, affine = deform_img_based_on_other_img(
+            original_img_path, refer_img_path, interpolation_order
+        )
+    
+    # 保存配准后的图像
+    save_registered_image(registered_data, affine, output_path, dtype)
+    
+    return registered_data, affine
+
+def label_suvr(label_data, suv_data, labels):
+    # 一次遍历计算所有label的SUV均值（忽略NaN）
+    stats = regional_stats(label_data, suv_data, labels)
+
+    # 初始化一个字典来存储每个label的SUVR
+    label_suvr = {}
+    for label, region_mean in zip(labels, stats['mean']):
+        label_suvr[f'Label{label}'] = region_mean
+
+    return label_suvr
+
+def calculate_label_suvr(label_path, suv_path, labels):
+    # 读取label文件
+    label_img = nib.load(label_path)
+    label_data = label_img.get_fdata()
+
+    # 读取SUV文件
+    suv_img = nib.load(suv_path)
+    suv_data = suv_img.get_fdata()
+
+    return label_suvr(label_data, suv_data, labels)
+
+def suvr_compute(label_path, pet_path, labels):
+    label_path = os.path.join(label_path)
+    pet_path = os.path.join(pet_path)
+
+    # 计算每个label的SUVR
+    label_suvr = calculate_label_suvr(label_path, pet_path, labels)
+
+    return label_suvr
+
+def compute_subject_suvr(pet_path, label_path, labels, label_output=None):
+    """
+    将标签图像配准到PET空间后计算各标签的SUVR
+
+    配准在内存中完成，PET几何相同的被试复用缓存的重采样索引。
+    label_output: 若指定，同时保存配准到PET空间的标签图像
+    """
+    pet_img = nib.load(pet_path)
+    label_img = nib.load(label_path)
+
+    # 配准标签图像到PET图像空间
+    label_data = resample_to_reference(
+        label_img.get_fdata(dtype=np.float32),
+        label_img.affine,
+        pet_img.shape,
+        pet_img.affine,
+        interpolation_order=0
+    )
+
+    if label_output is not None:
+        save_registered_image(label_data, pet_img.affine, label_output, np.float32)
+
+    # 计算SUVR
+    return label_suvr(label_data, pet_img.get_fdata(), labels)
+
+def suvr_mapping(pet_path, ref_mask_path, output_path):
+    """以参考脑区（mask值为1）的平均强度归一化PET图像并保存"""
+    normalizer = PETNormalizerWithRegistration()
+
+    if not normalizer.load_images(pet_path, ref_mask_path):
+        raise RuntimeError(f"图像加载失败: {pet_path}, {ref_mask_path}")
+
+    # 检查图像兼容性
+    if not normalizer.check_image_compatibility():
+        print("图像不兼容，进行配准...")
+        if not normalizer.register_mask_to_pet():
+            print("配准失败，使用原始mask")
+    else:
+        print("图像兼容，跳过配准步骤")
+
+    # 计算SUVR
+    suvr_img, suvr_data = normalizer.calculate_suvr(use_registered_mask=True)
+    normalizer.save_suvr_image(suvr_img, output_path)
+    return output_path
+
+def save_suvr_results(subdirs, suvr_results, errors, label_maps, output_path):
+    """按子文件夹顺序将SUVr结果保存到Excel文件，失败的被试保留空值"""
+    import pandas as pd
+
+    # 准备结果数据结构
+    results = {
+        'Folder': [],
+    }
+
+    # 为每个标签添加列
+    for label in label_maps:
+        results[f'Label_{label}'] = []
+
+    for subdir in subdirs:
+        if subdir in suvr_results:
+            suvr_result = suvr_results[subdir]
+        elif subdir in errors:
+            # 添加空值以保持数据对齐
+            suvr_result = {}
+        else:
+            continue
+
+        results['Folder'].append(subdir)
+
+        # 添加每个标签的值
+        for label in label_maps:
+            # 使用正确的键名，与suvr_compute返回的键一致
+            results[f'Label_{label}'].append(suvr_result.get(f'Label{label}'))
+
+    # 保存结果到Excel文件
+    df = pd.DataFrame(results)
+
+    # 确保输出目录存在
+    output_dir = os.path.dirname(output_path)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    # 使用openpyxl引擎以支持格式设置
+    with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name='SUVr_Results')
+
+        # 获取工作表对象进行格式设置
+        worksheet = writer.sheets['SUVr_Results']
+
+        # 设置列宽
+        worksheet.column_dimensions['A'].width = 20  # Folder列
+
+        # 设置标签列的宽度
+        for col_idx, col_name in enumerate(df.columns[1:], 2):  # 从第2列开始
+            col_letter = chr(64 + col_idx)  # A=65, B=66, etc.
+            worksheet.column_dimensions[col_letter].width = 12
+
+    print(f"结果已保存到: {output_path}")
@@ -0,0 +1,637 @@
+"""In-process SynthStrip skull-stripping.
+
+SynthStrip: Skull-Stripping for Any Brain Image
+A Hoopes, JS Mora, AV Dalca, B Fischl, M Hoffmann
+NeuroImage 206 (2022), 119474
+https://doi.org/10.1016/j.neuroimage.2022.119474
+"""
+
+import os
+import concurrent.futures
+
+import numpy as np
+import surfa as sf
+import torch
+import torch.nn as nn
+
+
+class StripModel(nn.Module):
+
+    def __init__(self,
+                 nb_features=16,
+                 nb_levels=7,
+                 feat_mult=2,
+                 max_features=64,
+                 nb_conv_per_level=2,
+                 max_pool=2,
+                 return_mask=False):
+
+        super().__init__()
+
+        # dimensionality
+        ndims = 3
+
+        # build feature list automatically
+        if isinstance(nb_features, int):
+            if nb_levels is None:
+                raise ValueError('must provide unet nb_levels if nb_features is an integer')
+            feats = np.round(nb_features * feat_mult ** np.arange(nb_levels)).astype(int)
+            feats = np.clip(feats, 1, max_features)
+            nb_features = [
+                np.repeat(feats[:-1], nb_conv_per_level),
+                np.repeat(np.flip(feats), nb_conv_per_level)
+            ]
+        elif nb_levels is not None:
+            raise ValueError('cannot use nb_levels if nb_features is not an integer')
+
+        # extract any surplus (full resolution) decoder convolutions
+        enc_nf, dec_nf = nb_features
+        nb_dec_convs = len(enc_nf)
+        final_convs = dec_nf[nb_dec_convs:]
+        dec_nf = dec_nf[:nb_dec_convs]
+        self.nb_levels = int(nb_dec_convs / nb_conv_per_level) + 1
+
+        if isinstance(max_pool, int):
+            max_pool = [max_pool] * self.nb_levels
+
+        # cache downsampling / upsampling operations
+        MaxPooling = getattr(nn, 'MaxPool%dd' % ndims)
+        self.pooling = [MaxPooling(s) for s in max_pool]
+        self.upsampling = [nn.Upsample(scale_factor=s, mode='nearest') for s in max_pool]
+
+        # configure encoder (down-sampling path)
+        prev_nf = 1
+        encoder_nfs = [prev_nf]
+        self.encoder = nn.ModuleList()
+        for level in range(self.nb_levels - 1):
+            convs = nn.ModuleList()
+            for conv in range(nb_conv_per_level):
+                nf = enc_nf[level * nb_conv_per_level + conv]
+                convs.append(ConvBlock(ndims, prev_nf, nf))
+                prev_nf = nf
+            self.encoder.append(convs)
+            encoder_nfs.append(prev_nf)
+
+        # configure decoder (up-sampling path)
+        encoder_nfs = np.flip(encoder_nfs)
+        self.decoder = nn.ModuleList()
+        for level in range(self.nb_levels - 1):
+            convs = nn.ModuleList()
+            for conv in range(nb_conv_per_level):
+                nf = dec_nf[level * nb_conv_per_level + conv]
+                convs.append(ConvBlock(ndims, prev_nf, nf))
+                prev_nf = nf
+            self.decoder.append(convs)
+            if level < (self.nb_levels - 1):
+                prev_nf += encoder_nfs[level]
+
+        # now we take care of any remaining convolutions
+        self.remaining = nn.ModuleList()
+        for num, nf in enumerate(final_convs):
+            self.remaining.append(ConvBlock(ndims, prev_nf, nf))
+            prev_nf = nf
+
+        # final convolutions
+        if return_mask:
+            self.remaining.append(ConvBlock(ndims, prev_nf, 2, activation=None))
+            self.remaining.append(nn.Softmax(dim=1))
+        else:
+            self.remaining.append(ConvBlock(ndims, prev_nf, 1, activation=None))
+
+    def forward(self, x):
+
+        # encoder forward pass
+        x_history = [x]
+        for level, convs in enumerate(self.encoder):
+            for conv in convs:
+                x = conv(x)
+            x_history.append(x)
+            x = self.pooling[level](x)
+
+        # decoder forward pass with upsampling and concatenation
+        for level, convs in enumerate(self.decoder):
+            for conv in convs:
+                x = conv(x)
+            if level < (self.nb_levels - 1):
+                x = self.upsampling[level](x)
+                x = torch.cat([x, x_history.pop()], dim=1)
+
+        # remaining convs at full resolution
+        for conv in self.remaining:
+            x = conv(x)
+
+        return x
+
+
+class ConvBlock(nn.Module):
+    """
+    Specific convolutional block followed by leakyrelu for unet.
+    """
+
+    def __init__(self, ndims, in_channels, out_channels, stride=1, activation='leaky'):
+        super().__init__()
+
+        Conv = getattr(nn, 'Conv%dd' % ndims)
+        self.conv = Conv(in_channels, out_channels, 3, stride, 1)
+        if activation == 'leaky':
+            self.activation = nn.LeakyReLU(0.2)
+        elif activation == None:
+            self.activation = None
+        else:
+            raise ValueError(f'Unknown activation: {activation}')
+
+    def forward(self, x):
+        out = self.conv(x)
+        if self.activation is not None:
+            out = self.activation(out)
+        return out
+
+
+def extend_sdt(sdt, border=1):
+    """Extend SynthStrip's narrow-band signed distance transform (SDT).
+
+    Recompute the positive outer part of the SDT estimated by SynthStrip, for
+    borders that likely exceed the 4-5 mm band. Keeps the negative inner part
+    intact and only computes the outer part where needed to save time.
+
+    Parameters
+    ----------
+    sdt : sf.Volume
+        Narrow-band signed distance transform estimated by SynthStrip.
+    border : float, optional
+        Mask border threshold in millimeters.
+
+    Returns
+    -------
+    sdt : sf.Volume
+        Extended SDT.
+
+    """
+    if border < int(sdt.max()):
+        return sdt
+
+    # Find bounding box.
+    mask = sdt < 1
+    keep = np.nonzero(mask)
+    low = np.min(keep, axis=-1)
+    upp = np.max(keep, axis=-1)
+
+    # Add requested border.
+    gap = int(border + 0.5)
+    low = (max(i - gap, 0) for i in low)
+    upp = (min(i + gap, d - 1) for i, d in zip(upp, mask.shape))
+
+    # Compute EDT within bounding box. Keep interior values.
+    ind = tuple(slice(a, b + 1) for a, b in zip(low, upp))
+    out = np.full_like(sdt, fill_value=100)
+    out[ind] = sf.Volume(mask[ind]).distance()
+    out[keep] = sdt[keep]
+
+    return sdt.new(out)
+
+
+def head_bbox(frame, threshold=0.1, margin=10):
+    """Bounding box of the head in a single-frame volume.
+
+    Voxels brighter than `threshold` of the range between the minimum and the
+    99th percentile count as head. Unlike `sf.Volume.bbox`, this also works
+    for CT, where air is not zero.
+
+    Parameters
+    ----------
+    frame : sf.Volume
+        Single-frame volume.
+    threshold : float, optional
+        Foreground threshold as a fraction of the intensity range.
+    margin : float, optional
+        Margin added to the box in millimeters.
+
+    Returns
+    -------
+    tuple of slice
+        Bounding box as an index expression.
+
+    """
+    data = frame.data
+
+    # Estimate the intensity range from a subsample, the full image is large.
+    sample = data[::4, ::4, ::4]
+    low = sample.min()
+    high = np.percentile(sample, 99)
+    mask = data > low + threshold * (high - low)
+    if not mask.any():
+        return tuple(slice(0, n) for n in data.shape[:3])
+
+    gap = np.ceil(margin / np.asarray(frame.geom.voxsize)).astype(int)
+    box = []
+    for axis in range(3):
+        other = tuple(a for a in range(3) if a != axis)
+        keep = np.flatnonzero(mask.any(axis=other))
+        start = max(keep[0] - gap[axis], 0)
+        stop = min(keep[-1] + 1 + gap[axis], data.shape[axis])
+        box.append(slice(start, stop))
+
+    return tuple(box)
+
+
+def conform(frame, margin=10, box=None):
+    """Prepare a frame for SynthStrip.
+
+    Crops to the head, resamples to 1-mm isotropic voxels in LIA orientation,
+    normalizes intensities, and pads or crops to the smallest multiple of 64,
+    within 192 to 320 voxels, so that every UNet level pools evenly. The
+    geometry of the result stays exact, so that outputs map back to the
+    native grid with `resample_like`.
+
+    Parameters
+    ----------
+    frame : sf.Volume
+        Single-frame volume.
+    margin : float, optional
+        Margin around the head in millimeters.
+    box : tuple of slice, optional
+        Head bounding box, shared by frames so that they stack into a batch.
+        Defaults to the bounding box of the frame.
+
+    Returns
+    -------
+    conformed : sf.Volume
+        Network input.
+
+    """
+    if box is None:
+        box = head_bbox(frame, margin=margin)
+    cropped = frame[box]
+    conformed = cropped.conform(voxsize=1.0, dtype='float32', method='nearest', orientation='LIA')
+
+    # Normalize before padding, so that padding matches the background.
+    conformed = normalize(conformed)
+
+    target_shape = np.clip(np.ceil(np.array(conformed.shape[:3]) / 64).astype(int) * 64, 192, 320)
+    return conformed.reshape(target_shape)
+
+
+def normalize(image):
+    image = image - image.min()
+    return (image / image.percentile(99)).clip(0, 1)
+
+
+def model_file(no_csf=False, version='1'):
+    """Path to the SynthStrip weights.
+
+    Uses weights shipped next to this module, or those of the FreeSurfer
+    installation in FREESURFER_HOME.
+
+    """
+    name = f'synthstrip.nocsf.{version}.pt' if no_csf else f'synthstrip.{version}.pt'
+    local = os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+    if os.path.isfile(local):
+        return local
+
+    fshome = os.environ.get('FREESURFER_HOME')
+    if fshome is None:
+        raise FileNotFoundError(f'SynthStrip weights {name} not found, set FREESURFER_HOME or pass a model file')
+    return os.path.join(fshome, 'models', name)
+
+
+def load_model(path, device='cpu'):
+    """Build StripModel and load a SynthStrip checkpoint."""
+    with torch.no_grad():
+        model = StripModel()
+        model.to(device)
+        model.eval()
+
+    checkpoint = torch.load(path, map_location=device)
+    model.load_state_dict(checkpoint['model_state_dict'])
+    return model
+
+
+def model_format(path):
+    """Format of a model file by extension: 'onnx', 'torchscript', or 'checkpoint'."""
+    if path.endswith('.onnx'):
+        return 'onnx'
+    if path.endswith(('.ts', '.torchscript', '.jit')):
+        return 'torchscript'
+    return 'checkpoint'
+
+
+def bf16_supported():
+    """Whether the CPU has native bfloat16 instructions for oneDNN convolutions."""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def export_model(model, output, shape=(192, 192, 192), opset=17):
+    """Export SynthStrip weights to TorchScript or ONNX.
+
+    The model is traced on a zero image of `shape`. The exported graph accepts
+    any batch size and any spatial shape that is a multiple of 64.
+
+    Parameters
+    ----------
+    model : str
+        SynthStrip checkpoint.
+    output : str
+        Exported file. Extension `.onnx` exports ONNX, `.ts`, `.torchscript`
+        or `.jit` export TorchScript.
+    shape : tuple of int, optional
+        Spatial shape of the tracing input.
+    opset : int, optional
+        ONNX opset version.
+
+    Returns
+    -------
+    output : str
+        Exported file.
+
+    """
+    fmt = model_format(output)
+    if fmt == 'checkpoint':
+        raise ValueError(f'unknown export format for {output}, use .onnx or .ts')
+
+    net = load_model(model)
+    example = torch.zeros((1, 1, *shape))
+
+    if fmt == 'torchscript':
+        with torch.no_grad():
+            traced = torch.jit.trace(net, example)
+            traced = torch.jit.freeze(traced)
+        traced.save(output)
+    else:
+        dims = {0: 'batch', 2: 'x', 3: 'y', 4: 'z'}
+        with torch.no_grad():
+            torch.onnx.export(net, example, output, input_names=['image'], output_names=['sdt'],
+                              dynamic_axes=dict(image=dims, sdt=dims), opset_version=opset)
+
+    return output
+
+
+def parity(model, exported, shape=(192, 192, 192), seed=0, **kwargs):
+    """Largest absolute SDT difference between a checkpoint and another model.
+
+    Both run on the same random input through `StripEngine`, so that the
+    comparison covers the optimized runtime too.
+
+    Parameters
+    ----------
+    model : str
+        SynthStrip checkpoint, run eagerly in float32.
+    exported : str
+        Model to compare, of any supported format.
+    shape : tuple of int, optional
+        Spatial shape of the test input.
+    **kwargs
+        Runtime options of the exported model, passed to `StripEngine`.
+
+    """
+    inp = np.random.default_rng(seed).random((1, 1, *shape), dtype=np.float32)
+    reference = StripEngine(model, channels_last=False).forward(inp)
+    result = StripEngine(exported, **kwargs).forward(inp)
+    return float(np.abs(reference - result).max())
+
+
+class StripEngine:
+    """Skull-strip many images with one loaded SynthStrip model.
+
+    Building the network and reading the checkpoint take longer than
+    stripping a typical image. The engine does both once, so that batches
+    only pay for inference.
+
+    Parameters
+    ----------
+    model : str, optional
+        Model weights. Defaults to `model_file(no_csf)`. A checkpoint runs the
+        PyTorch model, an `.onnx` or `.ts` file runs a model exported with
+        `export_model`, using onnxruntime or TorchScript.
+    no_csf : bool, optional
+        Exclude CSF from the brain border, if using the default weights.
+    gpu : bool, optional
+        Run on the GPU.
+    threads : int, optional
+        PyTorch CPU threads, PyTorch default if unset.
+    conform : bool, optional
+        Crop to the head and resample to 1 mm before inference. Otherwise, run
+        on the native grid, only padded to a multiple of 64.
+    frame_batch : int, optional
+        Frames per forward pass for multi-frame images, such as dynamic PET.
+        Bounds the memory of inference.
+    precision : str, optional
+        'float32', or 'bfloat16' for autocasting convolutions on CPUs with
+        native bfloat16 support. Ignored by ONNX models.
+    channels_last : bool, optional
+        Use the channels-last 3D memory format, which oneDNN convolutions on
+        the CPU run faster with. Applies to checkpoints only: exported models
+        keep the memory format they were traced with.
+
+    """
+
+    def __init__(self, model=None, no_csf=False, gpu=False, threads=None, conform=True, frame_batch=4,
+                 precision='float32', channels_last=True):
+        if gpu and not torch.cuda.is_available():
+            raise RuntimeError('GPU requested but CUDA is not available')
+        self.device = torch.device('cuda' if gpu else 'cpu')
+        self.conform = conform
+        self.frame_batch = max(1, frame_batch)
+        self.post_threads = threads or os.cpu_count() or 1
+
+        if threads is not None:
+            torch.set_num_threads(threads)
+
+        # necessary for speed gains (I think)
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cudnn.deterministic = True
+
+        self.model_file = model or model_file(no_csf)
+        self.format = model_format(self.model_file)
+        self.session = None
+        self.model = None
+
+        if self.format == 'onnx':
+            try:
+                import onnxruntime as ort
+            except ImportError:
+                raise RuntimeError('running ONNX models requires onnxruntime')
+
+            options = ort.SessionOptions()
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if threads is not None:
+                options.intra_op_num_threads = threads
+            providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if gpu else ['CPUExecutionProvider']
+            self.session = ort.InferenceSession(self.model_file, options, providers=providers)
+            self.input_name = self.session.get_inputs()[0].name
+        elif self.format == 'torchscript':
+            self.model = torch.jit.load(self.model_file, map_location=self.device)
+            self.model.eval()
+        else:
+            self.model = load_model(self.model_file, self.device)
+
+        # Frozen TorchScript models have their weights inlined as constants, which
+        # `to` cannot convert, and converting only the input slows them down.
+        self.channels_last = channels_last and self.format == 'checkpoint'
+        if self.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last_3d)
+
+        if precision not in ('float32', 'bfloat16'):
+            raise ValueError(f'unknown precision {precision}, use float32 or bfloat16')
+        self.autocast = precision == 'bfloat16' and self.model is not None
+        if self.autocast and not gpu and not bf16_supported():
+            print('CPU lacks native bfloat16 support, running in float32')
+            self.autocast = False
+
+    def forward(self, inp):
+        """Run the network on a batch of normalized images.
+
+        Parameters
+        ----------
+        inp : np.ndarray
+            Float32 array of shape (batch, 1, x, y, z), with spatial sizes
+            that are multiples of 64.
+
+        Returns
+        -------
+        sdt : np.ndarray
+            Float32 array of shape (batch, x, y, z).
+
+        """
+        if self.session is not None:
+            return self.session.run(None, {self.input_name: np.ascontiguousarray(inp)})[0][:, 0]
+
+        inp = torch.from_numpy(inp).to(self.device)
+        if self.channels_last:
+            inp = inp.contiguous(memory_format=torch.channels_last_3d)
+
+        with torch.inference_mode(), torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=self.autocast):
+            sdt = self.model(inp)[:, 0]
+
+        return sdt.float().cpu().numpy()
+
+    def prepare(self, frame, box=None):
+        """Network input of a single-frame volume."""
+        if self.conform:
+            return conform(frame, box=box)
+
+        conformed = normalize(frame.new(frame.data.astype('float32')))
+        target_shape = np.ceil(np.array(conformed.shape[:3]) / 64).astype(int) * 64
+        return conformed.reshape(target_shape)
+
+    def predict(self, conformed):
+        """Estimate the SDT of prepared frames of equal shape in one forward pass."""
+        inp = np.stack([c.data for c in conformed])[:, np.newaxis]
+        sdt = self.forward(inp)
+        return [c.new(s) for c, s in zip(conformed, sdt)]
+
+    def strip(self, image, border=1, frame_batch=None):
+        """Compute the brain mask of an image.
+
+        Frames are prepared and post-processed in threads and run through the
+        network in batches of `frame_batch`.
+
+        Parameters
+        ----------
+        image : sf.Volume or str
+            Input image or its path.
+        border : float, optional
+            Mask border threshold in millimeters.
+        frame_batch : int, optional
+            Frames per forward pass, defaults to that of the engine.
+
+        Returns
+        -------
+        mask : sf.Volume
+            Binary brain mask, with the frames of the image.
+        dist : sf.Volume
+            Signed distance transform to the brain border.
+
+        """
+        if isinstance(image, str):
+            image = sf.load_volume(image)
+        frame_batch = max(1, frame_batch or self.frame_batch)
+
+        # frames share one bounding box, so that they have the same shape
+        box = None
+        if self.conform:
+            box = head_bbox(image.max(frames=True) if image.nframes > 1 else image)
+
+        def frame(f):
+            return self.prepare(image.new(image.framed_data[..., f]), box=box)
+
+        def finish(sdt):
+            # extend the sdt if needed, unconform
+            sdt = extend_sdt(sdt, border=border)
+            sdt = sdt.resample_like(image, fill=100)
+
+            # extract mask, find largest CC to be safe
+            return sdt, (sdt < border).connected_component_mask(k=1, fill=True)
+
+        # post-processing of a batch overlaps inference of the next
+        results = []
+        with concurrent.futures.ThreadPoolExecutor(self.post_threads) as executor:
+            for start in range(0, image.nframes, frame_batch):
+                frames = range(start, min(start + frame_batch, image.nframes))
+                conformed = list(executor.map(frame, frames))
+                results += [executor.submit(finish, sdt) for sdt in self.predict(conformed)]
+                del conformed
+
+            results = [r.result() for r in results]
+
+        dist = [sdt for sdt, _ in results]
+        mask = [m for _, m in results]
+        return image.new(sf.stack(mask)), image.new(sf.stack(dist))
+
+    def run(self, image, out=None, mask=None, sdt=None, border=1, fill=None):
+        """Skull-strip an image file and save the requested outputs.
+
+        Parameters
+        ----------
+        image : str
+            Input image.
+        out, mask, sdt : str, optional
+            Files for the stripped image, the binary brain mask, and the
+            distance transform.
+        border : float, optional
+            Mask border threshold in millimeters.
+        fill : float, optional
+            Background fill value, defaults to min(image.min, 0).
+
+        Returns
+        -------
+        out : str
+            Stripped image file.
+
+        """
+        if not out and not mask and not sdt:
+            raise ValueError('Must provide at least one output: stripped image, mask, or distance transform')
+
+        image = sf.load_volume(image)
+        brain, dist = self.strip(image, border=border)
+
+        if out:
+            fill = np.min([image.min(), 0]) if fill is None else fill
+            image[brain == 0] = fill
+            image.save(out)
+
+        if mask:
+            brain.save(mask)
+
+        if sdt:
+            dist.save(sdt)
+
+        return out
+
+
+# Engines by model file and threads, loaded once per process.
+engines = {}
+
+
+def get_engine(model=None, no_csf=False, threads=None, **kwargs):
+    """Shared engine of the current process, loading it on first use.
+
+    Keyword arguments are passed to `StripEngine`.
+
+    """
+    key = (model or model_file(no_csf), threads, tuple(sorted(kwargs.items())))
+    if key not in engines:
+        engines[key] = StripEngine(model=key[0], threads=threads, **kwargs)
+    return engines[key]
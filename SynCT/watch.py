@@ -0,0 +1,220 @@
+"""Convert DICOM series as they arrive in an inbox folder.
+
+    python -m SynCT watch INBOX --output-dir DIR [--pipeline FILE]
+
+The inbox is polled and indexed incrementally. A series is complete when its
+number of files and their latest modification time stayed the same for a
+settling period, and it is then converted to NIfTI, PET in SUV units, in the
+subject folder named after its PatientID. Conversions run while the scanner
+keeps exporting other series. With a pipeline file, the pipeline runs over
+the output directory whenever conversions finished, skipping the stages and
+subjects that are up to date.
+
+Converted series are recorded in `.synct_watch.json` in the output
+directory, so that a restarted watcher only converts series that are new or
+that changed since.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import threading
+
+import batch_processing
+import dicom_index
+import preprocess
+
+
+def subject_name(patient_id):
+    """Folder name for a patient ID."""
+    return re.sub(r'[^\w.-]', '_', patient_id or 'unknown')
+
+
+class Watcher:
+    """Poll an inbox folder and convert complete series.
+
+    Parameters
+    ----------
+    inbox : str
+        Folder receiving DICOM files.
+    output_dir : str
+        Directory of subject folders receiving the NIfTI files.
+    outputs : dict
+        Output file name by modality. Series of other modalities are ignored.
+    settle : float, optional
+        Seconds a series must stay unchanged to be considered complete.
+    jobs : int, optional
+        Number of conversion processes.
+    index_path : str, optional
+        DICOM index database.
+    native : bool, optional
+        Decode slices in threads rather than with dicom2nifti.
+    suv_mode : str, optional
+        Storage of PET in SUV units, see `preprocess.convert_pet`.
+    criteria : dict, optional
+        Series selection, see `dicom_index.matches`.
+    pipeline : dict, optional
+        Pipeline definition run over the output directory after conversions.
+
+    """
+
+    def __init__(self, inbox, output_dir, outputs, settle=60, jobs=None, index_path=None, native=True,
+                 suv_mode='slope', criteria=None, pipeline=None):
+        self.inbox = inbox
+        self.output_dir = output_dir
+        self.outputs = outputs
+        self.settle = settle
+        self.native = native
+        self.suv_mode = suv_mode
+        self.criteria = criteria or {}
+        self.pipeline = pipeline
+
+        os.makedirs(output_dir, exist_ok=True)
+        self.index = dicom_index.DicomIndex(index_path)
+        self.executor = batch_processing.BatchExecutor(jobs, persistent=True)
+
+        # Series stamp and when it was first seen, by series UID
+        self.seen = {}
+        self.running = {}
+        self.state_file = os.path.join(output_dir, '.synct_watch.json')
+        self.state = self.load_state()
+
+        self.pipeline_thread = None
+        self.pipeline_due = False
+
+    def load_state(self):
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self):
+        tmp = f'{self.state_file}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(tmp, self.state_file)
+
+    def complete(self, series, now):
+        """Check if a series stopped changing for the settling period."""
+        uid = series['SeriesInstanceUID']
+        stamp = [series['files'], series['mtime_ns']]
+        if uid not in self.seen or self.seen[uid][0] != stamp:
+            self.seen[uid] = (stamp, now)
+        return now - self.seen[uid][1] >= self.settle
+
+    def poll(self):
+        """Index the inbox, start converting complete series, and collect finished ones."""
+        self.index.update(self.inbox)
+        now = time.monotonic()
+
+        for series in self.index.series(self.inbox, **self.criteria):
+            uid = series['SeriesInstanceUID']
+            name = self.outputs.get(series['Modality'])
+            if name is None or uid in self.running or not self.complete(series, now):
+                continue
+
+            stamp = self.seen[uid][0]
+            record = self.state.get(uid)
+            if record is not None and record['stamp'] == stamp:
+                continue
+
+            # A subject gets one series per modality, the first to complete
+            output = os.path.join(self.output_dir, subject_name(series['PatientID']), name)
+            owner = next((k for k, r in self.state.items() if r['output'] == output and k != uid), None)
+            if owner is not None:
+                if record is None:
+                    print(f'Skipping series {uid}: {output} was converted from series {owner}')
+                    self.state[uid] = dict(output=None, stamp=stamp)
+                    self.save_state()
+                continue
+
+            print(f'Converting {series["Modality"]} series "{series.get("SeriesDescription")}" to {output}')
+            self.running[uid] = (output, stamp)
+            self.executor.submit(uid, preprocess.dicom_series_to_nifti, uid, output, self.index.path, self.native,
+                                 self.suv_mode)
+
+        self.executor.poll()
+        changed = False
+        for uid in list(self.executor.results):
+            del self.executor.results[uid]
+            output, stamp = self.running.pop(uid)
+            self.state[uid] = dict(output=output, stamp=stamp)
+            print(f'Converted {output}')
+            changed = True
+            self.pipeline_due = self.pipeline is not None
+
+        # Failed series are retried when they change
+        for uid, e in list(self.executor.errors.items()):
+            del self.executor.errors[uid]
+            output, stamp = self.running.pop(uid)
+            self.state[uid] = dict(output=None, stamp=stamp, error=str(e))
+            changed = True
+
+        if changed:
+            self.save_state()
+
+        # Run the pipeline once the current conversions finished
+        if self.pipeline_due and not self.running and not self.pipeline_busy:
+            self.pipeline_due = False
+            self.pipeline_thread = threading.Thread(target=self.run_pipeline, daemon=True)
+            self.pipeline_thread.start()
+
+    @property
+    def pipeline_busy(self):
+        return self.pipeline_thread is not None and self.pipeline_thread.is_alive()
+
+    def run_pipeline(self):
+        import pipeline
+
+        try:
+            pipeline.Pipeline(self.pipeline, base_dir=self.output_dir).run()
+        except (OSError, ValueError, RuntimeError) as e:
+            print(f'Pipeline failed: {e}')
+
+    def run(self, interval=10):
+        """Poll until interrupted."""
+        print(f'Watching {self.inbox}')
+        try:
+            while True:
+                self.poll()
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print('Stopping, waiting for running conversions')
+        finally:
+            self.executor.run()
+            self.executor.shutdown()
+            if self.pipeline_busy:
+                self.pipeline_thread.join()
+            self.index.close()
+
+
+def main(arg):
+    """Run the watcher of `python -m SynCT watch`."""
+    import batch_cli
+
+    if not os.path.isdir(arg.inbox):
+        print(f'Inbox does not exist: {arg.inbox}', file=sys.stderr)
+        return 1
+
+    config = None
+    if arg.pipeline:
+        import pipeline
+        config = pipeline.load(arg.pipeline)
+
+    watcher = Watcher(
+        arg.inbox,
+        arg.output_dir,
+        outputs={'CT': arg.ct_output, 'PT': arg.pet_output},
+        settle=arg.settle,
+        jobs=arg.jobs,
+        index_path=arg.index,
+        native=not arg.dicom2nifti,
+        suv_mode=arg.suv_mode,
+        criteria=batch_cli.series_criteria(arg),
+        pipeline=config,
+    )
+    watcher.run(interval=arg.interval)
+    return 0